@@ -2,7 +2,6 @@ import numpy as np
 import pandas as pd
 import datetime
 import logging
-from tqdm import tqdm
 
 l = logging.getLogger('bfv_ingestor')
 
@@ -18,7 +17,7 @@ class MatchPlayerProcessor:
 
         self.db = ProcessingDB()
         self.process_all = process_all
-        self.breakthrough_ref = pd.read_csv('D:/Documents/Battlefield Analytics/BFV/data/manual/breakthrough_ref.csv').set_index(['map', 'team'])
+        self.breakthrough_ref_path = BREAKTHROUGH_REF_PATH # shared and cached, see get_breakthrough_ref
         self.matches_to_process = []
 
         if not process_all:
@@ -31,27 +30,41 @@ class MatchPlayerProcessor:
 
     def get_matches_for_processing(self):
         """
-        Compares insert and process_dates to determine what needs processing.
+        Finds parsed matches that haven't been processed yet.
         """
 
-        all_matches = self.db.get_parsed_matches_by_date()
-        all_processed_matches = self.db.get_processed_matches_by_date()
+        self.matches_to_process = self.db.get_unprocessed_match_ids()
 
-        self.matches_to_process = [x['_id'] for x in all_matches if x['_id'] not in [y['_id'] for y in all_processed_matches]]
-
-    def process(self):
+    def process(self, batch_size=200):
         """
-        Orchestration for processing matches
+        Orchestration for processing matches, batch_size matches at a time
         """
 
         total = len(self.matches_to_process)
-        for i, unproc_match in enumerate(self.matches_to_process):
+        for start in range(0, total, batch_size):
 
-            l.debug(f"Processing {unproc_match}, {i}/{total}")
-            match = self.db.get_match(unproc_match)
+            batch = self.matches_to_process[start:start+batch_size]
+            l.debug(f"Processing {batch[0]} to {batch[-1]}, {start+len(batch)}/{total}")
+            self.process_batch(batch)
 
-            if match is None:
-                continue
+        return True
+
+    def process_match(self, match_id):
+        """
+        Processes a single parsed match and its players, False if it couldn't be
+        """
+
+        return self.process_batch([match_id]) > 0
+
+    def process_batch(self, match_ids):
+        """
+        Processes many parsed matches at once, players of every match are handled together as columns.
+        Returns how many matches were written.
+        """
+
+        processed_matches = []
+        matches = []
+        for match in self.db.get_matches(match_ids):
 
             processed_match = {'_id':match['_id']}
 
@@ -65,21 +78,20 @@ class MatchPlayerProcessor:
             # Cleaning
             processed_match.update(self.clean_overall_match_stats(match))
 
-            # Process Players
-            processed_players = self.process_players(match, match['team_1'], match['team_2'])
+            processed_matches.append(processed_match)
+            matches.append(match)
 
-            # Add Overall stats to players
-            for player in processed_players:
-                player['match_start_time'] = processed_match['start_time']
+        if len(matches) == 0:
+            return 0
 
-            # Assign Orientations
-            processed_players = self.assign_orientations(processed_players)
+        # Process Players
+        processed_players = self.process_players(matches, processed_matches)
 
-            # Push
-            self.db.upsert_processed_match(processed_match)
-            self.db.upsert_match_players(processed_players)
+        # Push, players first so a match only counts as processed once its players are in
+        self.db.upsert_match_players(processed_players)
+        self.db.bulk_upsert_processed_matches(processed_matches)
 
-        return True
+        return len(matches)
 
     def clean_overall_match_stats(self, match):
         """
@@ -88,93 +100,103 @@ class MatchPlayerProcessor:
 
         out = {}
 
-        if 'h' not in match['duration']:
-            out['duration_m'] = (int(match['duration'].split('m ')[0])) + int(match['duration'].split('m ')[1].split('s')[0])/60
-        else:
-            out['duration_m'] = (int(match['duration'].split('h ')[0])*60) + int(match['duration'].split('h ')[1].split('m')[0])
+        out['duration_m'] = duration_parse(match['duration'])
 
         out['start_time'] = datetime.datetime.strptime(match['datetime'], r'%m/%d/%y @ %I:%M %p')
 
         return out
 
-    def process_players(self, match, team_1_name, team_2_name):
+    # Player stats that go through stat_parse
+    PLAYER_STATS = ['kills', 'deaths', 'kills_per_death', 'kills_per_min', 'solider_damages', 'headshots',
+        'kill_assists','avenger_kills','savior_kills','shots_taken','shots_hit','shot_accuracy', 'dogtags_taken',
+        'highest_killstreak','highest_multikill','heals','revives','revives_recieved',
+        'resupplies','repairs','squad_spawns','squad_wipes','orders_completed','score','score_per_min']
+
+    def process_players(self, matches, processed_matches):
         """
-        Processes players from a match. Writes to DB and returns them.
+        Processes the players of many matches as one frame and returns their records
         """
 
-        out = [{} for x in match['players']]
-
-        for i, player in enumerate(match['players']):
-
-            processed = {'_id':match['_id']+'_'+player['player_id']}
-            processed['match_id'] = match['_id']
-            processed['map'] = match['map']
-            processed['mode'] = match['mode']
-            processed['game_duration_m'] = match['duration']
-
-            # No Cleaning
-            keys = ['team', 'team_status', 'player_id']
-            processed.update({k:player[k] for k in keys})
-
-            # Clean Type Conversion
-            keys = ['kills', 'deaths', 'kills_per_death', 'kills_per_min', 'solider_damages', 'headshots',
-            'kill_assists','avenger_kills','savior_kills','shots_taken','shots_hit','shot_accuracy', 'dogtags_taken',
-            'highest_killstreak','highest_multikill','heals','revives','revives_recieved',
-            'resupplies','repairs','squad_spawns','squad_wipes','orders_completed','score','score_per_min']
-            processed.update({k:stat_parse(player[k]) for k in keys})
-
-            # Manual Parsing
-            processed['longest_headshot'] = int(player['longest_headshot'].split('m')[0]) if 'k' not in player['longest_headshot'] else int(player['longest_headshot'].split('k')[0])*1000
-            
-            # Simple Calculations
-            processed['true_deaths'] = processed['deaths']+processed['revives_recieved']
-            processed['true_kills_per_death'] = processed['kills']/max([processed['true_deaths'], 1])
-            
-            # Update match list
-            out[i].update(processed)
+        players = pd.DataFrame([player for match in matches for player in match['players']],
+                               columns=['team', 'team_status', 'player_id', 'longest_headshot'] + self.PLAYER_STATS, dtype=object)
+        if len(players) == 0:
+            return []
+        if players.isna().any().any():
+            raise KeyError(f'Players missing stats: {list(players.columns[players.isna().any()])}')
+
+        # Match info repeated down each match's players
+        counts = [len(match['players']) for match in matches]
+        for key in ['_id', 'map', 'mode', 'duration', 'team_1', 'team_2']:
+            players['match_'+key] = np.repeat([match[key] for match in matches], counts)
+        start_times = np.repeat(np.array([x['start_time'] for x in processed_matches], dtype=object), counts) # kept as datetimes
+
+        # Clean Type Conversion, each value keeps the int or float type stat_parse would give it
+        parsed, parsed_int = stat_parse_column(players[self.PLAYER_STATS].to_numpy(object).ravel(order='F'))
+        values = dict(zip(self.PLAYER_STATS, parsed.reshape(len(self.PLAYER_STATS), -1)))
+        is_int = dict(zip(self.PLAYER_STATS, parsed_int.reshape(len(self.PLAYER_STATS), -1)))
+
+        # Distances
+        values['longest_headshot'], is_int['longest_headshot'] = distance_parse_column(players['longest_headshot'])
+
+        # Simple Calculations
+        values['true_deaths'] = values['deaths'] + values['revives_recieved']
+        is_int['true_deaths'] = is_int['deaths'] & is_int['revives_recieved']
+        values['true_kills_per_death'] = values['kills'] / np.maximum(values['true_deaths'], 1)
+        is_int['true_kills_per_death'] = np.zeros(len(players), dtype=bool)
 
         # Complex Calcluations (warrant their own function)
-        out = self.rank_match_players(out, team_1_name, team_2_name)
+        values['overall_rank'], values['team_rank'] = self.rank_match_players(players, values['score'])
+        is_int['overall_rank'] = is_int['team_rank'] = np.ones(len(players), dtype=bool)
+
+        orientation = self.assign_orientations(players)
+
+        # Back to documents, keys in the order they've always been written
+        columns = {'_id':(players['match__id'] + '_' + players['player_id']).to_numpy(object),
+                   'match_id':players['match__id'].to_numpy(object),
+                   'map':players['match_map'].to_numpy(object),
+                   'mode':players['match_mode'].to_numpy(object),
+                   'game_duration_m':players['match_duration'].to_numpy(object),
+                   'team':players['team'].to_numpy(object),
+                   'team_status':players['team_status'].to_numpy(object),
+                   'player_id':players['player_id'].to_numpy(object)}
+        for k in self.PLAYER_STATS + ['longest_headshot', 'true_deaths', 'true_kills_per_death', 'overall_rank', 'team_rank']:
+            columns[k] = native_values(values[k], is_int[k])
+        columns['match_start_time'] = start_times
+
+        keys = list(columns)
+        out = [dict(zip(keys, row)) for row in zip(*columns.values())]
+        orientation = orientation.to_numpy(object)
+        for i in np.flatnonzero(pd.notna(orientation)):
+            out[i]['team_orientation'] = orientation[i]
 
         return out
 
-    def rank_match_players(self, processed_players, team_1_name, team_2_name):
+    def rank_match_players(self, players, score):
         """
-        Ranks players on team and overall after they've been processed
+        Ranks players on team and overall by score. Tied players share the lowest of their places.
+        Players on neither team are ranked among the rest.
         """
 
-        # Rank dictionaries (Score)
-        overall_rank_dict = {y:j+1 for j, y in enumerate(sorted([x['score'] for x in processed_players], reverse=True))}
-        team_1_rank_dict = {y:j+1 for j, y in enumerate(sorted([x['score'] for x in processed_players if x['team']==team_1_name], reverse=True))}
-        team_2_rank_dict = {y:j+1 for j, y in enumerate(sorted([x['score'] for x in processed_players if x['team']==team_2_name], reverse=True))}
-        dnf_rank_dict = {y:j+1 for j, y in enumerate(sorted([x['score'] for x in processed_players if x['team']=='Unknown'], reverse=True))}
+        frame = pd.DataFrame({'match':players['match__id'].to_numpy(), 'score':score,
+                              'team':np.where((players['team'] == players['match_team_1']) | (players['team'] == players['match_team_2']),
+                                              players['team'], 'Unknown')})
 
-        out = [player for player in processed_players]
-        for i, player in enumerate(processed_players):
+        overall = frame.groupby('match', sort=False)['score'].rank(method='max', ascending=False)
+        team = frame.groupby(['match', 'team'], sort=False)['score'].rank(method='max', ascending=False)
 
-            out[i]['overall_rank'] = overall_rank_dict[player['score']]
+        return overall.to_numpy(), team.to_numpy()
 
-            if player['team'] == team_1_name:
-                out[i]['team_rank'] = team_1_rank_dict[player['score']]
-            elif player['team'] == team_2_name:
-                out[i]['team_rank'] = team_2_rank_dict[player['score']]
-            else:
-                out[i]['team_rank'] = dnf_rank_dict[player['score']]
-            
-        return out
-
-    def assign_orientations(self, match_players):
+    def assign_orientations(self, players):
         """
-        adds attacker and defender info
+        Attacker and defender info for Breakthrough players, looked up in breakthrough_ref. NaN for other modes.
         """
 
-        for i, match_player in enumerate(match_players):
-            if match_player['mode']=='Breakthrough':
-                match_players[i]['team_orientation'] = self.breakthrough_ref.loc[(match_player['map'], match_player['team']), 'orientation']
-            else:
-                continue
+        breakthrough = (players['match_mode'] == 'Breakthrough').to_numpy()
 
-        return match_players
+        out = pd.Series(np.nan, index=players.index, dtype=object)
+        out[breakthrough] = orientation_lookup(players['match_map'][breakthrough], players['team'][breakthrough], self.breakthrough_ref_path)
+
+        return out
 
 class AnalyticsProcessor:
     """
@@ -189,77 +211,63 @@ class AnalyticsProcessor:
         
     def run(self):
         """
-        Orchestration for analytics
+        Orchestration for analytics. Everything that needs a metric is loaded once,
+        the metric families are computed as columns and written back in one bulk pass.
         """
 
-        self.player_time()
-        self.AER()
-        self.adj_pm()
-        
+        l.debug("Preparing Match Player Metrics")
+        cols = {'_id':1, 'score':1, 'score_per_min':1, 'kills':1, 'deaths':1, 'team_status':1, 'game_duration_m':1,
+                'player_time':1, 'AER':1, 'duration_m':1}
+        q = {} if self.process_all else self.pdb.METRIC_QUEUE
+        df = pd.DataFrame(list(self.pdb.processed_match_players.find(q, cols)))
 
-    # Match Player - Simple
-    def player_time(self):
-        """
-        How long the player was in the game
-        """
+        l.debug(f"Computing for {len(df)} Match Players")
+        if len(df) == 0:
+            return None
 
-        l.debug("Preparing Player Time Metric")
-        cols = {'_id':1, 'score_per_min':1, 'score':1}
-        q = {} if self.process_all else {'player_time':{"$exists":False}}
-        to_process = list(self.pdb.processed_match_players.find(q, cols))
+        # Stored values mark what's already done, process_all redoes everything
+        df = df.reindex(columns=list(cols.keys()))
+        todo = {metric: df[metric].isna() | self.process_all for metric in ['player_time', 'AER', 'duration_m']}
+        todo['AER'] &= df['team_status'] != 'dnf'
 
-        l.debug(f"Computing for {len(to_process)} Match Players")
-        out = [{"_id":x['_id'], "player_time":(x['score']/max([x['score_per_min'], 1]))} for x in tqdm(to_process)]
+        out = pd.DataFrame({'_id':df['_id']})
+        out = out.join(self.player_time(df)[todo['player_time']])
+        df['player_time'] = df['player_time'].where(~todo['player_time'], out['player_time'])
+        out = out.join(self.AER(df)[todo['AER']])
+        out = out.join(self.adj_pm(df)[todo['duration_m']])
 
         l.debug("Saving to DB")
-        self.pdb.safe_upsert_match_players(out)
+        records = out.astype(object).where(out.notna(), None).to_dict('records')
+        self.pdb.safe_upsert_match_players([{k:v for k, v in x.items() if v is not None} for x in records])
 
-    def AER(self):
+    # Match Player - Simple
+    def player_time(self, df):
         """
         How long the player was in the game
         """
 
-        l.debug("Preparing AER Metric")
-        cols = {'_id':1, 'player_time':1, 'kills':1, 'score':1, 'deaths':1}
-        base_q = {'team_status':{"$ne":"dnf"}}
-        q = base_q
+        return pd.DataFrame({"player_time":df['score']/df['score_per_min'].clip(lower=1)})
 
-        if not self.process_all:
-            q.update({'AER':{"$exists":False}})
-        to_process = list(self.pdb.processed_match_players.find(q, cols))
+    def AER(self, df):
+        """
+        Aggression and Efficiency ratings
+        """
 
-        l.debug(f"Computing for {len(to_process)} Match Players")
-        out = [{'_id':x["_id"]} for x in to_process]
-        for i, x in enumerate(tqdm(to_process)):
-            out[i].update({'aggression_rating':.005*min([((x['score'] + (100*x['kills']))/max([x['player_time'], 1])), 1000])})
-            out[i].update({'efficiency_rating':5*min([((x['score'] + (100*x['kills']))/max([x['deaths'], 1])), 1600])/1600})
-            out[i].update({'AER':out[i]['aggression_rating']+out[i]['efficiency_rating']})
+        points = df['score'] + (100*df['kills'])
+        out = pd.DataFrame({'aggression_rating':.005*(points/df['player_time'].clip(lower=1)).clip(upper=1000),
+                            'efficiency_rating':5*(points/df['deaths'].clip(lower=1)).clip(upper=1600)/1600})
+        out['AER'] = out['aggression_rating'] + out['efficiency_rating']
 
-        l.debug("Saving to DB")
-        self.pdb.safe_upsert_match_players(out)
+        return out
 
-    def adj_pm(self):
+    def adj_pm(self, df):
         """
         Computes and adjusted SPM based on match length not player time
         """
-        l.debug("Preparing Adjusted PM Metrics")
-        cols = {'_id':1, 'score':1, 'kills':1, 'game_duration_m':1}
-        q = {}
-
-        if not self.process_all:
-            q.update({'duration_m':{"$exists":False}})
-        to_process = list(self.pdb.processed_match_players.find(q, cols))
 
-        l.debug(f"Computing for {len(to_process)} Match Players")
-        out = [{'_id':x["_id"]} for x in to_process]
-        for i, x in enumerate(tqdm(to_process)):
-            if 'h' not in x['game_duration_m']:
-                out[i].update({'duration_m':(int(x['game_duration_m'].split('m ')[0])) + int(x['game_duration_m'].split('m ')[1].split('s')[0])/60})
-            else:
-                out[i].update({'duration_m':(int(x['game_duration_m'].split('h ')[0])*60) + int(x['game_duration_m'].split('h ')[1].split('m')[0])})
+        out = pd.DataFrame({'duration_m':duration_parse_column(df['game_duration_m'])[0]}, index=df.index)
 
-            out[i].update({'adj_spm':x['score']/max([out[i]['duration_m'], 1])})
-            out[i].update({'adj_kpm':x['kills']/max([out[i]['duration_m'], 1])})
+        out['adj_spm'] = df['score']/out['duration_m'].clip(lower=1)
+        out['adj_kpm'] = df['kills']/out['duration_m'].clip(lower=1)
 
-        l.debug("Saving to DB")
-        self.pdb.safe_upsert_match_players(out)
+        return out
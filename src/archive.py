@@ -0,0 +1,211 @@
+# Raw report archive, compressed pages in append-only segments with a SQLite index
+
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+from datetime import datetime
+import zstandard
+
+l = logging.getLogger('bfv_ingestor')
+
+ARCHIVE_DIR = 'D:/Documents/Battlefield Analytics/BFV/data/archive/'
+
+class ReportArchive:
+    """
+    Stores report html zstd compressed, one frame per page, appended to segment files that roll over
+    at segment_size bytes. Pages are content addressed, identical html is only stored once.
+    The index maps match ids to their page and tracks whether each has been parsed.
+    Reads go through memory maps of the segments.
+    """
+
+    def __init__(self, root=ARCHIVE_DIR, segment_size=256*1024*1024, level=10):
+
+        self.root = root
+        self.segment_size = segment_size
+        self.level = level # zstd compression level
+        self.lock = threading.Lock() # saver workers share one archive
+        self.maps = {} # segment -> (file, mmap)
+
+        os.makedirs(root, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(root, 'index.db'), check_same_thread=False)
+        self.index.execute('PRAGMA journal_mode=WAL') # parse workers read while the saver writes
+        self.index.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, segment INTEGER, offset INTEGER, length INTEGER, raw_length INTEGER)')
+        self.index.execute('CREATE TABLE IF NOT EXISTS reports (match_id TEXT PRIMARY KEY, digest TEXT, saved_at TEXT, parsed INTEGER DEFAULT 0)')
+        self.index.execute('CREATE INDEX IF NOT EXISTS reports_parsed ON reports (parsed)')
+        self.index.execute('CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, match_id TEXT, updated_at TEXT)')
+        self.index.commit()
+
+    def segment_path(self, segment):
+
+        return os.path.join(self.root, f'segment_{segment:05d}.zst')
+
+    def current_segment(self):
+        """
+        Segment new pages are appended to, a new one once the last is full
+        """
+
+        segment = self.index.execute('SELECT MAX(segment) FROM blobs').fetchone()[0] or 0
+        path = self.segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_size:
+            segment += 1
+
+        return segment
+
+    def put(self, match_id, page, parsed=False):
+        """
+        Archives a page for match_id, replacing any page it had and marking it unparsed (or parsed)
+        """
+
+        raw = page.encode('utf-8')
+        digest = hashlib.sha256(raw).hexdigest()
+
+        with self.lock:
+            if self.index.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone() is None:
+                frame = zstandard.ZstdCompressor(level=self.level).compress(raw)
+                segment = self.current_segment()
+                with open(self.segment_path(segment), 'ab') as f:
+                    offset = f.tell()
+                    f.write(frame)
+                self.index.execute('INSERT INTO blobs VALUES (?, ?, ?, ?, ?)', (digest, segment, offset, len(frame), len(raw)))
+
+            self.index.execute('INSERT OR REPLACE INTO reports (match_id, digest, saved_at, parsed) VALUES (?, ?, ?, ?)',
+                               (match_id, digest, datetime.now().isoformat(), int(parsed)))
+            self.index.commit()
+
+    def get(self, match_id):
+        """
+        The page archived for match_id, raises KeyError if there isn't one
+        """
+
+        with self.lock:
+            found = self.index.execute('SELECT b.segment, b.offset, b.length FROM reports r JOIN blobs b ON r.digest = b.digest WHERE r.match_id = ?',
+                                       (match_id,)).fetchone()
+            if found is None:
+                raise KeyError(f'{match_id} not archived.')
+
+            segment, offset, length = found
+            frame = self.segment_map(segment, offset+length)[offset:offset+length]
+
+        return zstandard.ZstdDecompressor().decompress(frame).decode('utf-8')
+
+    def segment_map(self, segment, end):
+        """
+        Memory map of a segment covering at least end bytes, remapped if the segment has grown since
+        """
+
+        if segment not in self.maps or len(self.maps[segment][1]) < end:
+            self.close_segment(segment)
+            f = open(self.segment_path(segment), 'rb')
+            self.maps[segment] = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        return self.maps[segment][1]
+
+    def close_segment(self, segment):
+
+        if segment in self.maps:
+            f, segment_map = self.maps.pop(segment)
+            segment_map.close()
+            f.close()
+
+    def __contains__(self, match_id):
+
+        with self.lock:
+            return self.index.execute('SELECT 1 FROM reports WHERE match_id = ?', (match_id,)).fetchone() is not None
+
+    def ids(self, parsed=None):
+        """
+        Archived match ids in order, only parsed or unparsed ones if parsed is given
+        """
+
+        with self.lock:
+            if parsed is None:
+                rows = self.index.execute('SELECT match_id FROM reports ORDER BY match_id').fetchall()
+            else:
+                rows = self.index.execute('SELECT match_id FROM reports WHERE parsed = ? ORDER BY match_id', (int(parsed),)).fetchall()
+
+        return [x[0] for x in rows]
+
+    def mark_parsed(self, match_ids, parsed=True):
+        """
+        Flags matches as parsed (or not)
+        """
+
+        with self.lock:
+            self.index.executemany('UPDATE reports SET parsed = ? WHERE match_id = ?', [(int(parsed), x) for x in match_ids])
+            self.index.commit()
+
+    def get_checkpoint(self, name):
+        """
+        Last match id a named job over the archive got through, None if it hasn't started
+        """
+
+        with self.lock:
+            found = self.index.execute('SELECT match_id FROM checkpoints WHERE name = ?', (name,)).fetchone()
+
+        return None if found is None else found[0]
+
+    def set_checkpoint(self, name, match_id):
+        """
+        Records progress of a named job, None clears it
+        """
+
+        with self.lock:
+            if match_id is None:
+                self.index.execute('DELETE FROM checkpoints WHERE name = ?', (name,))
+            else:
+                self.index.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)', (name, match_id, datetime.now().isoformat()))
+            self.index.commit()
+
+    def import_dir(self, directory, parsed=False, remove=False):
+        """
+        Archives the loose .html reports in directory, for moving over from the old unparsed/parsed folders.
+        Each file goes in whole with its parsed flag and reports already archived are left alone, so an
+        interrupted import is finished by running it again. Completion is recorded, see imported.
+        """
+
+        files = sorted(x for x in os.listdir(directory) if x.endswith('.html'))
+        archived = set(self.ids())
+        imported = 0
+        for filename in files:
+            match_id = filename[:-5]
+            if match_id not in archived:
+                with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+                    self.put(match_id, f.read(), parsed)
+                imported += 1
+            if remove:
+                os.remove(os.path.join(directory, filename))
+
+        self.set_checkpoint(self.import_checkpoint(directory), files[-1][:-5] if files else '')
+        l.debug(f'Archived {imported} reports from {directory}, {len(files)-imported} were already archived.')
+
+        return imported
+
+    def import_checkpoint(self, directory):
+
+        return 'import '+os.path.abspath(directory)
+
+    def imported(self, directory):
+        """
+        Whether an import of directory has run to the end
+        """
+
+        return self.get_checkpoint(self.import_checkpoint(directory)) is not None
+
+    def stats(self):
+        """
+        Report count, distinct pages, raw and stored bytes
+        """
+
+        reports = self.index.execute('SELECT COUNT(*), COUNT(DISTINCT digest) FROM reports').fetchone()
+        sizes = self.index.execute('SELECT COALESCE(SUM(raw_length), 0), COALESCE(SUM(length), 0) FROM blobs').fetchone()
+
+        return {'reports':reports[0], 'pages':reports[1], 'raw_bytes':sizes[0], 'stored_bytes':sizes[1]}
+
+    def close(self):
+
+        for segment in list(self.maps):
+            self.close_segment(segment)
+        self.index.close()
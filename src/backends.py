@@ -0,0 +1,96 @@
+# Fetch backends, how pages get off the tracker and into the scrapers
+
+import logging
+import os
+from selenium import webdriver
+
+l = logging.getLogger('bfv_ingestor')
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as ec
+from selenium.webdriver.support.wait import WebDriverWait
+
+gecko_driver_path = os.getenv('gecko_driver_path')
+
+class FetchBackend:
+    """
+    Interface for page fetchers. Load a url, wait for it to be ready, then read its source.
+    """
+
+    supports_scripts = False # Whether execute_script (scrolling etc.) is available
+
+    def load(self, url, ready_class, timeout=120):
+        """
+        Loads url, raising if an element with ready_class never shows up
+        """
+
+        raise NotImplementedError
+
+    def page_source(self):
+        """
+        Returns the source of the last loaded page
+        """
+
+        raise NotImplementedError
+
+    def execute_script(self, script, *args):
+        """
+        Runs javascript on the current page, args are available to it as arguments
+        """
+
+        raise NotImplementedError(f'{type(self).__name__} cannot run scripts.')
+
+    def close(self):
+        """
+        Releases anything held by the backend
+        """
+
+        pass
+
+class SeleniumBackend(FetchBackend):
+    """
+    Full Firefox browser, renders javascript loaded pages.
+    """
+
+    supports_scripts = True
+
+    def __init__(self):
+
+        self.browser = webdriver.Firefox(executable_path=gecko_driver_path)
+
+    def load(self, url, ready_class, timeout=120):
+
+        self.browser.get(url)
+        WebDriverWait(self.browser, timeout).until(ec.visibility_of_element_located((By.CLASS_NAME, ready_class)))
+
+        return True
+
+    def page_source(self):
+
+        return self.browser.page_source
+
+    def execute_script(self, script, *args):
+
+        return self.browser.execute_script(script, *args)
+
+    def close(self):
+
+        self.browser.close()
+
+BACKENDS = {'selenium':SeleniumBackend}
+
+def get_backend(name):
+    """
+    Builds a fetch backend by name, or from a FetchBackend subclass (e.g. one serving a local stand-in)
+    """
+
+    if isinstance(name, type) and issubclass(name, FetchBackend):
+        return name()
+
+    if name not in BACKENDS:
+        raise ValueError(f"{name} not a supported backend.")
+
+    return BACKENDS[name]()
@@ -0,0 +1,117 @@
+# Re-parses archived reports to fill in new or changed match fields
+
+import logging
+import multiprocessing
+
+l = logging.getLogger('bfv_ingestor')
+
+from archive import ARCHIVE_DIR, ReportArchive
+from db import ProcessingDB
+import scrapers
+
+class Backfill:
+    """
+    Streams every archived report back through MatchParser and $sets fields on the already stored matches.
+    With fields given only those are written, otherwise every top level field whose value changed.
+    Progress is checkpointed in the archive index under name after each batch, so a restarted backfill
+    picks up after the last batch that was written.
+    """
+
+    def __init__(self, name, fields=None, workers=1, batch_size=500, engine='lxml', archive_dir=ARCHIVE_DIR):
+
+        self.name = name
+        self.fields = fields # top level match fields, None to diff against what's stored
+        self.workers = workers
+        self.batch_size = batch_size
+        self.engine = engine
+        self.archive = ReportArchive(archive_dir)
+        self.processing_db = ProcessingDB()
+
+    def get_matches_for_backfill(self, restart=False):
+        """
+        Parsed matches still to go, after the checkpoint unless restarting
+        """
+
+        checkpoint = None if restart else self.archive.get_checkpoint(self.name)
+        matches = self.archive.ids(parsed=True)
+        if checkpoint is not None:
+            l.debug(f'Resuming {self.name} after {checkpoint}.')
+            matches = [x for x in matches if x > checkpoint]
+
+        return matches
+
+    def run(self, restart=False):
+        """
+        Runs (or resumes) the backfill
+        """
+
+        matches = self.get_matches_for_backfill(restart)
+        jobs = [(match, self.fields) for match in matches]
+        l.debug(f'Backfilling {len(jobs)} Matches for {self.name}.')
+
+        if self.workers > 1:
+            with multiprocessing.Pool(self.workers, initializer=scrapers.init_parse_worker, initargs=(self.engine, self.archive.root)) as pool:
+                self.write_all(pool.imap(backfill_worker, jobs, chunksize=8), len(jobs))
+        else:
+            parser = scrapers.MatchParser(engine=self.engine, connect=False, archive_dir=self.archive.root)
+            self.write_all((read_fields(parser, *job) for job in jobs), len(jobs))
+
+        self.archive.set_checkpoint(self.name, None)
+        l.debug(f'{self.name} finished.')
+
+    def write_all(self, results, total):
+        """
+        Consumes (match, fields, error) in match order, writing and checkpointing a batch at a time
+        """
+
+        batch = []
+        written = failed = 0
+
+        for i, (match, fields, error) in enumerate(results):
+            if error is not None:
+                l.debug(f'Could not backfill {match}: {error}')
+                failed += 1
+            else:
+                batch.append((match, fields))
+
+            if len(batch) >= self.batch_size or i == total-1:
+                written += self.write(batch)
+                self.archive.set_checkpoint(self.name, match)
+                l.debug(f'{self.name}: {i+1}/{total}, {written} Updated, {failed} Failed.')
+                batch = []
+
+    def write(self, batch):
+        """
+        Sets a batch of parsed fields, only what changed if no fields were asked for
+        """
+
+        if self.fields is None:
+            stored = self.processing_db.get_match_fields([match for match, fields in batch], {field for match, fields in batch for field in fields})
+            batch = [(match, {k:v for k, v in fields.items() if stored.get(match, {}).get(k) != v}) for match, fields in batch]
+
+        batch = [(match, fields) for match, fields in batch if len(fields) > 0]
+        if len(batch) > 0:
+            self.processing_db.set_match_fields(batch)
+
+        return len(batch)
+
+def read_fields(parser, match, fields=None):
+    """
+    Fully parses one archived report down to fields (all of them if None)
+    """
+
+    try:
+        data = parser.read(match, full=True)
+        data.pop('_id')
+        if fields is not None:
+            data = {field:data[field] for field in fields if field in data} # a field the report lacks is left alone
+        return match, data, None
+    except Exception as e:
+        return match, None, repr(e)
+
+def backfill_worker(job):
+    """
+    Pool entry point, job is (match, fields)
+    """
+
+    return read_fields(scrapers.worker_parser, *job)
@@ -1,23 +1,155 @@
 # Decoupled Database function
 import os
-from pymongo import MongoClient
+import time
+from pymongo import IndexModel, MongoClient, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 from datetime import date, datetime, timedelta
 import sqlite3 as db
+import shutil
+from functools import reduce
 import logging
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
 from dotenv import load_dotenv
 from tqdm import tqdm
 load_dotenv()
 
+from stats import ALL, GroupStats, QuantileSketch, lookup, percentile_bins
+
 l = logging.getLogger('bfv_ingestor')
 
+class BulkWriter:
+    """
+    Buffers write operations for a collection and sends them as unordered bulk writes, flushing every batch_size ops.
+    Use as a context manager so the tail gets flushed. Failed writes are counted, logged and raised.
+    """
+
+    def __init__(self, collection, batch_size=1000):
+
+        self.collection = collection
+        self.batch_size = batch_size
+        self.ops = []
+
+        # Running totals across batches
+        self.batches = 0
+        self.written = 0
+        self.errors = 0
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, *args):
+
+        # Don't send the tail after a failed batch, the error is on its way up
+        if exc_type is None:
+            self.flush()
+
+    def add(self, op):
+        """
+        Queues an UpdateOne/ReplaceOne, flushing if the batch is full
+        """
+
+        self.ops.append(op)
+        if len(self.ops) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes whatever is queued, re-raising BulkWriteError once the batch is accounted for
+        """
+
+        if len(self.ops) == 0:
+            return None
+
+        start = time.perf_counter()
+        errors = 0
+        failure = None
+        try:
+            self.collection.bulk_write(self.ops, ordered=False)
+        except BulkWriteError as e:
+            failure = e
+            write_errors = e.details.get('writeErrors', [])
+            concern_errors = e.details.get('writeConcernErrors', [])
+            errors = len(write_errors)
+            first = (write_errors or concern_errors or [{}])[0]
+            l.debug(f"{self.collection.name}: {len(write_errors)} write errors, {len(concern_errors)} write concern errors, first {first.get('errmsg')}")
+
+        self.batches += 1
+        self.written += len(self.ops) - errors
+        self.errors += errors
+        l.debug(f'{self.collection.name}: batch {self.batches} wrote {len(self.ops)-errors}/{len(self.ops)} in {time.perf_counter()-start:.2f}s, {errors} Errors')
+
+        self.ops = []
+
+        if failure is not None:
+            raise failure
+
+class QueryPlanError(Exception):
+    """
+    Raised when a hot query's winning plan scans a whole collection
+    """
+
+def ensure_indexes(db, indexes):
+    """
+    Creates the indexes declared for each collection of db, ones that already exist are left alone
+    """
+
+    for collection, models in indexes.items():
+        created = db[collection].create_indexes(models)
+        l.debug(f'{db.name}.{collection}: ensured {created}')
+
+def plan_stages(plan):
+    """
+    Every stage in an explain plan, outermost first
+    """
+
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+
+    return stages
+
+def check_query_plans(db, queries):
+    """
+    Explains each hot query, name -> (collection, filter, sort), and raises QueryPlanError
+    naming every one whose winning plan has a COLLSCAN
+    """
+
+    scans = []
+    for name, (collection, filter, sort) in queries.items():
+        command = {'find':collection, 'filter':filter}
+        if sort is not None:
+            command['sort'] = sort
+
+        stages = plan_stages(db.command('explain', command, verbosity='queryPlanner')['queryPlanner']['winningPlan'])
+        l.debug(f"{name}: {' > '.join(stages)}")
+        if 'COLLSCAN' in stages:
+            scans.append(name)
+
+    if len(scans) > 0:
+        raise QueryPlanError(f'{db.name} queries fall back to collection scans: {scans}. Check ensure_indexes ran.')
+
+    return True
+
 class IngestionDB:
     """
     Class for ingesting data, currently connected to MongoDB
     """
 
-    def __init__(self, mongo_host='', mongo_user='', mongo_pass='', mongo_db=''):
+    # Indexes each collection needs, ensured on connect
+    INDEXES = {'game_reports':[IndexModel('mode')],
+               'players':[IndexModel('last_crawled'), IndexModel('crawl_due')]}
+
+    def __init__(self, mongo_host='', mongo_user='', mongo_pass='', mongo_db='', batch_size=1000):
 
         # Build mongo client and db
         try:
@@ -30,35 +162,74 @@ class IngestionDB:
             raise Exception("Database connections could not be created from environment. Check connection and/or environment variables.")
 
         self.db = self.mc['bfv_ingestion']
+        self.batch_size = batch_size # ops per bulk write
 
         # Collections
         self.game_reports = self.db.game_reports
         self.players = self.db.players
 
+        ensure_indexes(self.db, self.INDEXES)
+
+    def hot_queries(self):
+        """
+        Queries run every cycle, name -> (collection, filter, sort), see check_indexes
+        """
+
+        now = datetime.now()
+
+        return {'matches_by_mode':('game_reports', {'mode':'Breakthrough'}, None),
+                'recently_crawled':('players', {'last_crawled':{'$gte':now}}, None),
+                'frontier_due':('players', self.due_filter(now), {'crawl_due':1})}
+
+    def check_indexes(self):
+        """
+        Raises QueryPlanError if any hot query would scan a whole collection
+        """
+
+        return check_query_plans(self.db, self.hot_queries())
+
+    def due_filter(self, now):
+        """
+        Players due a crawl at now, ones never scheduled count as due
+        """
+
+        return {'$or':[{'crawl_due':{'$lte':now}}, {'crawl_due':{'$exists':False}}]}
+
     def update_players(self, players):
         """
         Writes players into database.
         """
 
-        # upsert player and their most recent match
-        for player in players:
-            upsert = {'_id':player}
-            self.players.update({'_id':player}, upsert, True)
-        
+        # insert new players only, crawl tracking on existing ones is left alone
+        with BulkWriter(self.players, self.batch_size) as writer:
+            for player in dict.fromkeys(players):
+                now = datetime.now()
+                writer.add(UpdateOne({'_id':player}, {'$setOnInsert':{'first_seen':now, 'crawl_due':now}}, upsert=True))
+
+    def get_recently_crawled(self, crawl_window=7):
+        """
+        Players crawled within window days
+        """
+
+        q = {'last_crawled':{'$gte':datetime.now() - timedelta(days=crawl_window)}}
+
+        return {x['_id'] for x in self.players.find(q, {'_id':1})}
+
     def upsert_matches(self, match_ids, match_modes=None):
         """
         Writes matches into database.
         """
 
         # upsert match and their most recent scrape date
-        for i, match in enumerate(match_ids):
-            upsert = {'_id':match, 'insert_date':datetime.now()}
+        with BulkWriter(self.game_reports, self.batch_size) as writer:
+            for i, match in enumerate(match_ids):
+                upsert = {'_id':match, 'insert_date':datetime.now()}
 
-            # If the match_mode was scraped out as well, add it in
-            if match_modes is not None:
-                upsert.update({'mode':match_modes[i]})
+                # If the match_mode was scraped out as well, add it in
+                if match_modes is not None:
+                    upsert.update({'mode':match_modes[i]})
 
-            self.game_reports.update({'_id':match}, upsert, True)
+                writer.add(ReplaceOne({'_id':match}, upsert, upsert=True))
 
     def get_players(self, sample=False, n=100):
         """
@@ -86,7 +257,20 @@ class ProcessingDB:
     Database wrapper designed specifically for parsed results, computations and cleanups
     """
 
-    def __init__(self, mongo_host='', mongo_user='', mongo_pass='', mongo_db=''):
+    ACTIVITY_RETENTION = 400 # days activity buckets are kept
+
+    # Match players still missing an AnalyticsProcessor metric
+    METRIC_QUEUE = {"$or":[{'player_time':{"$exists":False}},
+                           {'AER':{"$exists":False}, 'team_status':{"$ne":"dnf"}},
+                           {'duration_m':{"$exists":False}}]}
+
+    # Indexes each collection needs, ensured on connect. Partial indexes can't filter on $exists:false,
+    # so the METRIC_QUEUE fields get plain indexes, missing fields are indexed as null.
+    INDEXES = {'processed_match_players':[IndexModel('match_start_time'), IndexModel('last_updated'),
+                                          IndexModel('player_time'), IndexModel([('AER', 1), ('team_status', 1)]), IndexModel('duration_m')],
+               'player_activity':[IndexModel('day', expireAfterSeconds=ACTIVITY_RETENTION*24*60*60)]}
+
+    def __init__(self, mongo_host='', mongo_user='', mongo_pass='', mongo_db='', batch_size=1000):
 
         # Build mongo client and db
         try:
@@ -99,12 +283,35 @@ class ProcessingDB:
             raise Exception("Database connections could not be created from environment. Check connection and/or environment variables.")
 
         self.db = self.mc['bfv_processing']
+        self.batch_size = batch_size # ops per bulk write
 
         # Collections
         self.matches = self.db.matches
         self.player_performance = self.db.player_performance
         self.processed_matches = self.db.processed_matches
         self.processed_match_players = self.db.processed_match_players
+        self.player_activity = self.db.player_activity # Daily buckets of who played, by match start, expire after ACTIVITY_RETENTION
+
+        ensure_indexes(self.db, self.INDEXES)
+
+    def hot_queries(self):
+        """
+        Queries run every cycle, name -> (collection, filter, sort), see check_indexes
+        """
+
+        since = datetime.now() - timedelta(days=1)
+
+        return {'recent_match_players':('processed_match_players', {'match_start_time':{'$gte':since}}, None),
+                'updated_match_players':('processed_match_players', {'last_updated':{'$gte':since}}, None),
+                'metric_queue':('processed_match_players', self.METRIC_QUEUE, None),
+                'activity_window':('player_activity', {'day':{'$gte':since}}, None)}
+
+    def check_indexes(self):
+        """
+        Raises QueryPlanError if any hot query would scan a whole collection
+        """
+
+        return check_query_plans(self.db, self.hot_queries())
 
     def upsert_match(self, match_data):
         """
@@ -112,17 +319,59 @@ class ProcessingDB:
         """
 
         match_data['last_updated'] = datetime.now()
-        self.matches.update({'_id':match_data['_id']}, match_data, True)
+        self.matches.replace_one({'_id':match_data['_id']}, match_data, upsert=True)
+
+        return True
+
+    def bulk_upsert_matches(self, matches):
+        """
+        Inserts or updates many fully parsed match_data records
+        """
+
+        with BulkWriter(self.matches, self.batch_size) as writer:
+            for match_data in matches:
+                match_data['last_updated'] = datetime.now()
+                writer.add(ReplaceOne({'_id':match_data['_id']}, match_data, upsert=True))
 
         return True
 
+    def set_match_fields(self, updates):
+        """
+        Sets fields on existing matches without rewriting them, updates are (match_id, {field:value})
+        """
+
+        with BulkWriter(self.matches, self.batch_size) as writer:
+            for match_id, fields in updates:
+                writer.add(UpdateOne({'_id':match_id}, {'$set':{**fields, 'last_updated':datetime.now()}}))
+
+        return True
+
+    def get_match_fields(self, match_ids, fields):
+        """
+        Stored values of fields for many matches, {match_id:{field:value}}
+        """
+
+        return {x.pop('_id'):x for x in self.matches.find({'_id':{'$in':list(match_ids)}}, {field:1 for field in fields})}
+
     def upsert_processed_match(self, match_data):
         """
         Inserts or updates a fully parsed match_data record
         """
 
         match_data['processed_date'] = datetime.now()
-        self.processed_matches.update({'_id':match_data['_id']}, match_data, True)
+        self.processed_matches.replace_one({'_id':match_data['_id']}, match_data, upsert=True)
+
+        return True
+
+    def bulk_upsert_processed_matches(self, matches):
+        """
+        Inserts or updates many processed match records
+        """
+
+        with BulkWriter(self.processed_matches, self.batch_size) as writer:
+            for match_data in matches:
+                match_data['processed_date'] = datetime.now()
+                writer.add(ReplaceOne({'_id':match_data['_id']}, match_data, upsert=True))
 
         return True
 
@@ -131,17 +380,104 @@ class ProcessingDB:
         Inserts new match players
         """
 
+        with BulkWriter(self.processed_match_players, self.batch_size) as writer:
+            for player in match_players:
+                player['last_updated'] = datetime.now()
+                writer.add(ReplaceOne({'_id':player['_id']}, player, upsert=True))
+
+        self.update_player_activity(match_players)
+
+        return True
+
+    def update_player_activity(self, match_players):
+        """
+        Adds match players to the daily activity bucket of their match start. Buckets hold sets
+        of matches and players, so reprocessing a match doesn't count it twice.
+        """
+
+        days = {}
         for player in match_players:
-            self.processed_match_players.update({'_id':player['_id']}, player, True)
+            if 'match_start_time' not in player:
+                continue
+            day = days.setdefault(player['match_start_time'].strftime('%Y-%m-%d'), {'matches':set(), 'players':set()})
+            day['matches'].add(player['match_id'])
+            day['players'].add(player['player_id'])
+
+        with BulkWriter(self.player_activity, self.batch_size) as writer:
+            for day, bucket in days.items():
+                writer.add(UpdateOne({'_id':day},
+                                     {'$setOnInsert':{'day':datetime.strptime(day, '%Y-%m-%d')},
+                                      '$addToSet':{'matches':{'$each':list(bucket['matches'])}, 'players':{'$each':list(bucket['players'])}}},
+                                     upsert=True))
+
+    def migrate_player_activity(self):
+        """
+        One time migration, deployments from before the buckets existed start with none so fill them from history.
+        Does nothing once there are buckets.
+        """
+
+        if self.player_activity.estimated_document_count() > 0:
+            return False
+
+        l.debug('No player activity buckets, rebuilding from processed match players.')
+        self.rebuild_player_activity(self.ACTIVITY_RETENTION)
 
         return True
 
+    def rebuild_player_activity(self, recency_window=400):
+        """
+        Rebuilds the activity buckets from processed match players, for history from before the buckets existed.
+        Needs MongoDB 4.2+ for $merge.
+        """
+
+        pipeline = [{'$match':{'match_start_time':{'$gte':datetime.now() - timedelta(days=recency_window)}}},
+                    {'$group':{'_id':{'$dateToString':{'format':'%Y-%m-%d', 'date':'$match_start_time'}},
+                               'matches':{'$addToSet':'$match_id'},
+                               'players':{'$addToSet':'$player_id'}}},
+                    {'$addFields':{'day':{'$dateFromString':{'dateString':'$_id'}}}}, # midnight of the bucket, as update_player_activity sets it
+                    {'$merge':{'into':'player_activity', 'whenMatched':'replace'}}]
+
+        self.processed_match_players.aggregate(pipeline, allowDiskUse=True)
+
+    def get_activity_buckets(self, recency_window, projection=None):
+        """
+        Daily buckets whose day falls within window days, only these are touched by window queries
+        """
+
+        start = datetime.combine(date.today() - timedelta(days=recency_window), datetime.min.time())
+
+        return self.player_activity.find({'day':{'$gte':start}}, projection)
+
+    def get_active_players(self, recency_window=365):
+        """
+        Distinct players with a match in the last window days
+        """
+
+        players = set()
+        for bucket in self.get_activity_buckets(recency_window, {'players':1}):
+            players.update(bucket['players'])
+
+        return players
+
+    def get_activity_counts(self, recency_window=120):
+        """
+        Matches and distinct players per day over the last window days
+        """
+
+        pipeline = [{'$match':{'day':{'$gte':datetime.combine(date.today() - timedelta(days=recency_window), datetime.min.time())}}},
+                    {'$project':{'day':1, 'matches':{'$size':'$matches'}, 'players':{'$size':'$players'}}},
+                    {'$sort':{'day':1}}]
+
+        return pd.DataFrame(list(self.player_activity.aggregate(pipeline)))
+
     def safe_upsert_match_players(self, match_players):
         """
-        Updates without overwrite (Much Slower, only use incrementally)
+        Updates without overwrite
         """
-        for player in tqdm(match_players):
-            self.processed_match_players.update({'_id':player['_id']}, {"$set":player}, True)
+        with BulkWriter(self.processed_match_players, self.batch_size) as writer:
+            for player in tqdm(match_players):
+                player['last_updated'] = datetime.now()
+                writer.add(UpdateOne({'_id':player['_id']}, {"$set":player}, upsert=True))
 
         return True
 
@@ -159,6 +495,34 @@ class ProcessingDB:
 
         return list(self.processed_matches.find({}, {'processed_date':1}))
 
+    def get_parsed_match_ids(self):
+        """
+        Gets the set of parsed match ids, reading only the _id index
+        """
+
+        return {x['_id'] for x in self.matches.find({}, {'_id':1}).hint('_id_')}
+
+    def get_unprocessed_match_ids(self):
+        """
+        Parsed matches without a processed record, diffed server side over the _id indexes
+        """
+
+        pipeline = [{'$project':{'_id':1}},
+                    {'$lookup':{'from':'processed_matches', 'localField':'_id', 'foreignField':'_id', 'as':'processed'}},
+                    {'$match':{'processed':{'$size':0}}},
+                    {'$project':{'_id':1}}]
+
+        return [x['_id'] for x in self.matches.aggregate(pipeline)]
+
+    def get_matches(self, match_ids):
+        """
+        Returns full match records for many matches, in the order of match_ids
+        """
+
+        found = {x['_id']:x for x in self.matches.find({'_id':{'$in':list(match_ids)}}, {'last_updated':0})}
+
+        return [found[x] for x in match_ids if x in found]
+
     def get_match(self, match_id):
         """
         Returns a full match record
@@ -170,37 +534,87 @@ class ProcessingDB:
             l.debug(f"{match_id} not found.")
             return None
 
-    def get_all_processed_matches(self):
+    def get_all_processed_matches(self, filter={}):
         """
         Retrieves all matches that have been processed
         """
 
-        return list(self.processed_matches.find())
+        return list(self.processed_matches.find(filter))
 
-    def get_all_processed_match_players(self, filter):
+    def get_all_processed_match_players(self, filter, projection=None):
         """
         Retrieves all matches that have been processed
         """
 
-        return list(self.processed_match_players.find(filter))
+        return list(self.processed_match_players.find(filter, projection))
+
+    def iter_processed_match_players(self, filter, projection=None, chunk_size=50000):
+        """
+        Yields processed match players in lists of chunk_size, so callers never hold the whole cursor
+        """
+
+        chunk = []
+        for player in self.processed_match_players.find(filter, projection).batch_size(min(chunk_size, 10000)):
+            chunk.append(player)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
 
-    def get_recent_player_sample(self, recency_window=5, n=100):
+        if len(chunk) > 0:
+            yield chunk
+
+    def get_recent_player_sample(self, recency_window=5, n=100, exclude=None):
         """
-        Returns a sample of players from recent matches (within window days)
+        Returns a sample of players from recent matches (within window days), without replacement.
+        Players in exclude (e.g. recently crawled) are never picked. Sampling happens server side so only
+        the sample comes back.
         """
-        q = {"match_start_time":{"$gte":datetime.now() - timedelta(days=recency_window)}}
 
-        players = np.unique([x['player_id'] for x in self.processed_match_players.find(q, {'player_id':1})])
-        return list(np.random.choice(players, n))
+        if n <= 0:
+            return []
+
+        start = datetime.combine(date.today() - timedelta(days=recency_window), datetime.min.time())
+        pipeline = [{'$match':{'day':{'$gte':start}}},
+                    {'$project':{'players':1}},
+                    {'$unwind':'$players'},
+                    {'$group':{'_id':'$players'}}]
+        if exclude:
+            pipeline.append({'$match':{'_id':{'$nin':list(exclude)}}})
+        pipeline.append({'$sample':{'size':n}})
+
+        return [x['_id'] for x in self.player_activity.aggregate(pipeline, allowDiskUse=True)]
 
 class AnalyticsDB:
     """
     SQLite DB for Reporting.
     """
 
-    def __init__(self):
+    # Relative metrics, map mode normalized and percentiled variables
+    NORM_VARS = ['score_per_min', 'kills_per_min', 'kills_per_death']
+    PCT_VARS = ['score_per_min', 'kills_per_min', 'kills_per_death', 'AER', 'bf4_match_skill']
+
+    # Benchmarks, TOP_ quantiles of each var over a rolling window of days
+    BENCH_QUANTILES = [.5, .75, .1, .05, .01]
+    BENCH_VARS = ['score_per_min', 'kills_per_min', 'kills_per_death', 'AER', 'mm_adj_score_per_min', 'mm_adj_kills_per_min', 'mm_adj_kills_per_death', 'aggression_rating', 'efficiency_rating']
+    BENCH_WINDOW = 120
+
+    # Explicit schema for the match player fact, anything else is inferred
+    FACT_CATEGORIES = ['match_id', 'player_id', 'map', 'mode', 'team', 'team_status', 'team_orientation', 'game_duration_m']
+    FACT_INTS = ['kills', 'deaths', 'solider_damages', 'headshots', 'kill_assists', 'avenger_kills', 'savior_kills', 'shots_taken',
+                 'shots_hit', 'dogtags_taken', 'highest_killstreak', 'highest_multikill', 'heals', 'revives', 'revives_recieved',
+                 'resupplies', 'repairs', 'squad_spawns', 'squad_wipes', 'orders_completed', 'score', 'longest_headshot',
+                 'true_deaths', 'overall_rank', 'team_rank']
+    FACT_FLOATS = ['kills_per_death', 'kills_per_min', 'shot_accuracy', 'score_per_min', 'true_kills_per_death', 'player_time',
+                   'aggression_rating', 'efficiency_rating', 'AER', 'duration_m', 'adj_spm', 'adj_kpm']
+
+    # String keys stored dictionary encoded in parquet
+    PARQUET_CATEGORIES = ['match_id', 'player_id', 'map', 'mode', 'team', 'team_status', 'match_team_id', 'match_team_status_id']
+
+    def __init__(self, parquet=True, benchmark_map_modes=False):
 
         self.out_dir = 'D:/Documents/Battlefield Analytics/BFV/data/bfv_analytics.db'
+        self.parquet_dir = 'D:/Documents/Battlefield Analytics/BFV/data/parquet/'
+        self.parquet = parquet # Also write the columnar copy
         self.processing_db = ProcessingDB()
 
         self.fact_match_players = pd.DataFrame()
@@ -210,13 +624,26 @@ class AnalyticsDB:
         self.dim_match_team_status = pd.DataFrame()
         self.dim_player = pd.DataFrame()
         self.dim_benchmarks = pd.DataFrame()
+        self.norm_stats = GroupStats() # Map mode stats behind the mm_adj_ columns
+        self.bench_sketches = {} # (day, var, map_mode) -> QuantileSketch, map_mode '' is every map mode
+        self.benchmark_map_modes = benchmark_map_modes # Also benchmark each map mode
 
-    def reload(self):
+    def reload(self, incremental=False):
         """
         Orchestrate a full recreation of the star schema.
 
-        Function maps table names to functions to generate them and executes them in a row
+        Function maps table names to functions to generate them and executes them in a row.
+        If incremental, only match players updated since the last run are pulled (see refresh).
         """
+
+        started = datetime.now()
+        con = db.connect(self.out_dir)
+
+        if incremental:
+            watermark = self.get_watermark(con)
+            if watermark is not None:
+                return self.refresh(con, watermark, started)
+            l.debug('No Watermark Found, Running Full Reload.')
         
         # Create Initial Fact Table
         l.debug('Fact Match Players')
@@ -238,6 +665,170 @@ class AnalyticsDB:
         # Write
         l.debug('Writing out to DB')
         self.save_tables()
+        self.save_norm_stats(con)
+        self.save_sketches(con)
+        if self.parquet:
+            l.debug('Writing out to Parquet')
+            self.save_parquet()
+        self.set_watermark(con, started)
+
+    def refresh(self, con, watermark, started):
+        """
+        Incremental reload. New and updated match players replace their fact rows, and only the
+        players and matches they touch get their dimension rows recomputed.
+
+        Relative metrics (mm_adj_*, *_pctl) of the new rows are computed against the whole table, using
+        running map mode stats for normalization. Rows already stored keep theirs until the next full reload.
+        """
+
+        l.debug(f'Sourcing Match Players Updated Since {watermark}')
+        new = self.load_match_players({'last_updated':{'$gte':watermark}})
+        if len(new) == 0:
+            l.debug('Nothing New.')
+            self.set_watermark(con, started)
+            return None
+
+        new = self.build_fact_columns(new)
+        self.stage_ids(con, new['match_player_id'])
+
+        # New columns can't be appended and stats may predate the table, fall back to a rebuild
+        stored_columns = pd.read_sql('SELECT * FROM fact_match_players LIMIT 0', con).columns
+        self.norm_stats = self.load_norm_stats(con)
+        if len(set(new.columns) - set(stored_columns) - set(self.relative_columns())) > 0 or self.norm_stats is None:
+            l.debug('Fact Schema or Stats Changed, Running Full Reload.')
+            return self.reload()
+
+        l.debug('Relative Metrics')
+        replaced = pd.read_sql(f"SELECT map_mode, team_status, {', '.join(self.NORM_VARS)} FROM fact_match_players WHERE match_player_id IN (SELECT id FROM refresh_ids)", con)
+        self.norm_stats.remove(self.summarize_norm_vars(replaced))
+        self.norm_stats.add(self.summarize_norm_vars(new))
+
+        stored = pd.read_sql(f"SELECT {', '.join(self.PCT_VARS)} FROM fact_match_players WHERE match_player_id NOT IN (SELECT id FROM refresh_ids)", con)
+        new = self.add_relative_metrics(new, self.norm_stats, pd.concat([stored, new[self.PCT_VARS]], ignore_index=True))
+
+        l.debug(f'Replacing {len(new)} Fact Rows')
+        new = new.reindex(columns=stored_columns)
+        plain_columns = [c for c in stored_columns if c not in self.relative_columns() and new[c].dtype != 'category']
+        new[plain_columns] = new[plain_columns].fillna(0)
+        con.execute('DELETE FROM fact_match_players WHERE match_player_id IN (SELECT id FROM refresh_ids)')
+        con.commit()
+        new.to_sql('fact_match_players', con, if_exists='append', index=False)
+        self.save_norm_stats(con)
+        self.fact_match_players = new
+
+        # Dimensions, recomputed for the touched keys only
+        l.debug('Dim Player')
+        self.stage_ids(con, new['player_id'].unique())
+        self.gen_dim_player(pd.read_sql('SELECT player_id, match_id, kills, score FROM fact_match_players WHERE player_id IN (SELECT id FROM refresh_ids)', con))
+        self.replace_rows(con, 'dim_player', 'player_id', self.dim_player)
+
+        l.debug('Dim Match')
+        self.stage_ids(con, new['match_id'].unique())
+        match_ids = list(new['match_id'].unique())
+        self.gen_dim_match(pd.read_sql('SELECT * FROM fact_match_players WHERE match_id IN (SELECT id FROM refresh_ids)', con), {'_id':{'$in':match_ids}})
+        self.replace_rows(con, 'dim_match', '_id', self.dim_match)
+
+        # Only the days new rows landed on get their sketches rebuilt, the rest of the window is reused
+        l.debug('Dim Benchmarks')
+        days = pd.to_datetime(new['match_start_time']).dt.strftime('%Y-%m-%d').unique()
+        self.stage_ids(con, days)
+        day_rows = pd.read_sql(f"SELECT match_start_time, map_mode, team_status, {', '.join(self.BENCH_VARS)} FROM fact_match_players WHERE substr(match_start_time, 1, 10) IN (SELECT id FROM refresh_ids)",
+                               con, parse_dates=['match_start_time'])
+        self.bench_sketches = {key:sketch for key, sketch in self.load_sketches(con).items() if key[0] not in days}
+        self.bench_sketches.update(self.build_sketches(day_rows))
+        self.dim_benchmarks = self.benchmarks_from_sketches(self.bench_sketches)
+        self.dim_benchmarks.to_sql('dim_benchmarks', con, if_exists='replace', index=False)
+        self.save_sketches(con)
+
+        if self.parquet:
+            l.debug('Rewriting Touched Parquet Partitions')
+            partitions = new[['map_mode', 'match_start_time']].assign(match_month=pd.to_datetime(new['match_start_time']).dt.strftime('%Y-%m'))
+            touched = pd.concat([pd.read_sql('SELECT * FROM fact_match_players WHERE map_mode = ? AND substr(match_start_time, 1, 7) = ?', con, params=[map_mode, month])
+                                 for map_mode, month in partitions[['map_mode', 'match_month']].drop_duplicates().itertuples(index=False)], ignore_index=True)
+            self.write_fact_parquet(touched)
+            self.write_dim_parquet({table:pd.read_sql(f'SELECT * FROM {table}', con) for table in ['dim_match', 'dim_player', 'dim_benchmarks']})
+
+        self.set_watermark(con, started)
+
+    def get_watermark(self, con):
+        """
+        When the last reload started, None if there hasn't been one
+        """
+
+        try:
+            row = con.execute("SELECT value FROM refresh_state WHERE key = 'watermark'").fetchone()
+        except db.OperationalError:
+            return None
+
+        return None if row is None else datetime.fromisoformat(row[0])
+
+    def set_watermark(self, con, watermark):
+        """
+        Records when a reload started, the next incremental reload picks up from there
+        """
+
+        con.execute('CREATE TABLE IF NOT EXISTS refresh_state (key TEXT PRIMARY KEY, value TEXT)')
+        con.execute("INSERT OR REPLACE INTO refresh_state VALUES ('watermark', ?)", (watermark.isoformat(),))
+        con.commit()
+
+    def load_norm_stats(self, con):
+        """
+        Map mode stats saved by the last reload, None if there aren't any
+        """
+
+        try:
+            return GroupStats(pd.read_sql('SELECT * FROM norm_stats', con).set_index(['group', 'var']))
+        except Exception:
+            return None
+
+    def save_norm_stats(self, con):
+        """
+        Keeps the map mode stats for the next incremental reload
+        """
+
+        self.norm_stats.table.reset_index().to_sql('norm_stats', con, if_exists='replace', index=False)
+
+    def load_sketches(self, con):
+        """
+        Benchmark sketches saved by the last reload, days that left the window are dropped
+        """
+
+        try:
+            rows = con.execute('SELECT day, var, map_mode, sketch FROM benchmark_sketches WHERE day >= ?', (self.window_start(),)).fetchall()
+        except db.OperationalError:
+            return {}
+
+        return {(day, var, map_mode):QuantileSketch.from_bytes(sketch) for day, var, map_mode, sketch in rows}
+
+    def save_sketches(self, con):
+        """
+        Keeps the benchmark sketches for the next incremental reload
+        """
+
+        con.execute('DROP TABLE IF EXISTS benchmark_sketches')
+        con.execute('CREATE TABLE benchmark_sketches (day TEXT, var TEXT, map_mode TEXT, sketch BLOB, PRIMARY KEY (day, var, map_mode))')
+        con.executemany('INSERT INTO benchmark_sketches VALUES (?, ?, ?, ?)',
+                        [(day, var, map_mode, sketch.to_bytes()) for (day, var, map_mode), sketch in self.bench_sketches.items()])
+        con.commit()
+
+    def stage_ids(self, con, ids):
+        """
+        Loads ids into a temp table for IN (SELECT id FROM refresh_ids) filters
+        """
+
+        con.execute('CREATE TEMP TABLE IF NOT EXISTS refresh_ids (id TEXT PRIMARY KEY)')
+        con.execute('DELETE FROM refresh_ids')
+        con.executemany('INSERT OR IGNORE INTO refresh_ids VALUES (?)', [(x,) for x in ids])
+
+    def replace_rows(self, con, table, key, df):
+        """
+        Upserts dimension rows by key
+        """
+
+        self.stage_ids(con, df[key])
+        con.execute(f'DELETE FROM {table} WHERE {key} IN (SELECT id FROM refresh_ids)')
+        con.commit()
+        df.to_sql(table, con, if_exists='append', index=False)
 
     def save_tables(self):
         """
@@ -250,6 +841,64 @@ class AnalyticsDB:
         self.dim_player.to_sql('dim_player', con, if_exists='replace', index=False)
         self.dim_benchmarks.to_sql('dim_benchmarks', con, if_exists='replace', index=False)
 
+    def save_parquet(self):
+        """
+        Writes a columnar copy of the tables. Facts are partitioned by map_mode and match month
+        so readers can prune partitions and push filters down (see read_fact_parquet).
+        """
+
+        shutil.rmtree(self.parquet_dir+'fact_match_players', ignore_errors=True)
+        self.write_fact_parquet(self.fact_match_players)
+        self.write_dim_parquet({'dim_match':self.dim_match, 'dim_player':self.dim_player, 'dim_benchmarks':self.dim_benchmarks})
+
+    def write_fact_parquet(self, fact):
+        """
+        Writes fact rows, replacing whichever partitions they fall in. Rows read back out of SQLite
+        are cast to the fact schema first, so rewritten partitions match the rest of the dataset.
+        """
+
+        fact = fact.assign(match_start_time=pd.to_datetime(fact['match_start_time'], errors='coerce'))
+        fact['match_month'] = fact['match_start_time'].dt.strftime('%Y-%m')
+        for col in self.PARQUET_CATEGORIES:
+            if col in fact.columns:
+                fact[col] = fact[col].astype('category')
+
+        fact.to_parquet(self.parquet_dir+'fact_match_players', engine='pyarrow', index=False, partition_cols=['map_mode', 'match_month'],
+                        schema=self.fact_parquet_schema(fact), existing_data_behavior='delete_matching', use_dictionary=True, compression='snappy')
+
+    def fact_parquet_schema(self, fact):
+        """
+        Arrow schema for fact rows. Columns already in the written dataset keep its types, the rest are
+        inferred, with dictionary indices fixed at int32 so they don't vary with the number of categories.
+        """
+
+        schema = pa.schema([pa.field(f.name, pa.dictionary(pa.int32(), f.type.value_type)) if pa.types.is_dictionary(f.type) else f
+                            for f in pa.Schema.from_pandas(fact, preserve_index=False)])
+
+        try:
+            stored = ds.dataset(self.parquet_dir+'fact_match_players', format='parquet').schema
+        except FileNotFoundError:
+            return schema
+
+        return pa.schema([stored.field(f.name) if f.name in stored.names else f for f in schema])
+
+    def write_dim_parquet(self, dims):
+        """
+        Writes each dimension as a single file
+        """
+
+        os.makedirs(self.parquet_dir, exist_ok=True)
+        for table, df in dims.items():
+            df.to_parquet(self.parquet_dir+table+'.parquet', engine='pyarrow', index=False)
+
+    def read_fact_parquet(self, columns=None, filters=None):
+        """
+        Reads the parquet facts. filters like [('map_mode', '==', 'Arras_Breakthrough'), ('match_month', '>=', '2021-06')]
+        prune partitions before anything is loaded, the rest is read memory mapped.
+        """
+
+        return pd.read_parquet(self.parquet_dir+'fact_match_players', engine='pyarrow', columns=columns, filters=filters, memory_map=True)
+
     # Fact tables
     def gen_fact_match_players(self):
         """
@@ -257,16 +906,86 @@ class AnalyticsDB:
         """
 
         l.debug("Sourcing")
-        df = pd.DataFrame(self.processing_db.get_all_processed_match_players({})).fillna(0)
+        df = self.load_match_players({})
+
+        df = self.build_fact_columns(df)
+        df = self.add_relative_metrics(df)
+
+        l.debug("Done.")        
+        self.fact_match_players = df
+
+    def load_match_players(self, filter, chunk_size=50000):
+        """
+        Streams processed match players out of Mongo, typing each chunk as it arrives so raw documents
+        never pile up. Missing values are zero filled as before, categorical keys are left missing.
+        """
+
+        chunks = []
+        for docs in self.processing_db.iter_processed_match_players(filter, {'last_updated':0}, chunk_size):
+            chunks.append(self.type_chunk(pd.DataFrame(docs)))
+            l.debug(f"Loaded {sum(len(c) for c in chunks)} Match Players")
+
+        if len(chunks) == 0:
+            return pd.DataFrame()
+
+        # Share categories across chunks so the concat stays categorical
+        for col in [c for c in self.FACT_CATEGORIES if any(c in chunk for chunk in chunks)]:
+            categories = reduce(lambda a, b: a.union(b), [c[col].cat.categories for c in chunks if col in c], pd.Index([]))
+            for i, chunk in enumerate(chunks):
+                chunks[i][col] = chunk[col].cat.set_categories(categories) if col in chunk else pd.Categorical([None]*len(chunk), categories=categories)
+
+        df = pd.concat(chunks, ignore_index=True)
+        del chunks
+
+        # Zero fill, then settle the numeric types
+        plain = [c for c in df.columns if c not in self.FACT_CATEGORIES]
+        df[plain] = df[plain].fillna(0)
+        for col in self.FACT_INTS:
+            if col in df:
+                df[col] = df[col].astype('int64')
+        for col in self.FACT_FLOATS:
+            if col in df:
+                df[col] = df[col].astype('float64')
+
+        return df
+
+    def type_chunk(self, df):
+        """
+        Applies the categorical part of the fact schema to a chunk
+        """
+
+        for col in self.FACT_CATEGORIES:
+            if col in df:
+                df[col] = df[col].astype('category')
+        if 'match_start_time' in df:
+            df['match_start_time'] = pd.to_datetime(df['match_start_time'])
+
+        return df
+
+    def combine_keys(self, *cols):
+        """
+        Categorical of the cols joined with '_'. Rows are integer coded and the strings are
+        only built once per distinct combination rather than once per row.
+        """
+
+        codes, uniques = pd.MultiIndex.from_arrays(cols).factorize()
+        labels = ['_'.join(str(x) for x in combination) for combination in uniques]
+
+        return pd.Categorical.from_codes(codes, labels)
+
+    def build_fact_columns(self, df):
+        """
+        Keys and per row metrics, these only depend on the row itself
+        """
         
         # Keys
         l.debug("Key Creation")
         df.rename(columns={'_id':'match_player_id'}, inplace=True) # Primary Key
         df['match_id'] = df['match_id'] # dim_match
         df['player_id'] = df['player_id'] # dim_player
-        df['match_team_id'] = df['match_id'] + '_' + df['team'] # dim_match_team
-        df['match_team_status_id'] = df['match_id'] + '_' + df['team_status'] # dim_match_team_status
-        df['map_mode'] = df['map']+'_'+df['mode'] # dim_map_mode
+        df['match_team_id'] = self.combine_keys(df['match_id'], df['team']) # dim_match_team
+        df['match_team_status_id'] = self.combine_keys(df['match_id'], df['team_status']) # dim_match_team_status
+        df['map_mode'] = self.combine_keys(df['map'], df['mode']) # dim_map_mode
 
         # Calculated Metrics - Foundational
         l.debug("Simple Calcs")
@@ -281,33 +1000,57 @@ class AnalyticsDB:
         df['bf4_match_skill_adj'] = 1000*((.6*(df['score_per_min'].clip(0, 1000)/1000)) + (.3*(df['kills_per_min'].clip(0, 3)/3)) + (.1*(df['true_kills_per_death'].clip(0, 5)/5)))
         df['inactive_squad'] = df['orders_completed'].clip(0, 1)
 
+        return df
+
+    def relative_columns(self):
+        """
+        Columns add_relative_metrics creates
+        """
+
+        return ['mm_adj_'+var for var in self.NORM_VARS] + [var+'_pctl' for var in self.PCT_VARS]
+
+    def summarize_norm_vars(self, df):
+        """
+        Map mode stats for the rows of df that count towards normalization (not dnf)
+        """
+
+        return GroupStats.from_frame(df[(df.team_status != 'dnf').to_numpy()], 'map_mode', self.NORM_VARS)
 
-        # Normalize
+    def add_relative_metrics(self, df, stats=None, population=None):
+        """
+        Metrics that depend on every row, map mode normalization and percentiles.
+        Normalization uses stats (map mode GroupStats) and percentile edges come from population,
+        both default to df itself.
+        """
+
+        # Normalize, each row is z scored within its map mode and rescaled to the overall distribution
         l.debug("Map Mode Normalization")
-        norm_vars = ['score_per_min', 'kills_per_min', 'kills_per_death']
-        norm = df[df.team_status != 'dnf'][norm_vars+['map_mode']].groupby('map_mode').transform(lambda x: (x - x.mean()) / x.std())
+        active = (df.team_status != 'dnf').to_numpy()
+        if stats is None:
+            stats = self.norm_stats = self.summarize_norm_vars(df)
 
-        for var in norm_vars:
-            df.loc[df[df.team_status != 'dnf'].index, 'mm_adj_'+var] = (norm[var]*df[df.team_status != 'dnf'][var].std()) + df[df.team_status != 'dnf'][var].mean()
+        for var in self.NORM_VARS:
+            modes = df.loc[active, 'map_mode']
+            z = (df.loc[active, var].to_numpy() - lookup(modes, stats.mean(var))) / lookup(modes, stats.std(var))
+            df.loc[active, 'mm_adj_'+var] = (z*stats.std(var)[ALL]) + stats.mean(var)[ALL]
 
         # Quantiles
         l.debug("Computing Percentiles")
-        pct_vars = norm_vars = ['score_per_min', 'kills_per_min', 'kills_per_death', 'AER', 'bf4_match_skill']
-        for var in pct_vars:
-            df[var+'_pctl'] = pd.qcut(df[var], 100, duplicates='drop', labels=False)
+        for var in self.PCT_VARS:
+            df[var+'_pctl'] = percentile_bins(df[var], None if population is None else population[var])
 
-        l.debug("Done.")        
-        self.fact_match_players = df
+        return df
 
-    def gen_dim_player(self):
+    def gen_dim_player(self, fact=None):
         """
         Generates the player dimension
         """
 
+        fact = self.fact_match_players if fact is None else fact
         agg_dict = {'matches_played':pd.NamedAgg(column='match_id', aggfunc='count'),
                     'total_kills':pd.NamedAgg(column='kills', aggfunc='sum'),
                     'total_score':pd.NamedAgg(column='score', aggfunc='sum')}
-        df = self.fact_match_players.groupby('player_id', as_index=False).agg(**agg_dict)
+        df = fact.groupby('player_id', as_index=False, observed=True).agg(**agg_dict)
 
         df['squad'] = 'unknown'
         df.loc[df[df.player_id.isin(['psn_GotYourBach', 'psn_SloshySole', 'psn_MissNemisis', 'psn_mypremeclean', 'psn_drumcon11'])].index, 'squad'] = 'GUMI'
@@ -316,30 +1059,72 @@ class AnalyticsDB:
 
         self.dim_player = df
 
-    def gen_dim_match(self):
+    def gen_dim_match(self, fact=None, match_filter={}):
         """
         Creates a dimenion for the match
         """
 
-        df = pd.DataFrame(self.processing_db.get_all_processed_matches())
+        fact = self.fact_match_players if fact is None else fact
+        df = pd.DataFrame(self.processing_db.get_all_processed_matches(match_filter))
         agg_dict = {'inactive_squads':pd.NamedAgg(column='inactive_squad_players', aggfunc=lambda x: sum(x))}
 
-        computed = self.fact_match_players.groupby('match_id').agg(**agg_dict)
+        computed = fact.groupby('match_id', observed=True).agg(**agg_dict)
 
         self.dim_match = df.merge(computed, on=df['_id']==computed['match_id'], how='inner').drop_duplicates('_id')
 
-    def gen_dim_benchmarks(self):
+    def gen_dim_benchmarks(self, fact=None):
         """
         Wide table of benchmarks
         """
 
-        quantiles = [.5, .75, .1, .05, .01]
-        bench_vars = ['score_per_min', 'kills_per_min', 'kills_per_death', 'AER', 'mm_adj_score_per_min', 'mm_adj_kills_per_min', 'mm_adj_kills_per_death', 'aggression_rating', 'efficiency_rating']
-        df = pd.DataFrame(index=[0], columns=['TOP_'+str(q)[1:]+'_'+v for q in quantiles for v in bench_vars])
-        filter_criteria = (self.fact_match_players.team_status != 'dnf')&(self.fact_match_players.match_start_time > datetime.now() - pd.to_timedelta("120day"))
+        fact = self.fact_match_players if fact is None else fact
+        self.bench_sketches = self.build_sketches(fact)
+        self.dim_benchmarks = self.benchmarks_from_sketches(self.bench_sketches)
+
+    def window_start(self):
+        """
+        First day inside the benchmark window
+        """
+
+        return (datetime.now() - timedelta(days=self.BENCH_WINDOW)).strftime('%Y-%m-%d')
+
+    def build_sketches(self, fact):
+        """
+        Daily quantile sketches of each benchmark var for the finished (not dnf) rows of fact inside the window
+        """
+
+        rows = fact[(fact.team_status != 'dnf')&(fact.match_start_time >= self.window_start())]
+        day = rows['match_start_time'].dt.strftime('%Y-%m-%d')
+
+        sketches = {}
+        for day_key, group in rows.groupby(day):
+            for v in self.BENCH_VARS:
+                sketches[(day_key, v, '')] = QuantileSketch().update(group[v])
+
+        if self.benchmark_map_modes:
+            for (day_key, map_mode), group in rows.groupby([day, rows['map_mode'].astype(str)]):
+                for v in self.BENCH_VARS:
+                    sketches[(day_key, v, map_mode)] = QuantileSketch().update(group[v])
+
+        return sketches
+
+    def benchmarks_from_sketches(self, sketches):
+        """
+        Merges the daily sketches across the window into the wide benchmark table.
+        One row, or one per map mode plus 'all' if benchmark_map_modes.
+        """
+
+        # Merging is order sensitive, go day by day so a refresh merges the same way a full reload does
+        merged = {}
+        for (day, v, map_mode), sketch in sorted(sketches.items(), key=lambda x: x[0]):
+            if day >= self.window_start():
+                merged.setdefault((map_mode, v), QuantileSketch()).merge(sketch)
+
+        map_modes = sorted({map_mode for map_mode, v in merged.keys()}) if self.benchmark_map_modes else ['']
+        df = pd.DataFrame({'TOP_'+str(q)[1:]+'_'+v:[merged[(m, v)].quantile(1-q) if (m, v) in merged else np.nan for m in map_modes]
+                           for q in self.BENCH_QUANTILES for v in self.BENCH_VARS})
 
-        for v in bench_vars:
-            for q in quantiles:
-                df['TOP_'+str(q)[1:]+'_'+v] = self.fact_match_players[filter_criteria][v].quantile(1-q)
+        if self.benchmark_map_modes:
+            df.insert(0, 'map_mode', [m if m != '' else 'all' for m in map_modes])
 
-        self.dim_benchmarks = df
\ No newline at end of file
+        return df
@@ -0,0 +1,69 @@
+# Crawl frontier, decides which players get their game reports crawled next
+
+import logging
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+
+l = logging.getLogger('bfv_ingestor')
+
+from db import BulkWriter
+
+class CrawlFrontier:
+    """
+    Priority queue of players kept on the ingestion players collection.
+    Each crawl updates the player's match rate (an EWMA of new matches per day) and schedules
+    the next crawl for when about target_yield new matches should have piled up.
+    Players come off the frontier most overdue first.
+    """
+
+    def __init__(self, db, target_yield=10, alpha=.3, prior_rate=1, min_interval=1, max_interval=60, first_span=14):
+
+        self.db = db # IngestionDB
+        self.players = db.players
+        self.target_yield = target_yield # new matches wanted per crawl
+        self.alpha = alpha # weight of the latest crawl in the rate
+        self.prior_rate = prior_rate # matches/day assumed before a player's first crawl
+        self.min_interval = min_interval # days between crawls, bounds
+        self.max_interval = max_interval
+        self.first_span = first_span # days a first crawl is assumed to cover
+
+    def next(self, n=100, exclude=None):
+        """
+        Up to n players that are due, most overdue first. Players that were never scheduled count as due.
+        """
+
+        if n <= 0:
+            return []
+
+        q = self.db.due_filter(datetime.now())
+        if exclude:
+            q['_id'] = {'$nin':list(exclude)}
+
+        return [x['_id'] for x in self.players.find(q, {'_id':1}).sort('crawl_due', 1).limit(n)]
+
+    def record(self, results):
+        """
+        Updates the schedule from a crawl, results is {player: new matches found}
+        """
+
+        now = datetime.now()
+        known = {x['_id']:x for x in self.players.find({'_id':{'$in':list(results)}}, {'rate':1, 'last_crawled':1, 'first_seen':1})}
+
+        with BulkWriter(self.players, self.db.batch_size) as writer:
+            for player, new_matches in results.items():
+                doc = known.get(player, {})
+
+                # Days the crawl covered, a first crawl sees a player's backlog so spread it over first_span
+                if 'last_crawled' in doc:
+                    span = max((now - doc['last_crawled']).total_seconds()/86400, self.min_interval)
+                    rate = (self.alpha*new_matches/span) + ((1-self.alpha)*doc.get('rate', self.prior_rate))
+                else:
+                    rate = (self.alpha*new_matches/self.first_span) + ((1-self.alpha)*self.prior_rate)
+
+                interval = min(max(self.target_yield/rate if rate > 0 else self.max_interval, self.min_interval), self.max_interval)
+                writer.add(UpdateOne({'_id':player},
+                                     {'$set':{'last_crawled':now, 'last_yield':new_matches, 'rate':rate,
+                                              'crawl_due':now + timedelta(days=interval)}},
+                                     upsert=True))
+
+        l.debug(f'Frontier: rescheduled {len(results)} players, {sum(results.values())} new matches.')
@@ -1,7 +1,17 @@
 # Functions that need to be shared
 
+import csv
+import os
+import re
+import sys
+import threading
+from types import MappingProxyType
+import numpy as np
+import pandas as pd
+
 BFV_BASE_URL = 'https://battlefieldtracker.com/bfv/'
 BF2042_BASE_URL = 'https://battlefieldtracker.com/bf2042/'
+BREAKTHROUGH_REF_PATH = 'D:/Documents/Battlefield Analytics/BFV/data/manual/breakthrough_ref.csv'
 
 def gen_player_url_from_id(player_id, how='bfv', reports_page=True):
     """
@@ -62,6 +72,10 @@ def gen_match_id_from_url(url, how='bfv'):
 
     return url.split('/gamereport/')[1].split('?')[0].replace('/', '_')
 
+# Tracker formatted values, "1,234", "12.5", "45.2%", "1.2k" (thousands), "23m 14s"/"1h 3m" (durations), "120m" (distances).
+# Each has a scalar parser and a column version that gives the same values in one vectorized pass.
+DURATION_PATTERN = r'^(\d+)([hm]) (\d+)[ms]'
+
 def stat_parse(number):
     """
     Function to handle different number formats
@@ -70,7 +84,9 @@ def stat_parse(number):
     # Character Removal
     clean = number.replace(',', '')
 
-    if '%' not in clean:
+    if clean.endswith('k'):
+        clean = int(round(float(clean[:-1])*1000))
+    elif '%' not in clean:
         if '.' in clean:
             clean = float(clean)
         else:
@@ -79,4 +95,112 @@ def stat_parse(number):
         clean = clean.replace('%', '')
         clean = float(clean)/100
 
-    return clean
\ No newline at end of file
+    return clean
+
+def stat_parse_column(numbers):
+    """
+    stat_parse over a whole column, returns the values as floats and a mask of the ones stat_parse makes ints
+    """
+
+    # Arrow backed strings keep the string work out of python
+    clean = pd.Series(np.asarray(numbers, dtype=object), dtype='string[pyarrow]').str.replace(',', '', regex=False)
+    thousands = clean.str.endswith('k').to_numpy(bool)
+    percent = ~thousands & clean.str.contains('%', regex=False).to_numpy(bool)
+    is_int = thousands | (~percent & ~clean.str.contains('.', regex=False).to_numpy(bool))
+
+    values = clean.str.replace('[%k]', '', regex=True).astype('float64').to_numpy(float, copy=True)
+    values[percent] = values[percent]/100
+    values[thousands] = np.round(values[thousands]*1000)
+
+    return values, is_int
+
+def distance_parse(distance):
+    """
+    Distances like "120m" or "1.2k" in meters
+    """
+
+    return stat_parse(distance.split('m')[0])
+
+def distance_parse_column(distances):
+    """
+    distance_parse over a whole column, returns (values, is_int) like stat_parse_column
+    """
+
+    return stat_parse_column(pd.Series(np.asarray(distances, dtype=object), dtype='string[pyarrow]').str.split('m').str[0])
+
+def duration_parse(duration):
+    """
+    Durations like "23m 14s" or "1h 3m" in minutes, ints when given in hours. Raises ValueError if it can't be read.
+    """
+
+    found = re.match(DURATION_PATTERN, duration) if isinstance(duration, str) else None
+    if found is None:
+        raise ValueError(f'Unreadable duration: {duration!r}')
+
+    if found.group(2) == 'h':
+        return (int(found.group(1))*60) + int(found.group(3))
+
+    return int(found.group(1)) + int(found.group(3))/60
+
+def duration_parse_column(durations):
+    """
+    duration_parse over a whole column, returns (values, is_int) like stat_parse_column.
+    Raises ValueError if any can't be read.
+    """
+
+    durations = pd.Series(np.asarray(durations, dtype=object), dtype='string[pyarrow]')
+    parts = durations.str.extract(DURATION_PATTERN)
+    unreadable = parts[0].isna().to_numpy(bool)
+    if unreadable.any():
+        raise ValueError(f'Unreadable durations: {list(durations[unreadable].unique()[:10])}')
+    first = parts[0].astype('float64').to_numpy(float)
+    second = parts[2].astype('float64').to_numpy(float)
+    hours = (parts[1] == 'h').fillna(False).to_numpy(bool)
+
+    return np.where(hours, (first*60) + second, first + (second/60)), hours
+
+def native_values(values, is_int):
+    """
+    Object array of python ints (where is_int) and floats, ready for the database
+    """
+
+    out = values.astype(object)
+    out[is_int] = values[is_int].astype(np.int64).astype(object)
+
+    return out
+
+# Reference tables loaded once per process, path -> (mtime, table)
+reference_cache = {}
+reference_lock = threading.Lock()
+
+def get_breakthrough_ref(path=BREAKTHROUGH_REF_PATH):
+    """
+    Breakthrough orientations as a read only {(map, team): orientation}, keys interned.
+    Read once per process and again only when the file changes.
+    """
+
+    mtime = os.stat(path).st_mtime_ns
+    cached = reference_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with reference_lock:
+        with open(path, newline='', encoding='utf-8-sig') as f: # spreadsheet exports start with a BOM
+            table = {(sys.intern(row['map']), sys.intern(row['team'])):sys.intern(row['orientation']) for row in csv.DictReader(f)}
+        reference_cache[path] = (mtime, MappingProxyType(table))
+
+    return reference_cache[path][1]
+
+def orientation_lookup(maps, teams, path=BREAKTHROUGH_REF_PATH):
+    """
+    Orientation of each (map, team), looked up once per distinct pair. Raises KeyError for pairs not in the reference.
+    """
+
+    ref = get_breakthrough_ref(path)
+    codes, pairs = pd.MultiIndex.from_arrays([np.asarray(maps, dtype=object), np.asarray(teams, dtype=object)]).factorize()
+
+    missing = [pair for pair in pairs if pair not in ref]
+    if len(missing) > 0:
+        raise KeyError(f'{missing} not in breakthrough_ref.')
+
+    return np.array([ref[pair] for pair in pairs] + [None], dtype=object)[codes]
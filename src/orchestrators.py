@@ -1,8 +1,13 @@
 from scrapers import *
 from analytics import *
 from db import AnalyticsDB, IngestionDB
+from frontier import CrawlFrontier
+import itertools
 import logging
+import multiprocessing
+import queue
 import sys
+import threading
 
 root = logging.getLogger('bfv_ingestor')
 root.setLevel(logging.DEBUG)
@@ -13,53 +18,246 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 handler.setFormatter(formatter)
 root.addHandler(handler)
 
-def gather_matches(cycles=1, sample_size=1, scrolls=10, specific_players=[]):
+def gather_matches(cycles=1, sample_size=1, scrolls=10, specific_players=[], workers=1, backend='selenium', parse_workers=1, crawl_window=7):
     """
     Samples Users and gets their matches
     """
 
     db = IngestionDB()
     pdb = ProcessingDB()
+    migrate(pdb)
+    check_indexes(db, pdb)
+    frontier = CrawlFrontier(db)
 
     for i in range(cycles):
 
         l.debug(f'Gathering Matches, Cycle {i+1}/{cycles}')
 
-        # Sample Players from database (and add specific if found)
+        # Manually specified players go first on the first cycle
+        specific = []
         if (len(specific_players) > 0)&(i==0):
             l.debug(f'Also Gathering {len(specific_players)} manually specified players.')
-            players = specific_players + pdb.get_recent_player_sample(n=sample_size)
-        else:
-            players = pdb.get_recent_player_sample(n=sample_size, recency_window=365)
+            specific = list(specific_players)
+
+        # Take the most overdue players off the frontier, topping up from recent players
+        # that weren't crawled within crawl_window days if too few are due
+        players = frontier.next(sample_size, exclude=specific)
+        if len(players) < sample_size:
+            exclude = db.get_recently_crawled(crawl_window) | set(players) | set(specific)
+            players = players + pdb.get_recent_player_sample(n=sample_size-len(players), recency_window=365, exclude=exclude)
+        players = specific + players
 
         # Get the players matches as htmls
         if len(players) > 0:
-            MatchRetriever(wait=10, scroll_times=scrolls).get(players)
+            MatchRetriever(wait=10, scroll_times=scrolls, backend=backend).get(players)
 
         # Get Matches
-        MatchSaver(wait=20, mode_filter='Breakthrough').get_all()
+        MatchSaver(wait=20, mode_filter='Breakthrough', workers=workers, backend=backend).get_all()
+
+        # Parse players and full matches out of the unparsed folder in one pass
+        MatchParser(load_dirs=True).parse_all(both=True, workers=parse_workers)
+
+        process_matches(parse_workers=parse_workers)
+
+    return None
+
+def pipeline_matches(cycles=1, sample_size=1, scrolls=10, specific_players=[], workers=1, backend='selenium', parse_workers=1,
+                     crawl_window=7, mode_filter='Breakthrough', queue_size=50):
+    """
+    gather_matches with its stages (retrieve -> save -> parse -> process) running at once on their own threads.
+    Stages hand match ids over bounded queues of queue_size, so a fast stage waits on a full queue
+    instead of running ahead, and throughput is set by the slowest stage.
+    """
+
+    db = IngestionDB()
+    pdb = ProcessingDB()
+    migrate(pdb)
+    check_indexes(db, pdb)
+    frontier = CrawlFrontier(db)
+
+    to_save = queue.Queue(queue_size) # match ids
+    to_parse = queue.Queue(queue_size) # (match id, saved)
+    to_process = queue.Queue(queue_size) # match ids
+
+    saver = MatchSaver(wait=20, mode_filter=mode_filter, workers=workers, backend=backend)
+    parser = MatchParser()
+    processor = MatchPlayerProcessor(process_all=False)
+    pending = parser.archive.ids(parsed=False) # archived on an earlier run, never parsed
+
+    def retrieve():
+
+        # Anything found on an earlier run but never saved goes first
+        queued = saver.parsed_matches | saver.archived_matches
+        for match_id in saver.get_matches_for_retrieval():
+            queued.add(match_id)
+            to_save.put(match_id)
+
+        for i in range(cycles):
+            l.debug(f'Retrieving Matches, Cycle {i+1}/{cycles}')
+
+            specific = list(specific_players) if i == 0 else []
+            players = frontier.next(sample_size, exclude=specific)
+            if len(players) < sample_size:
+                exclude = db.get_recently_crawled(crawl_window) | set(players) | set(specific)
+                players = players + pdb.get_recent_player_sample(n=sample_size-len(players), recency_window=365, exclude=exclude)
+
+            retriever = MatchRetriever(wait=10, scroll_times=scrolls, backend=backend)
+            for player, matches, match_modes in retriever.iter_get(specific + players):
+                for match_id, mode in zip(matches, match_modes):
+                    if match_id not in queued and (mode_filter is None or mode == mode_filter):
+                        queued.add(match_id)
+                        to_save.put(match_id)
+
+    def save():
+
+        pool = [FetchWorker(saver, to_save, to_parse, saver.recycle_after, stream=True) for x in range(workers)]
+        for worker in pool:
+            worker.start()
+        for worker in pool:
+            worker.join()
+
+        # Nobody is left taking match ids, fail so run_stage drains to_save and retrieve can't block on it
+        if all(worker.failed for worker in pool):
+            raise RuntimeError(f'All {len(pool)} fetch workers failed.')
+
+    def parse():
+
+        saved_matches = (match_id for match_id, saved in drain(to_parse) if saved)
+        jobs = ((match_id, False, True) for match_id in itertools.chain(pending, saved_matches))
+
+        if parse_workers > 1:
+            with multiprocessing.Pool(parse_workers, initializer=init_parse_worker, initargs=(parser.engine, parser.archive.root)) as pool:
+                write_parsed(parser, pool.imap(parse_worker, jobs), to_process)
+        else:
+            write_parsed(parser, (read_report(parser, *job) for job in jobs), to_process)
+
+    def process():
+
+        # Whatever piled up while the last batch was processing goes in together
+        for batch in drain_batches(to_process, queue_size):
+            try:
+                processor.process_batch(batch)
+            except Exception as e:
+                l.debug(f'Could not process batch of {len(batch)}: {e!r}, processing one at a time')
+                for match_id in batch:
+                    try:
+                        processor.process_match(match_id)
+                    except Exception as e:
+                        l.debug(f'Could not process {match_id}: {e!r}')
 
-        # Parse out just players from the unparsed folder
-        MatchParser(load_dirs=True).parse_all(full=False)
+        # Catch anything parsed outside of this run
+        processor.get_matches_for_processing()
+        processor.process()
 
-        process_matches()
+    stages = [run_stage('retrieve', retrieve, None, to_save),
+              run_stage('save', save, to_save, to_parse),
+              run_stage('parse', parse, to_parse, to_process),
+              run_stage('process', process, to_process, None)]
+
+    for stage in stages:
+        stage.join()
 
     return None
 
-def process_matches():
+def run_stage(name, target, inbox, outbox):
+    """
+    Runs a pipeline stage on its own thread. Its outbox gets a None once it's done, and if it
+    fails its inbox is drained so the stage before it can't block on a full queue.
+    """
+
+    def run():
+        try:
+            target()
+            l.debug(f'{name} stage finished.')
+        except Exception as e:
+            l.debug(f'{name} stage failed: {e!r}')
+            if inbox is not None:
+                for item in drain(inbox):
+                    pass
+        finally:
+            if outbox is not None:
+                outbox.put(None)
+
+    stage = threading.Thread(target=run, name=name, daemon=True)
+    stage.start()
+
+    return stage
+
+def drain(inbox):
+    """
+    Yields items off a stage queue until the None that closes it
+    """
+
+    while True:
+        item = inbox.get()
+        if item is None:
+            return
+        yield item
+
+def drain_batches(inbox, batch_size):
+    """
+    Yields lists of the items waiting on a stage queue, up to batch_size at a time, until the None that closes it.
+    Only waits when the queue is empty.
+    """
+
+    for item in drain(inbox):
+        batch = [item]
+        while len(batch) < batch_size:
+            try:
+                item = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                yield batch
+                return
+            batch.append(item)
+        yield batch
+
+def write_parsed(parser, results, outbox):
+    """
+    Writes each parsed (match, result, error) as it comes in and passes the match on
+    """
+
+    for match_id, result, error in results:
+        if error is not None:
+            l.debug(f'Could not parse {match_id}: {error}')
+            continue
+
+        parser.write([(match_id, result)], both=True)
+        outbox.put(match_id)
+
+def migrate(pdb):
+    """
+    One time data migrations, each does nothing once it has run
+    """
+
+    pdb.migrate_player_activity()
+
+def check_indexes(*dbs):
+    """
+    Fails before crawling if any hot query would scan a whole collection
+    """
+
+    for database in dbs:
+        database.check_indexes()
+    l.debug('Query plans checked, no collection scans.')
+
+def process_matches(parse_workers=1):
 
     # Parse the matches fully
-    MatchParser(load_dirs=True).parse_all(full=True)
+    MatchParser(load_dirs=True).parse_all(full=True, workers=parse_workers)
 
     # Processing Match Players
     MatchPlayerProcessor(process_all=False).process()
 
-#manual_players = ['psn_GotYourBach']#, 'psn_GotYourBach', 'psn_MissNemisis', 'psn_MyPremeClean', 'psn_Drumcon11']; 
-#gather_matches(cycles=1, specific_players=manual_players, sample_size=0, scrolls=1)
-gather_matches(cycles=1, sample_size=0, scrolls=4)
-#process_matches()
+# Guarded so parse pool processes can import this module without starting a crawl
+if __name__ == '__main__':
+    #manual_players = ['psn_GotYourBach']#, 'psn_GotYourBach', 'psn_MissNemisis', 'psn_MyPremeClean', 'psn_Drumcon11']; 
+    #gather_matches(cycles=1, specific_players=manual_players, sample_size=0, scrolls=1)
+    gather_matches(cycles=1, sample_size=0, scrolls=4)
+    #process_matches()
 
-# DB Stuff
-#AnalyticsProcessor().run()
+    # DB Stuff
+    #AnalyticsProcessor().run()
 
-#AnalyticsDB().reload()
\ No newline at end of file
+    #AnalyticsDB().reload()
\ No newline at end of file
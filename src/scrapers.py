@@ -2,81 +2,244 @@
 
 from re import match
 from pandas.io.parquet import to_parquet
-from selenium import webdriver
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import logging
 import os
 import time
-import shutil
 import random
+import queue
+import threading
+import multiprocessing
+from urllib.parse import urlparse
 
 l = logging.getLogger('bfv_ingestor')
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as ec
-from selenium.webdriver.support.wait import WebDriverWait
-
+from archive import ARCHIVE_DIR, ReportArchive
+from backends import get_backend
 from db import IngestionDB, ProcessingDB
+from frontier import CrawlFrontier
 from helpers import *
 from tqdm import tqdm
 
-gecko_driver_path = os.getenv('gecko_driver_path')
+# Parser engines, name -> (BeautifulSoup tree builder, whether to only build the needed containers)
+PARSER_ENGINES = {'bs4':('html.parser', False),
+                  'lxml':('lxml', True)}
+
+# The only containers each page type is read from
+REPORT_CONTAINERS = ["report-info-container card header-bordered responsive", "team card bordered header-bordered responsive"]
+PLAYER_REPORTS_CONTAINERS = ["entry card bordered header-bordered responsive"]
+
+# Report entries read in the browser, so scrolling doesn't need the whole page re-parsed
+ENTRY_SELECTOR = 'div[class="entry card bordered header-bordered responsive"]'
+COUNT_ENTRIES_SCRIPT = f"return document.querySelectorAll('{ENTRY_SELECTOR}').length;"
+READ_ENTRIES_SCRIPT = (f"return Array.from(document.querySelectorAll('{ENTRY_SELECTOR}')).slice(arguments[0])"
+                       ".map(e => [e.querySelector('a').getAttribute('href'), e.querySelector('span.name').textContent]);")
+
+def make_soup(markup, engine='lxml', containers=None):
+    """
+    Builds a soup with the given engine. Partial engines skip everything outside of containers.
+    """
+
+    if engine not in PARSER_ENGINES:
+        raise ValueError(f"{engine} not a supported parser engine.")
+
+    builder, partial = PARSER_ENGINES[engine]
+    parse_only = SoupStrainer('div', {'class':containers}) if (partial and containers is not None) else None
+
+    return BeautifulSoup(markup, builder, parse_only=parse_only)
+
+class HostLimiter:
+    """
+    Politeness limiter shared by fetch workers, spaces requests to the same host by at least min_interval seconds.
+    """
+
+    def __init__(self, min_interval=1):
+
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_slot = {} # host -> earliest time the next request may go out
+
+    def wait(self, url):
+        """
+        Blocks until the host of url may be requested again
+        """
+
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_interval
+
+        time.sleep(slot - now)
+
+class FetchWorker(threading.Thread):
+    """
+    Owns a single fetch backend (browser or http) and pulls match ids off a shared queue until it is empty.
+    When streaming, it waits on the queue instead and stops at a None, which is put back for the other workers.
+    A worker that can't start or recycle its backend stops with failed set.
+    """
+
+    def __init__(self, saver, work, done, recycle_after=30, stream=False):
+
+        super().__init__(daemon=True)
+        self.saver = saver
+        self.work = work # queue of match ids to fetch
+        self.done = done # queue of (match_id, saved) results
+        self.recycle_after = recycle_after # pages before the backend is replaced
+        self.stream = stream
+        self.fetcher = None
+        self.pages = 0
+        self.failed = False
+
+    def recycle(self):
+        """
+        Replaces this worker's backend
+        """
+
+        fetcher, self.fetcher = self.fetcher, None
+        if fetcher is not None:
+            fetcher.close()
+        self.fetcher = self.saver.new_fetcher()
+        self.pages = 0
+
+    def run(self):
+
+        try:
+            self.recycle()
+        except Exception as e:
+            l.debug(f'{self.name} could not start its backend: {e!r}')
+            self.failed = True
+            return
+
+        while True:
+            if self.stream:
+                match_id = self.work.get()
+                if match_id is None:
+                    self.work.put(None)
+                    break
+            else:
+                try:
+                    match_id = self.work.get_nowait()
+                except queue.Empty:
+                    break
+
+            if self.pages >= self.recycle_after:
+                l.debug(f'{self.name} Recycling Backend. . .')
+                try:
+                    self.recycle()
+                except Exception as e:
+                    l.debug(f'{self.name} could not recycle its backend: {e!r}')
+                    self.failed = True
+                    self.done.put((match_id, False))
+                    break
+
+            try:
+                saved = self.saver.fetch(self.fetcher, match_id)
+            except Exception as e:
+                l.debug(f'{self.name} failed on {match_id}: {e}')
+                saved = False
+
+            self.pages += 1
+            self.done.put((match_id, saved))
+
+        if self.fetcher is not None:
+            self.fetcher.close()
 
 class MatchSaver:
     """
     Grabs matches and saves their html.
     """
 
-    def __init__(self, wait=1, output='D:/Documents/Battlefield Analytics/BFV/data/unparsed/matches/', mode_filter=None):
+    def __init__(self, wait=1, mode_filter=None, workers=1, host_interval=1, recycle_after=30, url_fn=gen_match_url_from_id, backend='selenium', archive_dir=ARCHIVE_DIR):
 
         self.timeout = 20 # how long before moving on
         self.wait = wait # Minimum amount to wait (max will add 3 seconds)
-        self.output = 'D:/Documents/Battlefield Analytics/BFV/data/unparsed/matches/'
+        self.archive = ReportArchive(archive_dir)
         self.ingestion_db = IngestionDB()
         self.processing_db = ProcessingDB()
         self.browser_counter = 0 # Tracks when purging needs to be done
-        self.scraped_matches = self.ingestion_db.get_matches(mode_filter)
-        self.parsed_matches = [x['_id'] for x in self.processing_db.get_parsed_matches_by_date()]
-        self.parser = MatchParser()
-
-        self.browser = webdriver.Firefox(executable_path=gecko_driver_path)
+        self.scraped_matches = set(self.ingestion_db.get_matches(mode_filter))
+        self.parsed_matches = self.processing_db.get_parsed_match_ids()
+        self.parser = MatchParser(archive_dir=archive_dir) # imports any loose reports into the archive on first run
+        self.archived_matches = set(self.archive.ids())
+
+        # Pool configuration
+        self.backend = backend # 'selenium' or a FetchBackend class, see backends.py
+        self.workers = workers # number of concurrent fetchers used by get_all
+        self.recycle_after = recycle_after # pages per fetcher before it is recycled
+        self.limiter = HostLimiter(host_interval) # shared across workers
+        self.url_fn = url_fn # match_id -> url, swappable for a local stand-in server
+
+        self.fetcher = None # Only used by single get calls, workers own their own
         l.debug('Match Saver Created Successfully.')
 
+    def new_fetcher(self):
+        """
+        Creates a fresh fetch backend
+        """
+
+        return get_backend(self.backend)
+
     def purge_browser(self):
         """
         Refreshes Browser
         """
 
-        self.browser.close()
-        self.browser = None
-        self.browser = webdriver.Firefox(executable_path=gecko_driver_path)
+        if self.fetcher is not None:
+            self.fetcher.close()
+        self.fetcher = None
+        self.fetcher = self.new_fetcher()
         self.browser_counter = 0
 
     def get_matches_for_retrieval(self):
         """
-        Returns the matches that need scraped.
+        Returns the matches that need scraped. Archived ones are waiting on the parser, not the tracker.
         """
 
-        return list(set(self.scraped_matches) - set(self.parsed_matches))
+        return list(self.scraped_matches - self.parsed_matches - self.archived_matches)
 
     def get_all(self, parse=False):
         """
-        Scrapes all unscraped matches in DB.
+        Scrapes all unscraped matches in DB using a pool of fetch workers.
+        Matches are parsed on this thread as workers finish them.
         """
 
         matches_to_get = self.get_matches_for_retrieval()
         total = len(matches_to_get)
-        for i, match_id in enumerate(matches_to_get):
-            l.debug(f'Parsing {match_id}, {i+1}/{total}')
-            self.get(match_id)
 
-            self.parser.parse(match_id)
-            self.parser.parse(match_id, full=True)
+        work = queue.Queue()
+        done = queue.Queue()
+        for match_id in matches_to_get:
+            work.put(match_id)
+
+        pool = [FetchWorker(self, work, done, self.recycle_after) for x in range(min(self.workers, total))]
+        for worker in pool:
+            worker.start()
+        l.debug(f'Started {len(pool)} {self.backend} Workers for {total} Matches.')
+
+        finished = 0
+        while finished < total and (any(w.is_alive() for w in pool) or not done.empty()):
+            try:
+                match_id, saved = done.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            finished += 1
+            if not saved:
+                l.debug(f'Could not retrieve {match_id}, {finished}/{total}')
+                continue
+
+            l.debug(f'Parsing {match_id}, {finished}/{total}')
+            self.parser.parse(match_id, both=True)
 
-        self.browser.close()
+        for worker in pool:
+            worker.join()
+
+        if self.fetcher is not None:
+            self.fetcher.close()
 
     def get(self, match_id):
         """
@@ -88,50 +251,68 @@ class MatchSaver:
             return False
 
         else:
-            if self.browser_counter > 30:
+            if self.fetcher is None or self.browser_counter > self.recycle_after:
                 l.debug('Purging Browser. . .')
                 self.purge_browser()
 
-            retries = 0
-            while retries < 10:
+            self.browser_counter += 1
+            return self.fetch(self.fetcher, match_id)
 
-                try:
-                    self.browser.get(gen_match_url_from_id(match_id))
-                    self.browser_counter += 1
-                    element = WebDriverWait(self.browser, 120).until(ec.visibility_of_element_located((By.CLASS_NAME, "table-rows")))
-                    retries = 11
-                except:
-                    retries += 1
+    def fetch(self, fetcher, match_id):
+        """
+        Loads a match with the given backend and saves it. False if it never loaded.
+        """
 
-            page_source = self.browser.page_source
-            self.save(page_source, match_id)
+        url = self.url_fn(match_id)
+        retries = 0
+        while retries < 10:
 
-            return True
+            try:
+                self.limiter.wait(url)
+                fetcher.load(url, "table-rows", timeout=120)
+                retries = 11
+            except:
+                retries += 1
+
+        # Nothing usable came back, don't save whatever page was left over
+        if retries != 11:
+            l.debug(f'{match_id} did not load after {retries} tries.')
+            return False
+
+        page_source = fetcher.page_source()
+        self.save(page_source, match_id)
+
+        return True
 
     def save(self, page, match_id):
         """
         Saves a match
         """
 
-        with open(self.output+match_id+'.html', 'w', encoding="utf-8") as f:
-            f.write(page)
-            self.ingestion_db.upsert_matches([match_id])
-            l.debug('Successfully Parsed and Saved.')
+        self.archive.put(match_id, page)
+        self.ingestion_db.upsert_matches([match_id])
+        l.debug('Successfully Parsed and Saved.')
 
 class MatchRetriever:
     """
     A Class dedicated to getting matches from players
     """
 
-    def __init__(self, wait=1, scroll_times=10):
+    SCROLL_TIMEOUT = 5 # seconds to wait for more reports after a scroll
+    SCROLL_POLL = .25
+
+    def __init__(self, wait=1, scroll_times=10, backend='selenium', engine='lxml'):
 
         self.timeout = 20 # how long before moving on
         self.wait = wait # Minimum amount to wait (max will add 3 seconds)
         #self.saver = MatchSaver(wait)
         self.db = IngestionDB()
+        self.frontier = CrawlFrontier(self.db)
         self.scroll_times = scroll_times
+        self.engine = engine # see PARSER_ENGINES
+        self.known_matches = set() # stop scrolling once these show up
 
-        self.browser = webdriver.Firefox(executable_path=gecko_driver_path)
+        self.backend = get_backend(backend) # 'selenium' or a FetchBackend class, see backends.py
         l.debug('Match Retriever Created Successfully.')
 
     def get(self, player_ids):
@@ -139,67 +320,111 @@ class MatchRetriever:
         Gets Multiple Players matches
         """
 
-        all_matches = [[] for x in player_ids]
+        return [matches for player, matches, match_modes in self.iter_get(player_ids)]
+
+    def iter_get(self, player_ids):
+        """
+        Gets players matches one player at a time, yielding (player, matches, match_modes)
+        """
+
+        self.known_matches = set(self.db.get_matches())
 
-        for i, player in enumerate(player_ids):
-            all_matches[i] = self.get_player_matches(gen_player_url_from_id(player))
-            time.sleep(self.wait)
+        try:
+            for player in player_ids:
+                found = self.get_player_matches(gen_player_url_from_id(player))
+
+                # Failed loads leave the player's schedule alone
+                if found is None:
+                    yield player, [], []
+                else:
+                    matches, match_modes = found
+                    self.frontier.record({player:len(set(matches) - self.known_matches)})
+                    self.known_matches.update(matches)
+                    yield player, matches, match_modes
 
-        self.browser.close()
+                time.sleep(self.wait)
 
-        return all_matches
+        finally:
+            self.backend.close()
 
     def get_player_matches(self, url):
         """
-        A wrapper method for get on the webdriver that handles 
+        A wrapper method for get on the fetch backend that handles 
         retrieving the url data once the report is loaded.
         """
 
         l.debug(f'Player URL being scraped: {url}')
-        self.browser.get(url)
         try:
-            element = WebDriverWait(self.browser, 120).until(ec.visibility_of_element_located((By.CLASS_NAME, "reports-list")))
-
-            self.scroll_on_user_page()
+            self.backend.load(url, "reports-list", timeout=120)
 
-            page_source = self.browser.page_source
-            l.debug("Page Source Retrieved, Parsing . . .")
-
-            matches, match_modes = self.parse_out_matches(BeautifulSoup(page_source))
+            # A browser loads more reports while scrolling and reads them as they come in,
+            # anything else only has what the server rendered
+            if self.backend.supports_scripts:
+                matches, match_modes = self.scroll_on_user_page()
+            else:
+                page_source = self.backend.page_source()
+                l.debug("Page Source Retrieved, Parsing . . .")
+                matches, match_modes = self.parse_out_matches(make_soup(page_source, self.engine, PLAYER_REPORTS_CONTAINERS))
             l.debug(f"Parsed {len(matches)} Matches.")
 
             # Write to DB to parse later
             self.db.upsert_matches(matches, match_modes)
 
-            return matches
+            return matches, match_modes
         
         except:
             l.debug("Issue loading or Parsing, could be 404, timeout or formatting changes. Trying Next player if remaining.")
-            return []
+            return None
 
     def scroll_on_user_page(self):
         """
-        Scrolls to load more
+        Scrolls to load more, reading only the newly loaded entries after each scroll.
+        Stops at the first known match, when scroll_times is used up, or when nothing new loads within SCROLL_TIMEOUT.
         """
 
-        SCROLL_PAUSE_TIME = 2
-
-        # Get scroll height
-        last_height = self.browser.execute_script("return document.body.scrollHeight")
+        matches, match_modes = self.read_new_entries(0)
 
         for i in range(self.scroll_times):
 
-            # Scroll down to bottom
-            self.browser.execute_script(f"window.scrollTo(0, document.body.scrollHeight);")
+            # Everything past a known match was gathered on an earlier crawl
+            if not self.known_matches.isdisjoint(matches):
+                l.debug(f'Reached known matches after {i} scrolls.')
+                break
 
-            # Wait to load page
-            time.sleep(SCROLL_PAUSE_TIME)
+            # Scroll down to bottom
+            self.backend.execute_script("window.scrollTo(0, document.body.scrollHeight);")
 
-            # Calculate new scroll height and compare with last scroll height
-            new_height = self.browser.execute_script("return document.body.scrollHeight")
-            if new_height == last_height:
+            # Wait for more entries rather than a fixed pause
+            if not self.wait_for_entries(len(matches)):
                 break
-            last_height = new_height
+
+            new_matches, new_modes = self.read_new_entries(len(matches))
+            matches += new_matches
+            match_modes += new_modes
+
+        return matches, match_modes
+
+    def wait_for_entries(self, count):
+        """
+        Polls the page until it holds more than count report entries, False if it doesn't within SCROLL_TIMEOUT
+        """
+
+        deadline = time.perf_counter() + self.SCROLL_TIMEOUT
+        while time.perf_counter() < deadline:
+            if self.backend.execute_script(COUNT_ENTRIES_SCRIPT) > count:
+                return True
+            time.sleep(self.SCROLL_POLL)
+
+        return False
+
+    def read_new_entries(self, start):
+        """
+        Reads the match ids and modes of the report entries from start on, straight out of the page
+        """
+
+        entries = self.backend.execute_script(READ_ENTRIES_SCRIPT, start)
+
+        return [gen_match_id_from_url(url) for url, name in entries], [name.split(" - ")[0] for url, name in entries]
 
     def parse_out_matches(self, page):
         """
@@ -229,110 +454,167 @@ class MatchParser:
     Obtains player records from matches
     """
 
-    def __init__(self, load_dirs=False, load_configuration={}):
+    def __init__(self, load_dirs=False, load_configuration={}, engine='lxml', connect=True, archive_dir=ARCHIVE_DIR):
 
-        self.read_dir = 'D:/Documents/Battlefield Analytics/BFV/data/unparsed/matches/'
-        self.ingestion_db = IngestionDB()
-        self.processing_db = ProcessingDB()
+        self.read_dir = 'D:/Documents/Battlefield Analytics/BFV/data/unparsed/matches/' # loose files from before the archive
+        self.ingestion_db = IngestionDB() if connect else None # parse workers never connect
+        self.processing_db = ProcessingDB() if connect else None
         self.out_dir = 'D:/Documents/Battlefield Analytics/BFV/data/parsed/matches/'
+        self.archive = ReportArchive(archive_dir)
         self.matches_to_parse = []
+        self.engine = engine # see PARSER_ENGINES
+
+        # Reports saved as loose files before the archive existed get brought over, an interrupted import carries on
+        if connect:
+            self.archive_loose_files()
 
         if load_dirs:
             self.get_matches_to_parse_from_dir(**load_configuration)
         
     def get_matches_to_parse_from_dir(self, unparsed=True, parsed=False):
         """
-        Uses read and write directories to get a list of match ids
+        Uses the archive index to get a list of match ids
         """
         
         if unparsed:
-            unparsed = [x[:-5] for x in os.listdir(self.read_dir)]
-            self.matches_to_parse.extend(unparsed)
-            l.debug('Directories for Unparsed Matches Loaded Successfully.')
+            self.matches_to_parse.extend(self.archive.ids(parsed=False))
+            l.debug('Unparsed Matches Loaded Successfully.')
         if parsed:
-            parsed = [x[:-5] for x in os.listdir(self.out_dir)]
-            self.matches_to_parse.extend(parsed)
-            l.debug('Directories for Parsed Matches Loaded Successfully.')
+            self.matches_to_parse.extend(self.archive.ids(parsed=True))
+            l.debug('Parsed Matches Loaded Successfully.')
+
+    def archive_loose_files(self, remove=False):
+        """
+        Moves reports saved as loose files (unparsed and parsed folders) into the archive,
+        folders whose import finished are skipped
+        """
+
+        for directory, parsed in [(self.read_dir, False), (self.out_dir, True)]:
+            if os.path.isdir(directory) and not self.archive.imported(directory):
+                self.archive.import_dir(directory, parsed=parsed, remove=remove)
+
+    def parse_all(self, full=False, workers=1, batch_size=100, both=False):
+        """
+        Parses eveything in the matches_to_parse list. With workers > 1 files are parsed
+        in a process pool while this process batches the database writes and file moves.
+        """
+
+        jobs = [(match, full, both) for match in self.matches_to_parse]
+
+        if workers > 1:
+            with multiprocessing.Pool(workers, initializer=init_parse_worker, initargs=(self.engine, self.archive.root)) as pool:
+                self.write_all(pool.imap(parse_worker, jobs, chunksize=4), full, batch_size, both)
+        else:
+            self.write_all((read_report(self, *job) for job in jobs), full, batch_size, both)
 
-    def parse_all(self, full=False):
+    def write_all(self, results, full=False, batch_size=100, both=False):
         """
-        Parses eveything in the matches_to_parse list
+        Consumes (match, result, error) in order, writing in batches. Failed files are logged and left in place.
         """
 
         total = len(self.matches_to_parse)
-        for i, match in enumerate(self.matches_to_parse):
-            l.debug(f'Parsing {match}, {i+1}/{total}')
-            self.parse(match, full=full)
+        batch = []
+        failed = 0
+
+        for i, (match, result, error) in enumerate(results):
+            l.debug(f'Parsed {match}, {i+1}/{total}')
+
+            if error is not None:
+                l.debug(f'Could not parse {match}: {error}')
+                failed += 1
+                continue
 
-    def move_file(self, filename):
+            batch.append((match, result))
+            if len(batch) >= batch_size:
+                self.write(batch, full=full, both=both)
+                batch = []
+
+        if len(batch) > 0:
+            self.write(batch, full=full, both=both)
+
+        l.debug(f'Parsed {total-failed}/{total}, {failed} Failed.')
+
+    def write(self, batch, full=False, both=False):
         """
-        Transfers parsed file
+        Writes a batch of (match, result) from read. Fully parsed matches are flagged in the archive afterwards.
         """
 
-        shutil.copy(self.read_dir+filename, self.out_dir+filename)
-        os.remove(self.read_dir+filename)
+        # Players first, then carry on as a full write with the match halves
+        if both:
+            self.ingestion_db.update_players([player for match, (players, data) in batch for player in players])
+            batch = [(match, data) for match, (players, data) in batch]
+            full = True
+
+        if not full:
+            self.ingestion_db.update_players([player for match, players in batch for player in players])
+            return None
+
+        self.processing_db.bulk_upsert_matches([data for match, data in batch])
+        self.archive.mark_parsed([match for match, data in batch])
+
+    # Stat positions within each player card
+    COMBAT_STATS = {0:'kills', 
+        1:'deaths', 
+        2:'kills_per_death', 
+        3:'kills_per_min',
+        4:'solider_damages',
+        5:'headshots',
+        6:'kill_assists',
+        7:'avenger_kills',
+        8:'savior_kills',
+        9:'shots_taken',
+        10:'shots_hit',
+        11:'shot_accuracy',
+        12:'dogtags_taken',
+        13:'longest_headshot',
+        14:'highest_killstreak',
+        15:'highest_multikill'}
+
+    TEAM_STATS = {0: 'heals',
+        1: 'revives',
+        2: 'revives_recieved',
+        3: 'resupplies',
+        4: 'repairs',
+        5: 'squad_spawns',
+        6: 'squad_wipes',
+        7: 'orders_completed'}
+
+    SCORE_STATS = {0: 'score',
+        1: 'score_per_min'}
+
+    TEAM_CARD_CLASS = "team card bordered header-bordered responsive"
+
+    def parse_stat_card(self, card, mapping):
+        """
+        Scans a card's stats once and pulls the mapped values out by position
+        """
+
+        stats = card.find_all('div', {'class':'stat'})
+
+        return {name: stats[index].find('span', {'class':'value'}).text for index, name in mapping.items()}
 
     def parse_combat_card(self, combat):
         """
         Takes combat card for player and parses out info
         """
 
-        out = {}
-        mapping = {0:'kills', 
-            1:'deaths', 
-            2:'kills_per_death', 
-            3:'kills_per_min',
-            4:'solider_damages',
-            5:'headshots',
-            6:'kill_assists',
-            7:'avenger_kills',
-            8:'savior_kills',
-            9:'shots_taken',
-            10:'shots_hit',
-            11:'shot_accuracy',
-            12:'dogtags_taken',
-            13:'longest_headshot',
-            14:'highest_killstreak',
-            15:'highest_multikill'}
-
-        for index, name in mapping.items():
-            out[name] = combat.find_all('div', {'class':'stat'})[index].find('span', {'class':'value'}).text
-
-        return out
+        return self.parse_stat_card(combat, self.COMBAT_STATS)
     
     def parse_team_card(self, team):
         """
         Parses team score from team card
         """
-        data = {}
-        mapping = {0: 'heals',
-            1: 'revives',
-            2: 'revives_recieved',
-            3: 'resupplies',
-            4: 'repairs',
-            5: 'squad_spawns',
-            6: 'squad_wipes',
-            7: 'orders_completed'}
-
-        for index, name in mapping.items():
-            data[name] = team.find_all('div', {'class':'stat'})[index].find('span', {'class':'value'}).text
 
-        return data
+        return self.parse_stat_card(team, self.TEAM_STATS)
 
     def parse_score_card(self, score):
         """
         Parses Score Card
         """
-        data = {}
-        mapping = {0: 'score',
-            1: 'score_per_min'}
 
-        for index, name in mapping.items():
-            data[name] = score.find_all('div', {'class':'stat'})[index].find('span', {'class':'value'}).text
+        return self.parse_stat_card(score, self.SCORE_STATS)
 
-        return data
-
-    def parse_weapon_card(weapons):
+    def parse_weapon_card(self, weapons):
         """
         Parses Weapon Card - Not supported yet
         """
@@ -340,140 +622,180 @@ class MatchParser:
 
         return data
 
-    def parse_player_rows(self, page, full=False):
+    def parse_player_link(self, player):
         """
-        Parses players out of a beautiful soup page
+        Returns (network, gamertag) from a player's profile link
         """
 
-        player_data = page.find_all('div', {'class':'player'})
-        
+        href = player.find_all('a', {'class':'name'})[0]['href'].split('/')
+
+        return href[3], href[4]
+
+    def parse_player_id(self, player):
+        """
+        Builds network_gamertag from a player's profile link
+        """
+
+        return "{}_{}".format(*self.parse_player_link(player))
+
+    def parse_team_header(self, team_page):
+        """
+        Returns (team name, won/lost) from a team card header
+        """
+
+        header = team_page.find('div', {'class':'header'}).find('h2').text
+        name = header.replace('Winner', '').replace('\n', '').replace(' ', '')
+
+        return name, 'won' if 'Winner' in header else 'lost'
+
+    def parse_player_rows(self, page, full=False, team_cards=None):
+        """
+        Parses players out of a beautiful soup page
+        """
 
         # Parse out players, ignoring team and placement
         if not full:
             
-            players = [{} for x in range(len(player_data))]
-
-            # Parse basic player info
-            for i in range(len(players)):
-                    players[i]['gamertag'] = player_data[i].find_all('a', {'class':'name'})[0]['href'].split('/')[4]
-                    players[i]['network'] = player_data[i].find_all('a', {'class':'name'})[0]['href'].split('/')[3]
-                    players[i]['player_id'] = f"{players[i]['network']}_{players[i]['gamertag']}"
+            players = []
+            for player in page.find_all('div', {'class':'player'}):
+                network, gamertag = self.parse_player_link(player)
+                players.append({'gamertag':gamertag, 'network':network, 'player_id':f"{network}_{gamertag}"})
 
         # Otherwise Parse it with team and other context
         else:
 
             players = []
-            team_1_page = page.find_all('div', {'class':"team card bordered header-bordered responsive"})[0]
+            if team_cards is None:
+                team_cards = page.find_all('div', {'class':self.TEAM_CARD_CLASS})
 
-            if len(page.find_all('div', {'class':"team card bordered header-bordered responsive"})) < 2:
+            if len(team_cards) < 2:
                 l.debug("Match has no winner or Loser.")
                 return players
-            team_2_page = page.find_all('div', {'class':"team card bordered header-bordered responsive"})[1]
 
-            try:
-                quitters_page = page.find_all('div', {'class':"team card bordered header-bordered responsive"})[2]
-                subsets = [team_1_page, team_2_page, quitters_page]
-            except:
+            if len(team_cards) < 3:
                 l.debug('Quitters Not Found.')
-                subsets = [team_1_page, team_2_page]
+            subsets = team_cards[:3]
 
-            team_1_winner = 'won' if 'Winner' in team_1_page.find('div', {'class':'header'}).find('h2').text else 'lost'
-            team_2_winner = 'won' if 'Winner' in team_2_page.find('div', {'class':'header'}).find('h2').text else 'lost'
-            team_1_name = team_1_page.find('div', {'class':'header'}).find('h2').text.replace('Winner', '').replace('\n', '').replace(' ', '')
-            team_2_name = team_2_page.find('div', {'class':'header'}).find('h2').text.replace('Winner', '').replace('\n', '').replace(' ', '')
+            team_1_name, team_1_winner = self.parse_team_header(team_cards[0])
+            team_2_name, team_2_winner = self.parse_team_header(team_cards[1])
+            teams = [(team_1_name, team_1_winner), (team_2_name, team_2_winner), ('Unknown', 'dnf')]
 
             for i, group in enumerate(subsets):
 
-                player_data = group.find_all('div', {'class':'player'})
-                group_players = [{} for x in range(len(player_data))]
-
-                for j, player in enumerate(player_data):
-                    gamertag = player_data[j].find_all('a', {'class':'name'})[0]['href'].split('/')[4]
-                    network = player_data[j].find_all('a', {'class':'name'})[0]['href'].split('/')[3]
-                    group_players[j]['player_id'] = f"{network}_{gamertag}"
-
-                    group_players[j]['team'] = team_1_name if i==0 else team_2_name if i==1 else 'Unknown'
-                    group_players[j]['team_status'] = team_1_winner if i==0 else team_2_winner if i==1 else 'dnf'
+                team_name, team_status = teams[i]
 
-                    # Combat card
-                    combat = player.find_all('div', {'class':'card'})[0]
-                    group_players[j].update(self.parse_combat_card(combat))
+                for player in group.find_all('div', {'class':'player'}):
+                    parsed = {'player_id':self.parse_player_id(player),
+                              'team':team_name,
+                              'team_status':team_status}
 
-                    # Team Card
-                    team = player.find_all('div', {'class':'card'})[1]
-                    group_players[j].update(self.parse_team_card(team))
+                    # Combat, Team and Score cards, weapons not always found, especially on quitters
+                    cards = player.find_all('div', {'class':'card'})
+                    parsed.update(self.parse_combat_card(cards[0]))
+                    parsed.update(self.parse_team_card(cards[1]))
+                    parsed.update(self.parse_score_card(cards[2]))
+                    if len(cards) > 3:
+                        parsed.update(self.parse_weapon_card(cards[3]))
 
-                    # Score Card
-                    score = player.find_all('div', {'class':'card'})[2]
-                    group_players[j].update(self.parse_score_card(score))
+                    players.append(parsed)
 
-                    # Weapons not always found, especially on quitters
-                    try:
-                        weapons = player.find_all('div', {'class':'card'})[3]
-                        group_players[j].update(self.parse_weapon_card(weapons))
-
-                    except:
-                        continue
-                players.extend(group_players)
         return players
             
-    def parse_overall_match_info(self, page):
+    def parse_overall_match_info(self, page, team_cards=None):
         """
         Parses out match results and metadata
         """
         overview_card = page.find('div', {'class':"report-info-container card header-bordered responsive"})
+        stats = overview_card.find_all('div', {'class':'stat'})
 
         data = {}
         data['map'] = overview_card.find('h1').text
-        data['duration'] = overview_card.find_all('div', {'class':'stat'})[0].find('div', {'class':'value'}).text
+        data['duration'] = stats[0].find('div', {'class':'value'}).text
         data['mode'] = overview_card.find('span', {'class':'mode'}).text
         data['datetime'] = overview_card.find('span', {'class':'time'}).text
-        data['players'] = overview_card.find_all('div', {'class':'stat'})[1].find('div', {'class':'value'}).text
-        data['server_rules'] = overview_card.find_all('div', {'class':'stat'})[2].find('div', {'class':'value'}).text
-        data['server_type'] = overview_card.find_all('div', {'class':'stat'})[3].find('div', {'class':'value'}).text
+        data['players'] = stats[1].find('div', {'class':'value'}).text
+        data['server_rules'] = stats[2].find('div', {'class':'value'}).text
+        data['server_type'] = stats[3].find('div', {'class':'value'}).text
+
+        if team_cards is None:
+            team_cards = page.find_all('div', {'class':self.TEAM_CARD_CLASS})
 
-        if len(page.find_all('div', {'class':"team card bordered header-bordered responsive"})) < 2:
+        if len(team_cards) < 2:
             l.debug("Match has no winner or Loser.")
             return data
 
         # Winners and Losers
-        team_1_page = page.find_all('div', {'class':"team card bordered header-bordered responsive"})[0]
-        team_2_page = page.find_all('div', {'class':"team card bordered header-bordered responsive"})[1]
-        team_1_name = team_1_page.find('div', {'class':'header'}).find('h2').text.replace('Winner', '').replace('\n', '').replace(' ', '')
-        team_2_name = team_2_page.find('div', {'class':'header'}).find('h2').text.replace('Winner', '').replace('\n', '').replace(' ', '')
+        team_1_name, team_1_winner = self.parse_team_header(team_cards[0])
+        team_2_name, team_2_winner = self.parse_team_header(team_cards[1])
 
         data['team_1'] = team_1_name
         data['team_2'] = team_2_name
-        data['winner'] = team_1_name if 'Winner' in team_1_page.find('div', {'class':'header'}).find('h2').text else team_2_name
+        data['winner'] = team_1_name if team_1_winner == 'won' else team_2_name
 
         return data
 
     def parse_full_match(self, page):
         """
-        Parses player and match info
+        Parses player and match info, team cards are located once and shared
         """
 
-        data = self.parse_overall_match_info(page)
-        data['players'] = self.parse_player_rows(page, full=True)
+        team_cards = page.find_all('div', {'class':self.TEAM_CARD_CLASS})
+        data = self.parse_overall_match_info(page, team_cards)
+        data['players'] = self.parse_player_rows(page, full=True, team_cards=team_cards)
 
         return data
 
-    def parse(self, filename, full=False):
+    def read(self, filename, full=False, both=False):
         """
-        Parses a file by name in the read_dir. If not full, only gets the players out
+        Parses an archived report by match id without writing anything. If not full, only gets the player ids out.
+        If both, the page is parsed once for (player ids, full match).
         """
 
-        with open(self.read_dir+filename+'.html', 'r') as file:
-            
-            page = BeautifulSoup(file)
-            if not full:
-                # Player Rows
-                players = self.parse_player_rows(page, full=full)
-                self.ingestion_db.update_players([x['player_id'] for x in players])
-                return None
-            else:
-                match = self.parse_full_match(page)
-                match['_id'] = filename
-                self.processing_db.upsert_match(match)
-        
-        self.move_file(filename+'.html')
\ No newline at end of file
+        page = make_soup(self.archive.get(filename), self.engine, REPORT_CONTAINERS)
+
+        if not (full or both):
+            # Player Rows
+            return [x['player_id'] for x in self.parse_player_rows(page)]
+
+        match = self.parse_full_match(page)
+        match['_id'] = filename
+
+        if both:
+            return [x['player_id'] for x in self.parse_player_rows(page)], match
+
+        return match
+
+    def parse(self, filename, full=False, both=False):
+        """
+        Parses an archived report by match id. If not full, only gets the players out
+        """
+
+        self.write([(filename, self.read(filename, full=full, both=both))], full=full, both=both)
+
+# Parse pool workers, each process gets its own unconnected parser
+worker_parser = None
+
+def init_parse_worker(engine, archive_dir):
+    """
+    Builds the parser used by a pool process
+    """
+
+    global worker_parser
+    worker_parser = MatchParser(engine=engine, connect=False, archive_dir=archive_dir)
+
+def read_report(parser, filename, full=False, both=False):
+    """
+    Reads one report, catching failures so a bad file only costs itself
+    """
+
+    try:
+        return filename, parser.read(filename, full=full, both=both), None
+    except Exception as e:
+        return filename, None, repr(e)
+
+def parse_worker(job):
+    """
+    Pool entry point, job is (filename, full, both)
+    """
+
+    return read_report(worker_parser, *job)
\ No newline at end of file
@@ -0,0 +1,220 @@
+# Statistics engines for the analytics tables
+
+import numpy as np
+import pandas as pd
+
+ALL = '__all__' # Group key for stats over every row
+
+class GroupStats:
+    """
+    Running count, mean and sum of squared deviations (m2) per (group, var).
+    Batches are merged in with Chan's parallel form of Welford's update and can be taken back out the same way,
+    so map mode stats can follow new matches without a full recompute.
+    """
+
+    def __init__(self, table=None):
+
+        self.table = table if table is not None else pd.DataFrame(columns=['n', 'mean', 'm2'], index=pd.MultiIndex.from_tuples([], names=['group', 'var']))
+
+    @classmethod
+    def from_frame(cls, df, group_col, cols):
+        """
+        Summarizes a batch with built in aggregations, rows per group plus the ALL group
+        """
+
+        parts = []
+        for col in cols:
+            summary = df.groupby(group_col, observed=True)[col].agg(['count', 'mean', 'var'])
+            summary.index = summary.index.astype(str)
+            summary.loc[ALL] = [df[col].count(), df[col].mean(), df[col].var()]
+            summary['var_name'] = col
+            parts.append(summary)
+
+        table = pd.concat(parts)
+        table = pd.DataFrame({'n':table['count'].astype(float).to_numpy(),
+                              'mean':table['mean'].fillna(0).to_numpy(),
+                              'm2':(table['var']*(table['count']-1)).fillna(0).to_numpy()},
+                             index=pd.MultiIndex.from_arrays([table.index, table['var_name']], names=['group', 'var']))
+
+        return cls(table)
+
+    def add(self, other):
+        """
+        Merges another GroupStats in
+        """
+
+        a, b = self.table.align(other.table, fill_value=0)
+        n = a['n'] + b['n']
+        delta = b['mean'] - a['mean']
+
+        self.table = pd.DataFrame({'n':n,
+                                   'mean':(a['mean'] + (delta*b['n']/n)).fillna(0),
+                                   'm2':(a['m2'] + b['m2'] + (delta**2)*a['n']*b['n']/n).fillna(0)})
+
+        return self
+
+    def remove(self, other):
+        """
+        Takes rows summarized in other back out, for rows that are being replaced
+        """
+
+        total, part = self.table.align(other.table, fill_value=0)
+        n = total['n'] - part['n']
+        mean = ((total['n']*total['mean']) - (part['n']*part['mean'])) / n
+        delta = part['mean'] - mean
+
+        self.table = pd.DataFrame({'n':n,
+                                   'mean':mean.fillna(0),
+                                   'm2':(total['m2'] - part['m2'] - (delta**2)*n*part['n']/total['n']).fillna(0).clip(lower=0)})
+        self.table = self.table[self.table['n'] > 0]
+
+        return self
+
+    def mean(self, var):
+        """
+        Means by group for var
+        """
+
+        return self.table.xs(var, level='var')['mean']
+
+    def std(self, var):
+        """
+        Sample standard deviations by group for var, NaN under 2 rows like pandas
+        """
+
+        table = self.table.xs(var, level='var')
+
+        return np.sqrt(table['m2']/(table['n']-1)).where(table['n'] > 1)
+
+def lookup(keys, values):
+    """
+    values[key] for every row of keys, done over the distinct keys only
+    """
+
+    keys = keys.astype('category')
+
+    return values.reindex(keys.cat.categories.astype(str)).to_numpy()[keys.cat.codes.to_numpy()]
+
+def percentile_bins(values, population=None, bins=100):
+    """
+    Same labels as pd.qcut(values, bins, labels=False, duplicates='drop') but with the edges taken from
+    population (defaults to values). The edges come from one partition of the population and rows are
+    placed with a binary search over the edges.
+    """
+
+    x = np.asarray(values, dtype=float)
+    pop = x if population is None else np.asarray(population, dtype=float)
+    pop = pop[~np.isnan(pop)]
+
+    edges = np.unique(np.percentile(pop, np.linspace(0, 1, bins+1)*100))
+    labels = np.searchsorted(edges, x, side='left')
+    labels[x == edges[0]] = 1 # lowest edge is included
+
+    missing = np.isnan(x) | (labels == 0) | (labels == len(edges))
+    labels = labels - 1
+    if missing.any():
+        return np.where(missing, np.nan, labels)
+
+    return labels
+
+class QuantileSketch:
+    """
+    Mergeable t-digest. Values are kept as weighted centroids that get merged under the k1 scale function,
+    so the tails stay precise and the size stays bounded by compression however many values go in.
+    Sketches of different days (or map modes) can be merged and queried as one.
+    """
+
+    def __init__(self, compression=200, means=None, weights=None, low=np.inf, high=-np.inf):
+
+        self.compression = compression
+        self.means = np.array([], dtype=float) if means is None else means
+        self.weights = np.array([], dtype=float) if weights is None else weights
+        self.low = low # exact min and max, quantiles are pinned to them
+        self.high = high
+
+    def update(self, values):
+        """
+        Adds raw values, NaNs are skipped
+        """
+
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+
+        self.low = min(self.low, values.min())
+        self.high = max(self.high, values.max())
+        self.means = np.concatenate([self.means, values])
+        self.weights = np.concatenate([self.weights, np.ones(len(values))])
+
+        return self.compress()
+
+    def merge(self, other):
+        """
+        Folds another sketch into this one
+        """
+
+        self.low = min(self.low, other.low)
+        self.high = max(self.high, other.high)
+        self.means = np.concatenate([self.means, other.means])
+        self.weights = np.concatenate([self.weights, other.weights])
+
+        return self.compress()
+
+    def compress(self):
+        """
+        Merges neighbouring centroids that fall in the same unit of the k1 scale
+        """
+
+        order = np.argsort(self.means, kind='stable')
+        means, weights = self.means[order], self.weights[order]
+
+        # Position of each centroid's middle in the distribution, mapped onto the scale
+        cumulative = np.cumsum(weights)
+        q = (cumulative - (weights/2)) / cumulative[-1]
+        bucket = np.floor(self.compression/(2*np.pi) * np.arcsin((2*q) - 1)).astype(np.int64)
+        bucket -= bucket.min()
+
+        merged = np.bincount(bucket, weights=weights)
+        keep = merged > 0
+        self.weights = merged[keep]
+        self.means = (np.bincount(bucket, weights=means*weights)[keep]) / self.weights
+
+        return self
+
+    def count(self):
+
+        return self.weights.sum()
+
+    def quantile(self, q):
+        """
+        Estimated value at quantile q, NaN if the sketch is empty
+        """
+
+        if len(self.means) == 0:
+            return np.nan
+
+        total = self.weights.sum()
+        centers = np.cumsum(self.weights) - (self.weights/2)
+        positions = np.concatenate([[0], centers, [total]])
+        values = np.concatenate([[self.low], self.means, [self.high]])
+
+        return float(np.interp(q*total, positions, values))
+
+    def to_bytes(self):
+        """
+        Packs the sketch for storage
+        """
+
+        return np.concatenate([[self.compression, self.low, self.high], self.means, self.weights]).astype(float).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Unpacks a sketch made with to_bytes
+        """
+
+        packed = np.frombuffer(data, dtype=float)
+        size = (len(packed) - 3) // 2
+
+        return cls(int(packed[0]), packed[3:3+size].copy(), packed[3+size:].copy(), packed[1], packed[2])
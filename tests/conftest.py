@@ -0,0 +1,35 @@
+# Modules in src import each other by name, so tests import them the same way
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import pytest
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """
+    In-memory mongomock server, every DB wrapper built during the test shares it
+    """
+
+    mongomock = pytest.importorskip('mongomock')
+    import db
+
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(db, 'MongoClient', lambda *args, **kwargs: client)
+
+    return client
+
+@pytest.fixture
+def processing_db(mongo):
+
+    import db
+
+    return db.ProcessingDB()
+
+@pytest.fixture
+def ingestion_db(mongo):
+
+    import db
+
+    return db.IngestionDB()
@@ -0,0 +1,88 @@
+# Daily player activity buckets kept alongside processed match players
+
+from datetime import date, datetime, time, timedelta
+
+def match_players(match_id, day, players, hour=12):
+    """
+    Processed match players of one match started on day
+    """
+
+    start = datetime.combine(day, time(hour))
+
+    return [{'_id':f'{match_id}_{player}', 'match_id':match_id, 'player_id':player, 'match_start_time':start} for player in players]
+
+def test_buckets_hold_distinct_matches_and_players(processing_db):
+
+    today = date.today()
+    processing_db.upsert_match_players(match_players('m1', today, ['psn_a', 'psn_b']))
+    processing_db.upsert_match_players(match_players('m2', today, ['psn_b', 'psn_c'], hour=20))
+    # Reprocessing a match, and a player row without a start time, adds nothing
+    processing_db.upsert_match_players(match_players('m1', today, ['psn_a', 'psn_b']))
+    processing_db.update_player_activity([{'match_id':'m3', 'player_id':'psn_d'}])
+
+    buckets = list(processing_db.player_activity.find())
+    assert len(buckets) == 1
+    assert buckets[0]['_id'] == today.strftime('%Y-%m-%d')
+    assert buckets[0]['day'] == datetime.combine(today, time())
+    assert sorted(buckets[0]['matches']) == ['m1', 'm2']
+    assert sorted(buckets[0]['players']) == ['psn_a', 'psn_b', 'psn_c']
+
+def test_active_players_and_counts_cover_the_window(processing_db):
+
+    today = date.today()
+    processing_db.upsert_match_players(match_players('m1', today, ['psn_a', 'psn_b']))
+    processing_db.upsert_match_players(match_players('m2', today - timedelta(days=3), ['psn_b', 'psn_c']))
+    processing_db.upsert_match_players(match_players('m3', today - timedelta(days=3), ['psn_c']))
+    processing_db.upsert_match_players(match_players('m4', today - timedelta(days=30), ['psn_d']))
+
+    assert processing_db.get_active_players(0) == {'psn_a', 'psn_b'}
+    assert processing_db.get_active_players(3) == {'psn_a', 'psn_b', 'psn_c'}
+    assert processing_db.get_active_players(30) == {'psn_a', 'psn_b', 'psn_c', 'psn_d'}
+
+    counts = processing_db.get_activity_counts(7)
+    assert list(counts['day']) == [datetime.combine(today - timedelta(days=3), time()), datetime.combine(today, time())]
+    assert list(counts['matches']) == [2, 1]
+    assert list(counts['players']) == [2, 2]
+
+def test_migration_rebuilds_only_without_buckets(processing_db, monkeypatch):
+
+    rebuilds = []
+    monkeypatch.setattr(processing_db, 'rebuild_player_activity', lambda recency_window: rebuilds.append(recency_window))
+
+    assert processing_db.migrate_player_activity()
+    assert rebuilds == [processing_db.ACTIVITY_RETENTION]
+
+    processing_db.upsert_match_players(match_players('m1', date.today(), ['psn_a']))
+    assert not processing_db.migrate_player_activity()
+    assert rebuilds == [processing_db.ACTIVITY_RETENTION]
+
+def test_recent_player_sample_draws_without_replacement(processing_db):
+
+    today = date.today()
+    recent = [f'psn_{i}' for i in range(40)]
+    # Players show up in several matches and days, each can still only be drawn once
+    for i in range(8):
+        processing_db.upsert_match_players(match_players(f'm{i}', today - timedelta(days=i % 3), recent[i*5:i*5+10]))
+    processing_db.upsert_match_players(match_players('old', today - timedelta(days=30), ['psn_old']))
+
+    sample = processing_db.get_recent_player_sample(recency_window=5, n=15)
+    assert len(sample) == len(set(sample)) == 15
+    assert set(sample) <= set(recent)
+
+    everyone = processing_db.get_recent_player_sample(recency_window=5, n=100)
+    assert sorted(everyone) == sorted(recent)
+    assert processing_db.get_recent_player_sample(recency_window=5, n=0) == []
+
+def test_recent_player_sample_never_picks_excluded(processing_db):
+
+    today = date.today()
+    players = [f'psn_{i}' for i in range(30)]
+    processing_db.upsert_match_players(match_players('m1', today, players))
+    exclude = set(players[:20]) | {'psn_unknown'}
+
+    for _ in range(5):
+        sample = processing_db.get_recent_player_sample(n=8, exclude=exclude)
+        assert len(sample) == len(set(sample)) == 8
+        assert not set(sample) & exclude
+
+    assert sorted(processing_db.get_recent_player_sample(n=20, exclude=exclude)) == sorted(players[20:])
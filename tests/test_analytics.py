@@ -0,0 +1,162 @@
+# Match player metrics written back by AnalyticsProcessor
+
+import copy
+import datetime
+import random
+import pytest
+
+from analytics import AnalyticsProcessor, MatchPlayerProcessor
+
+def make_match_players(n, seed):
+    """
+    Processed match players missing some or all of their metrics
+    """
+
+    rnd = random.Random(seed)
+    match_players = [{'_id':f'psn_m_p{i}', 'score':rnd.randint(0, 9000), 'score_per_min':rnd.choice([0, rnd.random()*800]),
+                      'kills':rnd.randint(0, 60), 'deaths':rnd.randint(0, 30), 'team_status':rnd.choice(['won', 'lost', 'dnf']),
+                      'game_duration_m':rnd.choice(['23m 14s', '1h 3m', '9m 0s', '0m 40s'])} for i in range(n)]
+    for player in match_players[:n//5]:
+        player['player_time'] = 5.0
+    for player in match_players[n//5:n//4]:
+        player['duration_m'] = 12.0
+
+    return match_players
+
+def reference_metrics(match_players, process_all=False):
+    """
+    The metrics one player at a time, each family over what it's missing, in the order the processor writes them
+    """
+
+    match_players = copy.deepcopy(match_players)
+    for x in match_players:
+        if process_all or 'player_time' not in x:
+            x['player_time'] = x['score']/max(x['score_per_min'], 1)
+
+    for x in match_players:
+        if x['team_status'] != 'dnf' and (process_all or 'AER' not in x):
+            x['aggression_rating'] = .005*min((x['score'] + (100*x['kills']))/max(x['player_time'], 1), 1000)
+            x['efficiency_rating'] = 5*min((x['score'] + (100*x['kills']))/max(x['deaths'], 1), 1600)/1600
+            x['AER'] = x['aggression_rating'] + x['efficiency_rating']
+
+    for x in match_players:
+        if process_all or 'duration_m' not in x:
+            if 'h' not in x['game_duration_m']:
+                minutes, seconds = x['game_duration_m'].split('m ')
+                x['duration_m'] = int(minutes) + int(seconds.split('s')[0])/60
+            else:
+                hours, minutes = x['game_duration_m'].split('h ')
+                x['duration_m'] = int(hours)*60 + int(minutes.split('m')[0])
+            x['adj_spm'] = x['score']/max(x['duration_m'], 1)
+            x['adj_kpm'] = x['kills']/max(x['duration_m'], 1)
+
+    return match_players
+
+def stored_match_players(processing_db):
+
+    return [{k:v for k, v in x.items() if k != 'last_updated'} for x in processing_db.processed_match_players.find({}, sort=[('_id', 1)])]
+
+@pytest.mark.parametrize('process_all', [False, True])
+def test_metrics_match_per_row_computation(processing_db, process_all):
+
+    match_players = make_match_players(300, 0)
+    processing_db.processed_match_players.insert_many(copy.deepcopy(match_players))
+
+    AnalyticsProcessor(process_all=process_all).run()
+
+    expected = sorted(reference_metrics(match_players, process_all), key=lambda x: x['_id'])
+    assert stored_match_players(processing_db) == [pytest.approx(x) for x in expected]
+
+def test_metrics_are_only_computed_once(processing_db):
+
+    processing_db.processed_match_players.insert_many(make_match_players(50, 1))
+    AnalyticsProcessor().run()
+    first = stored_match_players(processing_db)
+
+    processing_db.processed_match_players.update_many({}, {'$set':{'score':0}})
+    AnalyticsProcessor().run()
+
+    assert [{k:v for k, v in x.items() if k != 'score'} for x in stored_match_players(processing_db)] == \
+           [{k:v for k, v in x.items() if k != 'score'} for x in first]
+
+BREAKTHROUGH_REF = {('Arras', 'UnitedKingdom'):'Attack', ('Arras', 'Germany'):'Defend',
+                    ('Hamada', 'UnitedKingdom'):'Defend', ('Hamada', 'Germany'):'Attack',
+                    ('Arras', 'Unknown'):'Unknown', ('Hamada', 'Unknown'):'Unknown'}
+
+def make_parsed_matches(n, seed):
+    """
+    Matches as MatchParser writes them, stats still tracker formatted. Scores repeat so ranks tie,
+    and later players fall into the Unknown (dnf) group.
+    """
+
+    rnd = random.Random(seed)
+    matches = []
+    for i in range(n):
+        match = {'_id':f'psn_{seed}_{i}', 'map':rnd.choice(['Arras', 'Hamada']), 'mode':rnd.choice(['Breakthrough', 'Breakthrough', 'Conquest']),
+                 'duration':rnd.choice(['23m 14s', '1h 3m']), 'datetime':'10/12/21 @ 8:15 PM', 'server_rules':'Official',
+                 'server_type':'Ranked', 'team_1':'UnitedKingdom', 'team_2':'Germany', 'winner':'UnitedKingdom', 'players':[]}
+        for j in range(rnd.randint(1, 14)):
+            team, team_status = rnd.choice([('UnitedKingdom', 'won')]*3 + [('Germany', 'lost')]*3 + [('Unknown', 'dnf')])
+            player = {'player_id':f'psn_p{j}', 'team':team, 'team_status':team_status,
+                      'longest_headshot':rnd.choice([f'{rnd.randint(0, 999)}m', f'{rnd.randint(1, 3)}k'])}
+            for stat in MatchPlayerProcessor.PLAYER_STATS:
+                player[stat] = rnd.choice([f'{rnd.randint(0, 99999):,}', f'{rnd.random()*900:.1f}', f'{rnd.random()*100:.1f}%'])
+            player['score'] = rnd.choice(['1,000', '2,500', f'{rnd.randint(0, 30000):,}'])
+            match['players'].append(player)
+        matches.append(match)
+
+    return matches
+
+def reference_process_players(match, start_time):
+    """
+    The documents written one player at a time, before players were processed as columns
+    """
+
+    def stat_parse(number):
+        clean = number.replace(',', '')
+        if '%' not in clean:
+            return float(clean) if '.' in clean else int(clean)
+        return float(clean.replace('%', ''))/100
+
+    out = []
+    for player in match['players']:
+        processed = {'_id':match['_id']+'_'+player['player_id'], 'match_id':match['_id'], 'map':match['map'],
+                     'mode':match['mode'], 'game_duration_m':match['duration']}
+        processed.update({k:player[k] for k in ['team', 'team_status', 'player_id']})
+        processed.update({k:stat_parse(player[k]) for k in MatchPlayerProcessor.PLAYER_STATS})
+        processed['longest_headshot'] = int(player['longest_headshot'].split('m')[0]) if 'k' not in player['longest_headshot'] else int(player['longest_headshot'].split('k')[0])*1000
+        processed['true_deaths'] = processed['deaths']+processed['revives_recieved']
+        processed['true_kills_per_death'] = processed['kills']/max([processed['true_deaths'], 1])
+        out.append(processed)
+
+    # Score ranks, a tie takes the last place it covers
+    ranks = {group:{score:j+1 for j, score in enumerate(sorted([x['score'] for x in out if group is None or x['team'] == group], reverse=True))}
+             for group in [None, match['team_1'], match['team_2'], 'Unknown']}
+    for player in out:
+        player['overall_rank'] = ranks[None][player['score']]
+        player['team_rank'] = ranks[player['team'] if player['team'] in ranks else 'Unknown'][player['score']]
+        player['match_start_time'] = start_time
+        if player['mode'] == 'Breakthrough':
+            player['team_orientation'] = BREAKTHROUGH_REF[(player['map'], player['team'])]
+
+    return out
+
+def test_process_players_matches_per_player_documents(processing_db, tmp_path):
+
+    ref_path = tmp_path/'breakthrough_ref.csv'
+    ref_path.write_text('map,team,orientation\n' + ''.join(f'{m},{t},{o}\n' for (m, t), o in BREAKTHROUGH_REF.items()))
+    processor = MatchPlayerProcessor()
+    processor.breakthrough_ref_path = str(ref_path)
+
+    matches = make_parsed_matches(60, 0)
+    processed_matches = [processor.clean_overall_match_stats(match) for match in matches]
+    expected = [player for match, processed in zip(matches, processed_matches) for player in reference_process_players(match, processed['start_time'])]
+
+    actual = processor.process_players(matches, processed_matches)
+
+    assert len(actual) == len(expected) > 300
+    for a, e in zip(actual, expected):
+        assert list(a) == list(e) # same keys in the same order
+        assert a == e
+        assert [type(x) for x in a.values()] == [type(x) for x in e.values()], a['_id']
+    assert processed_matches[0]['start_time'] == datetime.datetime(2021, 10, 12, 20, 15)
@@ -0,0 +1,228 @@
+# AnalyticsDB star schema builds, over match players in mongomock
+
+import random
+import sqlite3
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pytest
+
+from db import AnalyticsDB
+
+def make_match_players(n, seed, players_per_match=20):
+    """
+    Processed match players with the fields the fact table is built from
+    """
+
+    rnd = random.Random(seed)
+    match_players = []
+    for i in range(n):
+        match_id = f'psn_{seed}_{i//players_per_match}'
+        match_players.append({'_id':f'{match_id}_p{i}', 'match_id':match_id, 'player_id':f'psn_p{rnd.randint(0, 50)}',
+                              'map':rnd.choice(['Arras', 'Hamada', 'Twisted Steel']), 'mode':'Breakthrough',
+                              'team':rnd.choice(['UnitedKingdom', 'Germany']), 'team_status':rnd.choice(['won', 'lost', 'dnf']),
+                              'score':rnd.randint(0, 9000), 'score_per_min':rnd.random()*800, 'kills':rnd.randint(0, 60),
+                              'kills_per_min':rnd.random()*3, 'kills_per_death':rnd.random()*4, 'true_deaths':rnd.randint(0, 30),
+                              'true_kills_per_death':rnd.random()*3, 'orders_completed':rnd.randint(0, 3),
+                              'match_start_time':datetime.now() - timedelta(days=rnd.randint(0, 200), minutes=rnd.randint(0, 1440))})
+
+    return match_players
+
+def build(out_dir, parquet_dir, parquet=True):
+
+    analytics_db = AnalyticsDB(parquet=parquet)
+    analytics_db.out_dir = str(out_dir)
+    analytics_db.parquet_dir = str(parquet_dir)+'/'
+
+    return analytics_db
+
+def read_table(path, table, key):
+
+    con = sqlite3.connect(str(path))
+    table = pd.read_sql(f'SELECT * FROM {table}', con).set_index(key).sort_index()
+    con.close()
+
+    return table
+
+def reference_fact(match_players):
+    """
+    The fact table as it was built before typed chunks, one frame of every document with string keys
+    """
+
+    df = pd.DataFrame(match_players).fillna(0)
+    df.rename(columns={'_id':'match_player_id'}, inplace=True)
+    df['match_team_id'] = df['match_id'] + '_' + df['team']
+    df['match_team_status_id'] = df['match_id'] + '_' + df['team_status']
+    df['map_mode'] = df['map'] + '_' + df['mode']
+
+    df['player_time'] = (df['score'].div(df['score_per_min'])).replace(np.nan, 0)
+    df['aggression_rating'] = 5*(df['score'] + (100*df['kills'])).div(df['player_time']).replace(np.nan, 0).replace(np.inf, 0).clip(0, 1000)/1000
+    df['efficiency_rating'] = 5*(df['score'] + (100*df['kills'])).div(df['true_deaths'].replace(0, 1)).clip(0, 1600)/1600
+    df['AER'] = df['aggression_rating'] + df['efficiency_rating']
+    df['bf4_match_skill'] = 1000*((.6*(df['score_per_min'].clip(0, 1000)/1000)) + (.3*(df['kills_per_min'].clip(0, 3)/3)) + (.1*(df['kills_per_death'].clip(0, 5)/5)))
+    df['bf4_match_skill_adj'] = 1000*((.6*(df['score_per_min'].clip(0, 1000)/1000)) + (.3*(df['kills_per_min'].clip(0, 3)/3)) + (.1*(df['true_kills_per_death'].clip(0, 5)/5)))
+    df['inactive_squad'] = df['orders_completed'].clip(0, 1)
+
+    return df.set_index('match_player_id').sort_index()
+
+def reference_relative_metrics(df):
+    """
+    Map mode normalization with a groupby transform and percentiles with pd.qcut, as before running stats
+    """
+
+    active = df[df.team_status != 'dnf']
+    norm = active[AnalyticsDB.NORM_VARS+['map_mode']].groupby('map_mode').transform(lambda x: (x - x.mean()) / x.std())
+    for var in AnalyticsDB.NORM_VARS:
+        df.loc[active.index, 'mm_adj_'+var] = (norm[var]*active[var].std()) + active[var].mean()
+
+    for var in AnalyticsDB.PCT_VARS:
+        df[var+'_pctl'] = pd.qcut(df[var], 100, duplicates='drop', labels=False)
+
+    return df
+
+def assert_same_values(actual, expected, columns):
+    """
+    Column values agree whatever their dtypes, numbers to float precision
+    """
+
+    for col in columns:
+        if pd.api.types.is_numeric_dtype(expected[col]) and not pd.api.types.is_bool_dtype(expected[col]):
+            np.testing.assert_allclose(actual[col].astype(float), expected[col].astype(float), err_msg=col)
+        else:
+            assert actual[col].astype(object).tolist() == expected[col].astype(object).tolist(), col
+
+@pytest.fixture(autouse=True)
+def no_dim_match(monkeypatch):
+    """
+    dim_match sums inactive_squad_players, which processed match players don't carry, leave it empty here
+    """
+
+    monkeypatch.setattr(AnalyticsDB, 'gen_dim_match', lambda self, fact=None, match_filter={}: setattr(self, 'dim_match', pd.DataFrame({'_id':[]})))
+
+def test_incremental_refresh_matches_full_reload(processing_db, tmp_path):
+
+    processing_db.upsert_match_players(make_match_players(400, 1))
+    build(tmp_path/'incremental.db', tmp_path/'parquet').reload(incremental=True)
+
+    # New matches, and rescored players from matches already loaded
+    new = make_match_players(100, 2) + [dict(x, score=x['score']+1) for x in make_match_players(400, 1)[:30]]
+    processing_db.upsert_match_players(new)
+    incremental = build(tmp_path/'incremental.db', tmp_path/'parquet')
+    incremental.reload(incremental=True)
+
+    full = build(tmp_path/'full.db', tmp_path/'full_parquet', parquet=False)
+    full.reload()
+
+    inc_fact = read_table(tmp_path/'incremental.db', 'fact_match_players', 'match_player_id')
+    full_fact = read_table(tmp_path/'full.db', 'fact_match_players', 'match_player_id')
+    assert len(inc_fact) == len(full_fact) == 500
+
+    # Rows already stored keep their relative metrics until a full reload, new rows get them against the whole table
+    relative = full.relative_columns()
+    plain = [c for c in full_fact.columns if c not in relative]
+    pd.testing.assert_frame_equal(inc_fact[plain], full_fact[plain])
+    new_ids = [x['_id'] for x in new]
+    np.testing.assert_allclose(inc_fact.loc[new_ids, relative].astype(float), full_fact.loc[new_ids, relative].astype(float))
+
+    pd.testing.assert_frame_equal(read_table(tmp_path/'incremental.db', 'dim_player', 'player_id'),
+                                  read_table(tmp_path/'full.db', 'dim_player', 'player_id'))
+
+    # Benchmarks of stored rows' mm_adj_ columns also wait for a full reload
+    con = sqlite3.connect(str(tmp_path/'incremental.db'))
+    inc_bench = pd.read_sql('SELECT * FROM dim_benchmarks', con)
+    con.close()
+    con = sqlite3.connect(str(tmp_path/'full.db'))
+    full_bench = pd.read_sql('SELECT * FROM dim_benchmarks', con)
+    con.close()
+    plain_bench = [c for c in full_bench.columns if '_mm_adj_' not in c]
+    assert list(inc_bench.columns) == list(full_bench.columns)
+    pd.testing.assert_frame_equal(inc_bench[plain_bench], full_bench[plain_bench])
+
+    inc_stats = read_table(tmp_path/'incremental.db', 'norm_stats', ['group', 'var'])
+    full_stats = read_table(tmp_path/'full.db', 'norm_stats', ['group', 'var'])
+    pd.testing.assert_index_equal(inc_stats.index, full_stats.index)
+    np.testing.assert_allclose(inc_stats.astype(float), full_stats[inc_stats.columns].astype(float))
+
+def test_incremental_refresh_without_watermark_runs_full_reload(processing_db, tmp_path):
+
+    processing_db.upsert_match_players(make_match_players(100, 3))
+    analytics_db = build(tmp_path/'analytics.db', tmp_path/'parquet', parquet=False)
+    analytics_db.reload(incremental=True)
+
+    con = sqlite3.connect(str(tmp_path/'analytics.db'))
+    assert analytics_db.get_watermark(con) is not None
+    con.close()
+    assert len(read_table(tmp_path/'analytics.db', 'fact_match_players', 'match_player_id')) == 100
+
+def test_refreshed_parquet_partitions_keep_the_fact_schema(processing_db, tmp_path):
+
+    processing_db.upsert_match_players(make_match_players(200, 4))
+    build(tmp_path/'analytics.db', tmp_path/'parquet').reload(incremental=True)
+    processing_db.upsert_match_players(make_match_players(40, 5))
+    analytics_db = build(tmp_path/'analytics.db', tmp_path/'parquet')
+    analytics_db.reload(incremental=True)
+
+    dataset = ds.dataset(str(tmp_path/'parquet'/'fact_match_players'), format='parquet')
+    schemas = {fragment.physical_schema.remove_metadata() for fragment in dataset.get_fragments()}
+    assert len(schemas) == 1
+    assert schemas.pop().field('match_start_time').type == pa.timestamp('us')
+
+    since = datetime.now() - timedelta(days=30)
+    recent = analytics_db.read_fact_parquet(columns=['match_player_id', 'match_start_time'], filters=[('match_start_time', '>=', since)])
+    stored = read_table(tmp_path/'analytics.db', 'fact_match_players', 'match_player_id')
+    assert len(recent) == (pd.to_datetime(stored['match_start_time']) >= since).sum()
+
+def test_fact_matches_single_frame_build(processing_db, tmp_path):
+
+    match_players = make_match_players(600, 6)
+    for player in match_players[::7]:
+        del player['true_kills_per_death'] # missing stats are zero filled
+    processing_db.upsert_match_players(match_players)
+
+    # Several chunks, categories have to line up across them
+    analytics_db = build(tmp_path/'analytics.db', tmp_path/'parquet', parquet=False)
+    fact = analytics_db.build_fact_columns(analytics_db.load_match_players({}, chunk_size=128)).set_index('match_player_id').sort_index()
+    expected = reference_fact(list(processing_db.processed_match_players.find({}, {'last_updated':0})))
+
+    assert set(expected.columns) <= set(fact.columns)
+    assert_same_values(fact, expected, expected.columns)
+    for col in ['match_id', 'player_id', 'map', 'mode', 'team', 'team_status']:
+        assert isinstance(fact[col].dtype, pd.CategoricalDtype), col
+
+def test_relative_metrics_match_transform_and_qcut(processing_db, tmp_path):
+
+    match_players = make_match_players(600, 7)
+    for player in match_players[::9]:
+        player['kills_per_death'] = 0 # ties at the bottom, qcut drops the duplicate edges
+    processing_db.upsert_match_players(match_players)
+
+    analytics_db = build(tmp_path/'analytics.db', tmp_path/'parquet', parquet=False)
+    analytics_db.gen_fact_match_players()
+    fact = analytics_db.fact_match_players.set_index('match_player_id').sort_index()
+    expected = reference_relative_metrics(reference_fact(list(processing_db.processed_match_players.find({}, {'last_updated':0}))))
+
+    assert_same_values(fact, expected, analytics_db.relative_columns())
+
+def test_benchmarks_by_map_mode(processing_db, tmp_path):
+
+    processing_db.upsert_match_players(make_match_players(3000, 8))
+    by_map_mode = build(tmp_path/'map_modes.db', tmp_path/'parquet', parquet=False)
+    by_map_mode.benchmark_map_modes = True
+    by_map_mode.reload()
+    overall = build(tmp_path/'overall.db', tmp_path/'parquet', parquet=False)
+    overall.reload()
+
+    bench = by_map_mode.dim_benchmarks.set_index('map_mode')
+    assert sorted(bench.index) == ['Arras_Breakthrough', 'Hamada_Breakthrough', 'Twisted Steel_Breakthrough', 'all']
+    pd.testing.assert_frame_equal(bench.loc[['all']].reset_index(drop=True), overall.dim_benchmarks)
+
+    # Finished rows from the window's whole days only
+    fact = by_map_mode.fact_match_players
+    rows = fact[(fact.team_status != 'dnf') & (fact.match_start_time >= by_map_mode.window_start())]
+    assert 0 < len(rows) < len(fact[fact.team_status != 'dnf'])
+    for map_mode, group in rows.groupby(rows['map_mode'].astype(str)):
+        for q, v in [(.5, 'score_per_min'), (.1, 'kills_per_min'), (.01, 'kills_per_death')]:
+            estimate = bench.loc[map_mode, 'TOP_'+str(q)[1:]+'_'+v]
+            assert abs((group[v] < estimate).mean() - (1-q)) < .02, (map_mode, v)
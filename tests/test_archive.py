@@ -0,0 +1,147 @@
+# Compressed report archive, segments, dedup and the index
+
+import os
+import random
+import threading
+
+import pytest
+
+pytest.importorskip('zstandard')
+from archive import ReportArchive
+
+def page(i, size=4000):
+    """
+    Report sized html that doesn't compress away to nothing
+    """
+
+    rng = random.Random(i)
+
+    return f'<html><body id="{i}">' + ''.join(rng.choice('abcdefghij <>/') for _ in range(size)) + '</body></html>'
+
+def test_pages_roll_over_into_new_segments(tmp_path):
+
+    archive = ReportArchive(str(tmp_path), segment_size=10000)
+    pages = {f'psn_{i}':page(i) for i in range(12)}
+    for match_id, html in pages.items():
+        archive.put(match_id, html)
+
+    segments = sorted(x for x in os.listdir(tmp_path) if x.endswith('.zst'))
+    assert len(segments) > 1
+    # Segments only go past segment_size by the frame that filled them
+    assert all(os.path.getsize(tmp_path/x) < 10000 + 4000 for x in segments)
+    assert {match_id:archive.get(match_id) for match_id in pages} == pages
+
+def test_identical_pages_are_stored_once(tmp_path):
+
+    archive = ReportArchive(str(tmp_path))
+    archive.put('psn_a', page(1))
+    archive.put('psn_b', page(1))
+    archive.put('psn_c', page(2))
+
+    stats = archive.stats()
+    assert (stats['reports'], stats['pages']) == (3, 2)
+    assert stats['stored_bytes'] < stats['raw_bytes']
+    assert archive.get('psn_a') == archive.get('psn_b') == page(1)
+
+    # Replacing a page points the match at the new one
+    archive.put('psn_b', page(3))
+    assert archive.get('psn_b') == page(3)
+    assert archive.get('psn_a') == page(1)
+
+    with pytest.raises(KeyError):
+        archive.get('psn_missing')
+
+def test_second_instance_reads_while_first_appends(tmp_path):
+
+    writer = ReportArchive(str(tmp_path), segment_size=20000)
+    reader = ReportArchive(str(tmp_path), segment_size=20000)
+    done = threading.Event()
+
+    def append():
+        for i in range(40):
+            writer.put(f'psn_{i:02d}', page(i))
+        done.set()
+
+    thread = threading.Thread(target=append)
+    thread.start()
+    checked = set()
+    while not done.is_set() or len(checked) < 40:
+        for match_id in reader.ids():
+            if match_id not in checked:
+                assert reader.get(match_id) == page(int(match_id[4:]))
+                checked.add(match_id)
+    thread.join()
+
+    assert len(checked) == 40
+
+def test_parsed_flags(tmp_path):
+
+    archive = ReportArchive(str(tmp_path))
+    for i in range(5):
+        archive.put(f'psn_{i}', page(i))
+    archive.mark_parsed(['psn_1', 'psn_3'])
+
+    assert archive.ids() == [f'psn_{i}' for i in range(5)]
+    assert archive.ids(parsed=True) == ['psn_1', 'psn_3']
+    assert archive.ids(parsed=False) == ['psn_0', 'psn_2', 'psn_4']
+
+    archive.mark_parsed(['psn_3'], parsed=False)
+    assert archive.ids(parsed=True) == ['psn_1']
+
+    # Saving a match again means it needs parsing again
+    archive.put('psn_1', page(10))
+    assert archive.ids(parsed=True) == []
+
+def loose_files(directory, ids):
+
+    os.makedirs(directory, exist_ok=True)
+    for i in ids:
+        with open(os.path.join(directory, f'psn_{i}.html'), 'w', encoding='utf-8') as f:
+            f.write(page(i))
+
+def test_import_dir(tmp_path):
+
+    archive = ReportArchive(str(tmp_path/'archive'))
+    loose_files(tmp_path/'unparsed', range(3))
+    loose_files(tmp_path/'parsed', range(3, 5))
+    (tmp_path/'parsed'/'notes.txt').write_text('not a report')
+
+    assert not archive.imported(str(tmp_path/'unparsed'))
+    assert archive.import_dir(str(tmp_path/'unparsed')) == 3
+    assert archive.import_dir(str(tmp_path/'parsed'), parsed=True, remove=True) == 2
+
+    assert archive.imported(str(tmp_path/'unparsed')) and archive.imported(str(tmp_path/'parsed'))
+    assert archive.ids(parsed=False) == ['psn_0', 'psn_1', 'psn_2']
+    assert archive.ids(parsed=True) == ['psn_3', 'psn_4']
+    assert all(archive.get(f'psn_{i}') == page(i) for i in range(5))
+    assert os.listdir(tmp_path/'unparsed') != [] and os.listdir(tmp_path/'parsed') == ['notes.txt']
+
+def test_interrupted_import_finishes_on_the_next_run(tmp_path, monkeypatch):
+
+    archive = ReportArchive(str(tmp_path/'archive'))
+    loose_files(tmp_path/'parsed', range(6))
+    put = archive.put
+    calls = []
+
+    def crash_on_fourth(match_id, html, parsed=False):
+        calls.append(match_id)
+        if len(calls) == 4:
+            raise KeyboardInterrupt
+        put(match_id, html, parsed)
+
+    monkeypatch.setattr(archive, 'put', crash_on_fourth)
+    with pytest.raises(KeyboardInterrupt):
+        archive.import_dir(str(tmp_path/'parsed'), parsed=True)
+    monkeypatch.undo()
+
+    # Whatever went in went in parsed, and the folder isn't recorded as imported
+    assert archive.ids(parsed=True) == ['psn_0', 'psn_1', 'psn_2']
+    assert archive.ids(parsed=False) == []
+    assert not archive.imported(str(tmp_path/'parsed'))
+
+    # A page saved again since is left as it is
+    archive.put('psn_1', page(11))
+    assert archive.import_dir(str(tmp_path/'parsed'), parsed=True) == 3
+    assert archive.imported(str(tmp_path/'parsed'))
+    assert archive.ids(parsed=True) == ['psn_0', 'psn_2', 'psn_3', 'psn_4', 'psn_5']
+    assert archive.get('psn_1') == page(11)
@@ -0,0 +1,22 @@
+# Reading fields back out of archived reports for backfills
+
+from backfill import read_fields
+from scrapers import MatchParser
+from test_parsers import load_report
+
+def test_read_fields_keeps_only_fields_the_report_has(tmp_path):
+
+    parser = MatchParser(connect=False, archive_dir=str(tmp_path))
+    for report in ['two_teams', 'one_team']:
+        parser.archive.put(report, load_report(report)[0])
+
+    assert read_fields(parser, 'two_teams', ['map', 'team_1', 'winner']) == ('two_teams', {'map':'Arras', 'team_1':'UnitedKingdom', 'winner':'UnitedKingdom'}, None)
+    assert read_fields(parser, 'one_team', ['map', 'team_1', 'winner']) == ('one_team', {'map':'Arras'}, None)
+
+def test_read_fields_reports_failures(tmp_path):
+
+    parser = MatchParser(connect=False, archive_dir=str(tmp_path))
+    match, fields, error = read_fields(parser, 'psn_missing', ['map'])
+
+    assert (match, fields) == ('psn_missing', None)
+    assert 'KeyError' in error
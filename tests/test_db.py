@@ -0,0 +1,113 @@
+# Bulk write buffering shared by the Mongo wrappers
+
+import pytest
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from db import BulkWriter, QueryPlanError, check_query_plans, plan_stages
+
+class ConcernFailure:
+    """
+    Collection whose writes land but whose write concern isn't met
+    """
+
+    name = 'concern'
+
+    def bulk_write(self, ops, ordered=False):
+        raise BulkWriteError({'writeErrors':[], 'writeConcernErrors':[{'code':64, 'errmsg':'waiting for replication timed out'}]})
+
+def test_flush_writes_in_batches(processing_db):
+
+    with BulkWriter(processing_db.matches, batch_size=3) as writer:
+        for i in range(7):
+            writer.add(UpdateOne({'_id':f'psn_{i}'}, {'$set':{'map':'Arras'}}, upsert=True))
+
+    assert (writer.batches, writer.written, writer.errors) == (3, 7, 0)
+    assert processing_db.matches.count_documents({}) == 7
+
+def test_failed_writes_are_raised_after_the_batch(processing_db):
+
+    processing_db.matches.insert_one({'_id':'psn_0'})
+
+    with pytest.raises(BulkWriteError):
+        with BulkWriter(processing_db.matches) as writer:
+            writer.add(InsertOne({'_id':'psn_0'}))
+            writer.add(InsertOne({'_id':'psn_1'}))
+
+    assert (writer.written, writer.errors, writer.ops) == (1, 1, [])
+    assert processing_db.matches.count_documents({}) == 2
+
+def test_write_concern_errors_are_raised():
+
+    writer = BulkWriter(ConcernFailure())
+    writer.add(UpdateOne({'_id':'psn_0'}, {'$set':{'map':'Arras'}}))
+
+    with pytest.raises(BulkWriteError):
+        writer.flush()
+    assert writer.ops == []
+
+def test_nothing_is_flushed_after_an_error(processing_db):
+
+    with pytest.raises(ValueError):
+        with BulkWriter(processing_db.matches) as writer:
+            writer.add(UpdateOne({'_id':'psn_0'}, {'$set':{'map':'Arras'}}, upsert=True))
+            raise ValueError('match failed to process')
+
+    assert processing_db.matches.count_documents({}) == 0
+
+# Winning plans as explain returns them
+IXSCAN = {'stage':'FETCH', 'inputStage':{'stage':'IXSCAN', 'indexName':'crawl_due_1'}}
+SORTED_COLLSCAN = {'stage':'SORT', 'inputStage':{'stage':'COLLSCAN', 'direction':'forward'}}
+OR_WITH_COLLSCAN = {'stage':'SUBPLAN', 'inputStage':{'stage':'FETCH', 'inputStage':{'stage':'OR', 'inputStages':[
+    {'stage':'IXSCAN', 'indexName':'player_time_1'}, {'stage':'COLLSCAN', 'filter':{'duration_m':{'$exists':False}}}]}}}
+
+class ExplainDB:
+    """
+    Database whose explain returns a canned winning plan per collection
+    """
+
+    name = 'bfv_test'
+
+    def __init__(self, plans):
+        self.plans = plans
+        self.explained = []
+
+    def command(self, name, command, verbosity=None):
+        assert (name, verbosity) == ('explain', 'queryPlanner')
+        self.explained.append(command)
+        return {'queryPlanner':{'winningPlan':self.plans[command['find']]}}
+
+def test_plan_stages_walks_nested_plans():
+
+    assert plan_stages(IXSCAN) == ['FETCH', 'IXSCAN']
+    assert plan_stages(SORTED_COLLSCAN) == ['SORT', 'COLLSCAN']
+    assert plan_stages(OR_WITH_COLLSCAN) == ['SUBPLAN', 'FETCH', 'OR', 'IXSCAN', 'COLLSCAN']
+
+def test_indexed_queries_pass():
+
+    db = ExplainDB({'players':IXSCAN, 'game_reports':IXSCAN})
+    assert check_query_plans(db, {'due':('players', {'crawl_due':{'$lte':1}}, [('crawl_due', 1)]),
+                                  'mode':('game_reports', {'mode':'Breakthrough'}, None)})
+    assert db.explained == [{'find':'players', 'filter':{'crawl_due':{'$lte':1}}, 'sort':[('crawl_due', 1)]},
+                            {'find':'game_reports', 'filter':{'mode':'Breakthrough'}}]
+
+def test_every_collection_scan_is_named():
+
+    db = ExplainDB({'players':IXSCAN, 'matches':SORTED_COLLSCAN, 'processed_match_players':OR_WITH_COLLSCAN})
+    queries = {'due':('players', {}, None), 'recent_matches':('matches', {}, None), 'metric_queue':('processed_match_players', {}, None)}
+
+    with pytest.raises(QueryPlanError) as error:
+        check_query_plans(db, queries)
+
+    assert "['recent_matches', 'metric_queue']" in str(error.value)
+    assert 'bfv_test' in str(error.value)
+    assert len(db.explained) == 3
+
+def test_processing_db_explains_its_hot_queries(processing_db, monkeypatch):
+
+    db = ExplainDB({x:IXSCAN for x in ['processed_match_players', 'player_activity']})
+    monkeypatch.setattr(processing_db, 'db', db)
+
+    assert processing_db.check_indexes()
+    assert [x['find'] for x in db.explained] == ['processed_match_players']*3 + ['player_activity']
+    assert db.explained[2]['filter'] == processing_db.METRIC_QUEUE
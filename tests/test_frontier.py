@@ -0,0 +1,79 @@
+# Crawl frontier scheduling on the ingestion players collection
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from frontier import CrawlFrontier
+
+def scheduled(ingestion_db, player):
+    """
+    Rate and days until the next crawl as record left them
+    """
+
+    doc = ingestion_db.players.find_one({'_id':player})
+
+    return doc['rate'], (doc['crawl_due'] - doc['last_crawled']).total_seconds()/86400
+
+def test_first_crawl_spreads_the_backlog_over_first_span(ingestion_db):
+
+    frontier = CrawlFrontier(ingestion_db)
+    ingestion_db.update_players(['psn_new'])
+    frontier.record({'psn_new':28, 'psn_unseen':0})
+
+    rate = (.3*28/14) + (.7*1)
+    assert scheduled(ingestion_db, 'psn_new') == (pytest.approx(rate), pytest.approx(10/rate))
+    assert scheduled(ingestion_db, 'psn_unseen') == (pytest.approx(.7), pytest.approx(10/.7))
+    assert ingestion_db.players.find_one({'_id':'psn_new'})['last_yield'] == 28
+
+def test_rate_is_an_ewma_of_matches_per_day(ingestion_db):
+
+    frontier = CrawlFrontier(ingestion_db)
+    now = datetime.now()
+    ingestion_db.players.insert_many([{'_id':'psn_a', 'rate':2, 'last_crawled':now - timedelta(days=4)},
+                                      {'_id':'psn_b', 'rate':2, 'last_crawled':now - timedelta(hours=2)},
+                                      {'_id':'psn_c', 'last_crawled':now - timedelta(days=5)}])
+    frontier.record({'psn_a':20, 'psn_b':6, 'psn_c':5})
+
+    # Spans shorter than min_interval count as min_interval, players without a rate start from prior_rate
+    expected = {'psn_a':(.3*20/4) + (.7*2), 'psn_b':(.3*6/1) + (.7*2), 'psn_c':(.3*5/5) + (.7*1)}
+    for player, rate in expected.items():
+        assert scheduled(ingestion_db, player) == (pytest.approx(rate, rel=1e-4), pytest.approx(10/rate, rel=1e-4))
+
+    # Each crawl moves the rate alpha of the way to the latest one
+    frontier.record({'psn_a':0})
+    assert scheduled(ingestion_db, 'psn_a')[0] == pytest.approx(.7*expected['psn_a'], rel=1e-4)
+
+def test_intervals_are_clamped(ingestion_db):
+
+    frontier = CrawlFrontier(ingestion_db, min_interval=1, max_interval=60)
+    ingestion_db.players.insert_many([{'_id':'psn_busy', 'rate':50, 'last_crawled':datetime.now() - timedelta(days=1)},
+                                      {'_id':'psn_quiet', 'rate':.01, 'last_crawled':datetime.now() - timedelta(days=30)}])
+    frontier.record({'psn_busy':100, 'psn_quiet':0})
+    assert scheduled(ingestion_db, 'psn_busy')[1] == pytest.approx(1)
+    assert scheduled(ingestion_db, 'psn_quiet')[1] == pytest.approx(60)
+
+    # No matches at all still gets a next crawl
+    frontier = CrawlFrontier(ingestion_db, prior_rate=0)
+    frontier.record({'psn_gone':0})
+    assert scheduled(ingestion_db, 'psn_gone') == (0, pytest.approx(60))
+
+def test_most_overdue_players_come_off_first(ingestion_db):
+
+    frontier = CrawlFrontier(ingestion_db)
+    now = datetime.now()
+    ingestion_db.players.insert_many([{'_id':'psn_due_1d', 'crawl_due':now - timedelta(days=1)},
+                                      {'_id':'psn_later', 'crawl_due':now + timedelta(days=1)},
+                                      {'_id':'psn_due_5d', 'crawl_due':now - timedelta(days=5)},
+                                      {'_id':'psn_never'},
+                                      {'_id':'psn_due_3d', 'crawl_due':now - timedelta(days=3)}])
+
+    # Players that were never scheduled sort ahead of every scheduled one
+    assert frontier.next(10) == ['psn_never', 'psn_due_5d', 'psn_due_3d', 'psn_due_1d']
+    assert frontier.next(2) == ['psn_never', 'psn_due_5d']
+    assert frontier.next(10, exclude={'psn_never', 'psn_due_3d'}) == ['psn_due_5d', 'psn_due_1d']
+    assert frontier.next(0) == []
+
+    # A crawl reschedules them into the future
+    frontier.record({'psn_never':3, 'psn_due_5d':3})
+    assert frontier.next(10) == ['psn_due_3d', 'psn_due_1d']
@@ -0,0 +1,82 @@
+# Reference tables and stat parsing shared by the processors
+
+import random
+
+import numpy as np
+import pytest
+
+from helpers import (distance_parse, distance_parse_column, duration_parse, duration_parse_column, get_breakthrough_ref,
+                     native_values, orientation_lookup, stat_parse, stat_parse_column)
+
+@pytest.mark.parametrize('encoding', ['utf-8', 'utf-8-sig'])
+def test_breakthrough_ref_reads_with_or_without_bom(tmp_path, encoding):
+
+    path = tmp_path/'breakthrough_ref.csv'
+    path.write_text('map,team,orientation\r\nArras,UnitedKingdom,Attack\r\nArras,Germany,Defend\r\n', encoding=encoding)
+
+    assert dict(get_breakthrough_ref(str(path))) == {('Arras', 'UnitedKingdom'):'Attack', ('Arras', 'Germany'):'Defend'}
+    assert list(orientation_lookup(['Arras', 'Arras', 'Arras'], ['Germany', 'UnitedKingdom', 'Germany'], str(path))) == ['Defend', 'Attack', 'Defend']
+
+    with pytest.raises(KeyError):
+        orientation_lookup(['Hamada'], ['Germany'], str(path))
+
+def test_stat_parsers():
+
+    assert stat_parse('1,478') == 1478
+    assert stat_parse('418.4') == pytest.approx(418.4)
+    assert duration_parse('23m 14s') == pytest.approx(23 + 14/60)
+    assert duration_parse('1h 3m') == 63
+
+@pytest.mark.parametrize('value, expected', [('1.2k', 1200), ('12k', 12000), ('1,2k', 12000), ('0.5k', 500),
+                                             ('45.3%', .453), ('100%', 1.0), ('0', 0), ('2,004,117', 2004117)])
+def test_stat_parse_forms(value, expected):
+
+    parsed = stat_parse(value)
+    assert parsed == pytest.approx(expected)
+    assert type(parsed) is type(expected)
+
+@pytest.mark.parametrize('value, expected', [('120m', 120), ('0m', 0), ('1k', 1000), ('1.2k', 1200), ('64.5m', 64.5)])
+def test_distance_parse(value, expected):
+
+    parsed = distance_parse(value)
+    assert parsed == pytest.approx(expected)
+    assert type(parsed) is type(expected)
+
+@pytest.mark.parametrize('duration', ['', '23m', '14s', 'n/a', None, 14])
+def test_unreadable_durations_raise(duration):
+
+    with pytest.raises(ValueError):
+        duration_parse(duration)
+    with pytest.raises(ValueError):
+        duration_parse_column(['23m 14s', duration])
+
+def fuzzed_values(seed=0, n=4000):
+    """
+    Tracker formatted stats, distances and durations in every form the tracker shows
+    """
+
+    rng = random.Random(seed)
+    stats = []
+    for _ in range(n):
+        stats.append(f'{rng.randint(0, 10**rng.randint(1, 7)):,}')
+        stats.append(f'{rng.uniform(0, 1000):.{rng.randint(1, 3)}f}')
+        stats.append(f'{rng.uniform(0, 100):.{rng.randint(0, 2)}f}%')
+        stats.append(f'{rng.uniform(0, 999):.{rng.randint(0, 2)}f}k')
+    distances = [f'{rng.randint(0, 999)}m' if rng.random() < .5 else f'{rng.uniform(0, 9):.{rng.randint(0, 1)}f}k' for _ in range(n)]
+    durations = [f'{rng.randint(0, 59)}m {rng.randint(0, 59)}s' if rng.random() < .7 else f'{rng.randint(1, 5)}h {rng.randint(0, 59)}m' for _ in range(n)]
+
+    return stats, distances, durations
+
+@pytest.mark.parametrize('scalar, column, kind', [(stat_parse, stat_parse_column, 0), (distance_parse, distance_parse_column, 1),
+                                                  (duration_parse, duration_parse_column, 2)])
+def test_column_parsers_agree_with_scalar_parsers(scalar, column, kind):
+
+    values = fuzzed_values()[kind]
+    expected = [scalar(x) for x in values]
+    parsed, is_int = column(values)
+
+    assert list(is_int) == [isinstance(x, int) for x in expected]
+    np.testing.assert_allclose(parsed, np.array(expected, dtype=float), rtol=1e-12)
+    native = native_values(parsed, is_int)
+    assert [type(x) for x in native] == [type(x) for x in expected]
+    assert [x for x, i in zip(native, is_int) if i] == [x for x in expected if isinstance(x, int)]
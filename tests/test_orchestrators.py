@@ -0,0 +1,190 @@
+# Threaded match pipeline, stage hand offs and shutdown
+
+import queue
+import threading
+import time
+
+import pytest
+
+import orchestrators
+
+class FakeDB:
+
+    def get_recently_crawled(self, crawl_window=7):
+        return set()
+
+    def get_recent_player_sample(self, **kwargs):
+        return []
+
+class FakeFrontier:
+
+    def __init__(self, db):
+        pass
+
+    def next(self, n, exclude=None):
+        return ['psn_player']
+
+class FakeRetriever:
+    """
+    Finds 120 breakthrough matches for every player
+    """
+
+    def __init__(self, **kwargs):
+        pass
+
+    def iter_get(self, players):
+        for player in players:
+            yield player, [f'psn_m{i}' for i in range(120)], ['Breakthrough']*120
+
+class FakeFetcher:
+
+    def close(self):
+        pass
+
+class FakeSaver:
+
+    parsed_matches = set()
+    archived_matches = set()
+    recycle_after = 30
+    browser_works = True
+
+    def __init__(self, **kwargs):
+        pass
+
+    def get_matches_for_retrieval(self):
+        return []
+
+    def new_fetcher(self):
+        if not self.browser_works:
+            raise RuntimeError('no browser')
+        return FakeFetcher()
+
+    def fetch(self, fetcher, match_id):
+        return True
+
+class FakeArchive:
+
+    root = None
+
+    def ids(self, parsed=None):
+        return []
+
+class FakeParser:
+
+    engine = 'lxml'
+
+    def __init__(self):
+        self.archive = FakeArchive()
+
+    def read(self, match_id, full=False, both=False):
+        return {}
+
+    def write(self, results, both=False):
+        pass
+
+class FakeProcessor:
+    """
+    Slow enough per batch for parsed matches to pile up, fails any batch holding a bad match
+    """
+
+    bad = {'psn_m13'}
+
+    def __init__(self, **kwargs):
+        self.batches = []
+        self.processed = []
+        self.caught_up = False
+        processors.append(self)
+
+    def process_batch(self, match_ids):
+        self.batches.append(list(match_ids))
+        time.sleep(.02)
+        if self.bad & set(match_ids):
+            raise KeyError(sorted(self.bad & set(match_ids)))
+        self.processed.extend(match_ids)
+        return len(match_ids)
+
+    def process_match(self, match_id):
+        return self.process_batch([match_id]) > 0
+
+    def get_matches_for_processing(self):
+        pass
+
+    def process(self):
+        self.caught_up = True
+
+processors = []
+
+@pytest.fixture
+def fake_stages(monkeypatch):
+
+    processors.clear()
+    for name, fake in [('IngestionDB', FakeDB), ('ProcessingDB', FakeDB), ('CrawlFrontier', FakeFrontier),
+                       ('MatchRetriever', FakeRetriever), ('MatchSaver', FakeSaver), ('MatchParser', FakeParser),
+                       ('MatchPlayerProcessor', FakeProcessor)]:
+        monkeypatch.setattr(orchestrators, name, fake)
+    monkeypatch.setattr(orchestrators, 'migrate', lambda pdb: None)
+    monkeypatch.setattr(orchestrators, 'check_indexes', lambda *dbs: None)
+
+def run_pipeline(timeout=20, **kwargs):
+    """
+    Runs pipeline_matches on a thread, failing instead of hanging the suite if it never returns
+    """
+
+    pipeline = threading.Thread(target=orchestrators.pipeline_matches, kwargs=kwargs, daemon=True)
+    pipeline.start()
+    pipeline.join(timeout)
+    assert not pipeline.is_alive(), 'pipeline hung'
+
+def test_parsed_matches_are_processed_in_batches(fake_stages):
+
+    run_pipeline(workers=2, queue_size=10)
+    processor = processors[0]
+
+    # The bad match's batch is retried one match at a time, only the bad match is lost
+    assert sorted(processor.processed) == sorted(f'psn_m{i}' for i in range(120) if i != 13)
+    assert max(len(x) for x in processor.batches) == 10
+    assert len(processor.batches) < 60
+    assert processor.caught_up
+
+def test_pipeline_shuts_down_when_no_backend_starts(fake_stages, monkeypatch):
+
+    # retrieve finds far more than the queues hold, with nobody fetching it would block forever on to_save
+    monkeypatch.setattr(FakeSaver, 'browser_works', False)
+    run_pipeline(workers=2, queue_size=5)
+
+    assert processors[0].batches == []
+    assert processors[0].caught_up
+
+def test_failed_stage_drains_its_inbox_and_closes_its_outbox():
+
+    inbox, outbox = queue.Queue(3), queue.Queue()
+
+    def fail():
+        raise RuntimeError('stage broke')
+
+    stage = orchestrators.run_stage('broken', fail, inbox, outbox)
+    for i in range(20):
+        inbox.put(i, timeout=5)
+    inbox.put(None, timeout=5)
+    stage.join(5)
+
+    assert not stage.is_alive()
+    assert inbox.empty()
+    assert outbox.get_nowait() is None
+
+def test_drain_batches_takes_what_is_waiting():
+
+    inbox = queue.Queue()
+    for i in range(7):
+        inbox.put(i)
+    batches = orchestrators.drain_batches(inbox, 3)
+
+    assert next(batches) == [0, 1, 2]
+    assert next(batches) == [3, 4, 5]
+    assert next(batches) == [6]
+
+    # An empty queue waits for the next item instead of handing out an empty batch
+    threading.Timer(.05, lambda: [inbox.put(x) for x in [7, 8, None]]).start()
+    rest = list(batches)
+    assert [x for batch in rest for x in batch] == [7, 8]
+    assert all(len(batch) > 0 for batch in rest)
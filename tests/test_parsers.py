@@ -0,0 +1,39 @@
+# Golden file tests, parsed reports against the output checked in next to them
+
+import json
+import os
+import pytest
+
+from scrapers import PARSER_ENGINES, REPORT_CONTAINERS, MatchParser, make_soup
+
+REPORTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports')
+
+def load_report(name):
+    """
+    Report html and its expected parse
+    """
+
+    with open(os.path.join(REPORTS_DIR, name+'.html'), encoding='utf-8') as f:
+        html = f.read()
+    with open(os.path.join(REPORTS_DIR, name+'.json'), encoding='utf-8') as f:
+        expected = json.load(f)
+
+    return html, expected
+
+@pytest.mark.parametrize('engine', list(PARSER_ENGINES))
+@pytest.mark.parametrize('report', ['three_teams', 'two_teams', 'one_team'])
+def test_parse_full_match(tmp_path, engine, report):
+
+    html, expected = load_report(report)
+    parser = MatchParser(engine=engine, connect=False, archive_dir=str(tmp_path))
+
+    assert parser.parse_full_match(make_soup(html, engine, REPORT_CONTAINERS)) == expected
+
+@pytest.mark.parametrize('report', ['three_teams', 'two_teams', 'one_team'])
+def test_read_archived_report(tmp_path, report):
+
+    html, expected = load_report(report)
+    parser = MatchParser(connect=False, archive_dir=str(tmp_path))
+    parser.archive.put('psn_match', html)
+
+    assert parser.read('psn_match', full=True) == dict(expected, _id='psn_match')
@@ -0,0 +1,169 @@
+# Fetch pool and report scrolling, against a local stand-in for the tracker
+
+import http.server
+import threading
+import time
+import urllib.request
+import pytest
+
+from backends import FetchBackend
+from db import IngestionDB
+from scrapers import COUNT_ENTRIES_SCRIPT, READ_ENTRIES_SCRIPT, MatchRetriever, MatchSaver
+from test_parsers import load_report
+
+class StandInBackend(FetchBackend):
+    """
+    Plain urllib fetches, the stand-in serves its reports already rendered
+    """
+
+    def __init__(self):
+
+        self.source = None
+
+    def load(self, url, ready_class, timeout=120):
+
+        self.source = None
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            self.source = response.read().decode('utf-8')
+
+        return True
+
+    def page_source(self):
+
+        return self.source
+
+@pytest.fixture
+def stand_in():
+    """
+    Local server with a report page per match id, (base url, pages, request log)
+    """
+
+    pages = {}
+    requests = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            match_id = self.path.strip('/')
+            requests.append(match_id)
+            if match_id not in pages:
+                self.send_error(404)
+                return
+            body = pages[match_id].encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f'http://127.0.0.1:{server.server_address[1]}', pages, requests
+
+    server.shutdown()
+    server.server_close()
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_get_all_saves_and_parses_every_match(processing_db, tmp_path, stand_in, workers):
+
+    base_url, pages, requests = stand_in
+    for i in range(12):
+        pages[f'psn_m{i}'] = load_report(['three_teams', 'two_teams'][i % 2])[0]
+    IngestionDB().upsert_matches(list(pages) + ['psn_gone'])
+
+    saver = MatchSaver(workers=workers, host_interval=0, recycle_after=2, url_fn=lambda match_id: f'{base_url}/{match_id}/',
+                       backend=StandInBackend, archive_dir=str(tmp_path/'archive'))
+    saver.get_all()
+
+    # Every served match is archived, parsed and written, the missing one is retried and left out
+    assert saver.archive.ids(parsed=True) == sorted(pages)
+    assert 'psn_gone' not in saver.archive
+    assert sorted(x['_id'] for x in processing_db.matches.find({}, {'_id':1})) == sorted(pages)
+    assert requests.count('psn_gone') == 10
+    assert all(requests.count(match_id) == 1 for match_id in pages)
+
+class ScrolledPage(FetchBackend):
+    """
+    A player's report list that loads page_size more entries a few polls after each scroll,
+    until the player has no more matches
+    """
+
+    supports_scripts = True
+    total = 50
+    page_size = 10
+    load_polls = 3 # count polls before a scroll's entries show up
+
+    def __init__(self):
+
+        self.loaded = self.page_size
+        self.pending = 0
+        self.scrolls = 0
+        self.reads = [] # start of every read
+
+    def execute_script(self, script, *args):
+
+        if script == COUNT_ENTRIES_SCRIPT:
+            if self.pending > 0:
+                self.pending -= 1
+                if self.pending == 0:
+                    self.loaded = min(self.loaded + self.page_size, self.total)
+            return self.loaded
+
+        if script == READ_ENTRIES_SCRIPT:
+            self.reads.append(args[0])
+            return [[f'/bfv/gamereport/psn/{i}', f'Breakthrough - Map {i}'] for i in range(self.total - 1, self.total - 1 - self.loaded, -1)][args[0]:]
+
+        self.scrolls += 1
+        self.pending = self.load_polls
+
+@pytest.fixture
+def retriever(ingestion_db):
+
+    retriever = MatchRetriever(wait=0, scroll_times=10, backend=ScrolledPage)
+    retriever.SCROLL_TIMEOUT = .5
+    retriever.SCROLL_POLL = .001
+
+    return retriever
+
+def test_scrolling_reads_only_new_entries(retriever):
+
+    matches, match_modes = retriever.scroll_on_user_page()
+
+    assert matches == [f'psn_{i}' for i in range(49, -1, -1)]
+    assert match_modes == ['Breakthrough']*50
+    assert retriever.backend.reads == [0, 10, 20, 30, 40]
+
+def test_scrolling_stops_at_a_known_match(retriever):
+
+    retriever.known_matches = {'psn_27', 'psn_3'}
+    matches, match_modes = retriever.scroll_on_user_page()
+
+    # The page holding psn_27 is read, nothing past it is loaded
+    assert matches == [f'psn_{i}' for i in range(49, 19, -1)]
+    assert retriever.backend.scrolls == 2
+
+def test_scrolling_stops_when_nothing_more_loads(retriever):
+
+    retriever.SCROLL_TIMEOUT = .05
+    retriever.backend.total = 25
+    start = time.perf_counter()
+    matches, match_modes = retriever.scroll_on_user_page()
+
+    # The last scroll times out instead of using up scroll_times
+    assert matches == [f'psn_{i}' for i in range(24, -1, -1)]
+    assert retriever.backend.scrolls == 3
+    assert retriever.backend.reads == [0, 10, 20]
+    assert time.perf_counter() - start < 1
+
+def test_wait_for_entries_polls_until_the_page_grows(retriever):
+
+    backend = retriever.backend
+    assert not retriever.wait_for_entries(10)
+    backend.execute_script('window.scrollTo(0, document.body.scrollHeight);')
+    assert retriever.wait_for_entries(10)
+    assert backend.loaded == 20 and backend.pending == 0
@@ -0,0 +1,136 @@
+# Running group stats and percentile bins against pandas computing them directly
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from stats import ALL, GroupStats, QuantileSketch, lookup, percentile_bins
+
+def make_frame(n, seed):
+
+    rng = np.random.default_rng(seed)
+
+    return pd.DataFrame({'map_mode':rng.choice(['Arras_Breakthrough', 'Hamada_Breakthrough', 'Panzerstorm_Breakthrough'], n),
+                         'spm':rng.gamma(2, 150, n), 'kpm':rng.random(n)*3})
+
+def assert_matches_pandas(stats, df):
+
+    for var in ['spm', 'kpm']:
+        grouped = df.groupby('map_mode')[var]
+        np.testing.assert_allclose(stats.mean(var).drop(ALL).sort_index(), grouped.mean().sort_index())
+        np.testing.assert_allclose(stats.std(var).drop(ALL).sort_index(), grouped.std().sort_index())
+        assert stats.mean(var)[ALL] == pytest.approx(df[var].mean())
+        assert stats.std(var)[ALL] == pytest.approx(df[var].std())
+
+def test_group_stats_match_groupby():
+
+    df = make_frame(500, 0)
+
+    assert_matches_pandas(GroupStats.from_frame(df, 'map_mode', ['spm', 'kpm']), df)
+
+def test_group_stats_merge_and_remove_batches():
+
+    df = make_frame(900, 1)
+    stats = GroupStats.from_frame(df[:300], 'map_mode', ['spm', 'kpm'])
+    stats.add(GroupStats.from_frame(df[300:], 'map_mode', ['spm', 'kpm']))
+    assert_matches_pandas(stats, df)
+
+    stats.remove(GroupStats.from_frame(df[:200], 'map_mode', ['spm', 'kpm']))
+    assert_matches_pandas(stats, df[200:])
+
+def test_lookup_maps_keys_to_group_values():
+
+    keys = pd.Series(['b', 'a', 'b', 'c'])
+    values = pd.Series({'a':1.0, 'b':2.0, 'c':3.0})
+
+    np.testing.assert_array_equal(lookup(keys, values), [2.0, 1.0, 2.0, 3.0])
+
+@pytest.mark.parametrize('values', [np.random.default_rng(2).random(1000),
+                                    np.random.default_rng(3).integers(0, 20, 1000).astype(float), # duplicate edges
+                                    np.concatenate([np.random.default_rng(4).random(300), [np.nan]*10])])
+def test_percentile_bins_match_qcut(values):
+
+    expected = pd.qcut(values, 100, duplicates='drop', labels=False)
+
+    np.testing.assert_array_equal(percentile_bins(values), expected)
+
+def test_percentile_bins_from_population():
+
+    rng = np.random.default_rng(5)
+    population = rng.random(1000)
+    values = population[:100]
+
+    np.testing.assert_array_equal(percentile_bins(values, population), pd.qcut(population, 100, labels=False)[:100])
+
+def rank_error(values, estimate, q):
+    """
+    How far the estimate's place in values is from q
+    """
+
+    return abs((values < estimate).mean() + ((values == estimate).mean()/2) - q)
+
+QUANTILES = [.01, .05, .1, .25, .5, .75, .9, .95, .99]
+
+@pytest.mark.parametrize('values', [np.random.default_rng(6).gamma(2, 150, 20000),
+                                    np.random.default_rng(7).normal(0, 1, 20000),
+                                    np.random.default_rng(8).integers(0, 40, 20000).astype(float)])
+def test_quantile_sketch_accuracy(values):
+
+    sketch = QuantileSketch().update(values)
+
+    assert len(sketch.means) <= 200
+    assert sketch.count() == len(values)
+    for q in QUANTILES:
+        assert rank_error(values, sketch.quantile(q), q) < .01, q
+    assert sketch.quantile(0) == values.min()
+    assert sketch.quantile(1) == values.max()
+
+def test_quantile_sketch_tails_stay_close():
+
+    values = np.random.default_rng(9).gamma(2, 150, 50000)
+    sketch = QuantileSketch().update(values)
+
+    for q in [.001, .01, .99, .999]:
+        assert sketch.quantile(q) == pytest.approx(np.quantile(values, q), rel=.02), q
+
+def test_merged_sketches_match_one_sketch():
+
+    values = np.random.default_rng(10).gamma(2, 150, 30000)
+    whole = QuantileSketch().update(values)
+
+    merged = QuantileSketch()
+    for chunk in np.array_split(values, 30):
+        merged.merge(QuantileSketch().update(chunk))
+
+    assert merged.count() == whole.count()
+    assert (merged.low, merged.high) == (whole.low, whole.high)
+    for q in QUANTILES:
+        assert rank_error(values, merged.quantile(q), q) < .01, q
+        assert merged.quantile(q) == pytest.approx(whole.quantile(q), rel=.02), q
+
+def test_quantile_sketch_skips_nan_and_empty():
+
+    sketch = QuantileSketch()
+    assert np.isnan(sketch.quantile(.5))
+
+    sketch.update([np.nan, np.nan])
+    assert np.isnan(sketch.quantile(.5))
+
+    sketch.update([1.0, np.nan, 3.0])
+    assert sketch.count() == 2
+    assert sketch.quantile(.5) == pytest.approx(2.0)
+
+def test_quantile_sketch_bytes_round_trip():
+
+    sketch = QuantileSketch(compression=100).update(np.random.default_rng(11).random(5000))
+    loaded = QuantileSketch.from_bytes(sketch.to_bytes())
+
+    assert loaded.compression == 100
+    assert (loaded.low, loaded.high) == (sketch.low, sketch.high)
+    np.testing.assert_array_equal(loaded.means, sketch.means)
+    np.testing.assert_array_equal(loaded.weights, sketch.weights)
+    assert [loaded.quantile(q) for q in QUANTILES] == [sketch.quantile(q) for q in QUANTILES]
+
+    # Loaded sketches keep taking values
+    loaded.update([2.0])
+    assert loaded.high == 2.0